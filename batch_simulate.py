@@ -0,0 +1,255 @@
+"""Vectorized blackjack simulation with NumPy.
+
+Plays many independent single seat tables at once. Each table has its own shoe, a row of an (n_tables, n_cards)
+uint8 matrix of card codes, and a round is played as array operations over all tables: player decisions come from a
+ChartStrategy's table and the dealer draws to 17 in a masked loop. The rules and payouts are those of
+BlackJackEngine / BlackJackGameBase, for a player betting 1 every round.
+
+Usage: python batch_simulate.py --tables 10000 --rounds 100 --strategy always-stand
+"""
+import argparse
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from cards import (
+    Actions,
+    HARD_CARD_VALUES,
+    NUM_OF_CARDS_IN_DECK,
+    SAME_AS_THE_BET,
+    ONE_AND_A_HALF_TIMES_THE_BET,
+    TWICE_AS_THE_BET,
+    CARDS,
+)
+from engine import Outcomes, SURRENDER_MULTIPLIER, TABLE_RULES
+from strategies import STRATEGIES, NUM_OF_UPCARDS, MAX_HAND_TOTAL, upcard_index
+
+_HARD_VALUES = np.array(HARD_CARD_VALUES, dtype=np.int16)
+_ACES = (_HARD_VALUES == 1).astype(np.int16)
+_UPCARD_COLUMNS = np.array([upcard_index(card) for card in CARDS], dtype=np.intp)
+
+_HIT = Actions.HIT.value
+_DOUBLE = Actions.DOUBLE.value
+_SURRENDER = Actions.SURRENDER.value
+
+UPCARD_NAMES = ("2", "3", "4", "5", "6", "7", "8", "9", "10", "A")
+
+BatchRoundResult = namedtuple(
+    "BatchRoundResult",
+    ["bet", "payout", "outcome", "player_value", "upcard_column", "dealer_value", "dealer_drew", "dealer_bust"],
+)
+
+
+def strategy_tables(strategy):
+    """(first decision, later decisions) arrays of Actions values, indexed by [is_soft, total, upcard column]"""
+    tables = np.empty((2, 2, MAX_HAND_TOTAL + 1, NUM_OF_UPCARDS), dtype=np.int8)
+    for can_double in (True, False):
+        for is_soft in (False, True):
+            for total in range(MAX_HAND_TOTAL + 1):
+                for column in range(NUM_OF_UPCARDS):
+                    action = strategy.decide(total, is_soft, column, can_double)
+                    tables[int(not can_double), int(is_soft), total, column] = action.value
+    return tables[0], tables[1]
+
+
+def hand_values(hard_totals, num_of_aces):
+    """Vectorized Hand.value"""
+    soft = (num_of_aces > 0) & (hard_totals + 10 <= 21)
+    return np.where(hard_totals > 21, hard_totals + 10 * num_of_aces, np.where(soft, hard_totals + 10, hard_totals))
+
+
+class BatchTableSimulator(object):
+    def __init__(self, num_of_tables, num_of_decks, penetration, strategy, seed=None):
+        self._num_of_tables = num_of_tables
+        self._num_of_cards = num_of_decks * NUM_OF_CARDS_IN_DECK
+        self._cut_card_position = max(1, int(self._num_of_cards * penetration))
+        self._first_decision, self._later_decision = strategy_tables(strategy)
+        self._rng = np.random.default_rng(seed)
+        self._sorted_shoe = np.tile(np.arange(NUM_OF_CARDS_IN_DECK, dtype=np.uint8), num_of_decks)
+        self._shoes = np.empty((num_of_tables, self._num_of_cards), dtype=np.uint8)
+        self._positions = np.zeros(num_of_tables, dtype=np.intp)
+        self._all_tables = np.arange(num_of_tables)
+        self._shuffle(self._all_tables)
+
+    @property
+    def shoes(self):
+        return self._shoes
+
+    @property
+    def positions(self):
+        return self._positions
+
+    def _shuffle(self, tables):
+        self._shoes[tables] = self._rng.permuted(
+            np.broadcast_to(self._sorted_shoe, (len(tables), self._num_of_cards)), axis=1
+        )
+        self._positions[tables] = 0
+
+    def _draw(self, tables):
+        exhausted = self._positions[tables] >= self._num_of_cards
+        if exhausted.any():  # Like Shoe.draw_code, reshuffle rather than stopping the round
+            self._shuffle(tables[exhausted])
+        codes = self._shoes[tables, self._positions[tables]]
+        self._positions[tables] += 1
+        return codes
+
+    def play_round(self):
+        self._shuffle(np.flatnonzero(self._positions >= self._cut_card_position))
+        tables = self._all_tables
+
+        # Deal cards
+        first_card, dealer_upcard = self._draw(tables), self._draw(tables)
+        second_card, hole_card = self._draw(tables), self._draw(tables)
+        player_hard = _HARD_VALUES[first_card] + _HARD_VALUES[second_card]
+        player_aces = _ACES[first_card] + _ACES[second_card]
+        dealer_hard = _HARD_VALUES[dealer_upcard] + _HARD_VALUES[hole_card]
+        dealer_aces = _ACES[dealer_upcard] + _ACES[hole_card]
+        upcard_column = _UPCARD_COLUMNS[dealer_upcard]
+
+        bet = np.ones(self._num_of_tables)
+        payout = np.zeros(self._num_of_tables)
+        outcome = np.zeros(self._num_of_tables, dtype=np.int8)
+
+        # Check for blackjacks
+        natural = hand_values(player_hard, player_aces) == 21
+        dealer_natural = hand_values(dealer_hard, dealer_aces) == 21
+        payout[natural & dealer_natural] = SAME_AS_THE_BET
+        outcome[natural & dealer_natural] = Outcomes.TIE.value
+        payout[natural & ~dealer_natural] = ONE_AND_A_HALF_TIMES_THE_BET
+        outcome[natural & ~dealer_natural] = Outcomes.NATURAL.value
+
+        # Players' decisions
+        in_round = ~natural
+        deciding = in_round.copy()
+        decisions = self._first_decision
+        while True:
+            deciding_tables = np.flatnonzero(deciding)
+            if deciding_tables.size == 0:
+                break
+
+            hard = player_hard[deciding_tables]
+            aces = player_aces[deciding_tables]
+            is_soft = ((aces > 0) & (hard + 10 <= 21)).astype(np.intp)
+            actions = decisions[is_soft, hand_values(hard, aces), upcard_column[deciding_tables]]
+            decisions = self._later_decision
+
+            surrendered = deciding_tables[actions == _SURRENDER]
+            payout[surrendered] = SURRENDER_MULTIPLIER
+            outcome[surrendered] = Outcomes.SURRENDER.value
+            in_round[surrendered] = False
+
+            doubled = deciding_tables[actions == _DOUBLE]
+            bet[doubled] *= 2
+            deciding[deciding_tables[actions != _HIT]] = False
+
+            drawing = deciding_tables[(actions == _HIT) | (actions == _DOUBLE)]
+            codes = self._draw(drawing)
+            player_hard[drawing] += _HARD_VALUES[codes]
+            player_aces[drawing] += _ACES[codes]
+
+            bust = drawing[player_hard[drawing] > 21]
+            outcome[bust] = Outcomes.BUST.value
+            in_round[bust] = False
+            deciding[bust] = False
+
+        # Dealer takes cards until he has 17 or higher, then check who won
+        dealer_value = hand_values(dealer_hard, dealer_aces)
+        dealer_drawing = in_round & (dealer_value < 17)
+        while dealer_drawing.any():
+            drawing = np.flatnonzero(dealer_drawing)
+            codes = self._draw(drawing)
+            dealer_hard[drawing] += _HARD_VALUES[codes]
+            dealer_aces[drawing] += _ACES[codes]
+            dealer_value[drawing] = hand_values(dealer_hard[drawing], dealer_aces[drawing])
+            dealer_drawing[drawing] = dealer_value[drawing] < 17
+
+        player_value = hand_values(player_hard, player_aces)
+        dealer_bust = in_round & (dealer_hard > 21)
+        win = in_round & (dealer_bust | (player_value > dealer_value))
+        tie = in_round & ~win & (player_value == dealer_value)
+        lose = in_round & ~win & ~tie
+        payout[win] = bet[win] * TWICE_AS_THE_BET
+        outcome[win] = Outcomes.WIN.value
+        payout[tie] = bet[tie] * SAME_AS_THE_BET
+        outcome[tie] = Outcomes.TIE.value
+        outcome[lose] = Outcomes.LOSE.value
+
+        return BatchRoundResult(
+            bet, payout, outcome, player_value, upcard_column, dealer_value, in_round.copy(), dealer_bust
+        )
+
+
+class BatchStats(object):
+    def __init__(self):
+        self.hands = 0
+        self.net = 0.0
+        self.net_squared = 0.0
+        self.outcomes = np.zeros(len(Outcomes) + 1, dtype=np.int64)  # indexed by Outcomes value
+        self.dealer_rounds_by_upcard = np.zeros(NUM_OF_UPCARDS, dtype=np.int64)
+        self.dealer_busts_by_upcard = np.zeros(NUM_OF_UPCARDS, dtype=np.int64)
+
+    def add_round(self, result):
+        net = result.payout - result.bet
+        self.hands += len(net)
+        self.net += net.sum()
+        self.net_squared += (net * net).sum()
+        self.outcomes += np.bincount(result.outcome, minlength=len(self.outcomes))
+        self.dealer_rounds_by_upcard += np.bincount(
+            result.upcard_column[result.dealer_drew], minlength=NUM_OF_UPCARDS
+        )
+        self.dealer_busts_by_upcard += np.bincount(
+            result.upcard_column[result.dealer_bust], minlength=NUM_OF_UPCARDS
+        )
+
+    @property
+    def expected_value(self):
+        return self.net / self.hands
+
+    @property
+    def variance(self):
+        return self.net_squared / self.hands - self.expected_value ** 2
+
+    def dealer_bust_rate_by_upcard(self):
+        return dict(zip(UPCARD_NAMES, self.dealer_busts_by_upcard / np.maximum(self.dealer_rounds_by_upcard, 1)))
+
+    def outcome_rates(self):
+        return {outcome.name: self.outcomes[outcome.value] / self.hands for outcome in Outcomes}
+
+
+def simulate(strategy_name, rules_name, num_of_tables, num_of_rounds, seed=None):
+    rules = TABLE_RULES[rules_name]
+    simulator = BatchTableSimulator(
+        num_of_tables, rules.num_of_decks, rules.penetration, STRATEGIES[strategy_name], seed=seed
+    )
+    stats = BatchStats()
+    for _ in range(num_of_rounds):
+        stats.add_round(simulator.play_round())
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fixed blackjack strategy on many tables at once")
+    parser.add_argument("--strategy", choices=sorted(STRATEGIES), default="basic")
+    parser.add_argument("--rules", choices=sorted(TABLE_RULES), default="default")
+    parser.add_argument("--tables", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    stats = simulate(args.strategy, args.rules, args.tables, args.rounds, args.seed)
+    elapsed_seconds = time.perf_counter() - start
+
+    print("Hands:          %d" % stats.hands)
+    print("Expected value: %.4f%% (variance %.4f)" % (stats.expected_value * 100, stats.variance))
+    for outcome, rate in stats.outcome_rates().items():
+        print("%-15s %.4f%%" % (outcome + ":", rate * 100))
+    print("Dealer bust rate by upcard:")
+    for upcard, rate in stats.dealer_bust_rate_by_upcard().items():
+        print("  %-3s %.4f%%" % (upcard, rate * 100))
+    print("Took %.2f seconds, %d hands per second" % (elapsed_seconds, stats.hands / elapsed_seconds))
+
+
+if __name__ == "__main__":
+    main()
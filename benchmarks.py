@@ -0,0 +1,244 @@
+"""Micro and macro benchmarks of the game core.
+
+Every benchmark is a function building a zero argument callable to time, registered in BENCHMARKS. Each one is timed
+with timeit: the number of calls per repeat is calibrated to last about --min-time seconds, then the best and the
+median time per call over --repeats repeats are reported. The best time is the one compared, as it is the least
+affected by noise.
+
+Results can be saved as JSON and compared with a saved baseline. A benchmark is a regression if it became slower
+than the baseline by more than --threshold (e.g. 1.1 for 10%), and the comparison exits with a non-zero status if
+any benchmark regressed.
+
+Usage:
+    python benchmarks.py --save baseline.json
+    python benchmarks.py --compare baseline.json --threshold 1.1
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import timeit
+
+from blackjack_base import AwaitedPlayer, BlackJackGameBase
+from cards import (
+    Actions,
+    Card,
+    CARDS,
+    Deck,
+    Hand,
+    Shoe,
+    Suites,
+)
+from engine import BlackJackEngine
+from strategies import BASIC_STRATEGY
+
+BENCHMARKS = {}
+
+HAND_SIZES = (2, 3, 5, 8)
+NUM_OF_SCRIPTED_PLAYERS = 6
+DEFAULT_MIN_TIME = 0.2  # seconds per repeat
+DEFAULT_REPEATS = 5
+DEFAULT_THRESHOLD = 1.1
+
+
+def benchmark(name):
+    def register(build_callable):
+        BENCHMARKS[name] = build_callable
+        return build_callable
+
+    return register
+
+
+class _ScriptedPlayer(AwaitedPlayer):
+    """Bets 10 every round and hits below 17"""
+
+    async def get_bet(self):
+        return 10
+
+    async def get_cmd(self, msg, list_of_valid_actions):
+        if Actions.BET in list_of_valid_actions:
+            return Actions.BET
+        return Actions.HIT if self.cards.value < 17 else Actions.STAND
+
+    async def msg_to_user(self, *args, **kwargs):
+        pass
+
+
+class _ScriptedGame(BlackJackGameBase):
+    def __init__(self, num_of_players):
+        super().__init__()
+        for seat in range(num_of_players):
+            self.add_player(_ScriptedPlayer("P%d" % seat, id=str(seat), amount_of_money=10 ** 9))
+
+    def remove_player_from_game(self, player_id):
+        pass
+
+    def _end_connection_with_player(self, player_id):
+        pass
+
+    async def output_msg_to_game(self, msg):
+        pass
+
+
+def _hand_of(num_of_cards):
+    # Low cards first, so every size has a mix of aces, low and face cards
+    ranks = ("A", 2, "K", 3, "A", 4, 5, "Q")
+    hand = Hand()
+    for suit_index, rank in enumerate(ranks[:num_of_cards]):
+        hand.take_card(Card(list(Suites)[suit_index % 4], rank))
+    return hand
+
+
+@benchmark("card_hash")
+def _card_hash():
+    cards = CARDS
+    return lambda: [hash(card) for card in cards]
+
+
+@benchmark("card_eq")
+def _card_eq():
+    cards = CARDS
+    first_card = cards[0]
+    return lambda: [card == first_card for card in cards]
+
+
+@benchmark("card_lookup")
+def _card_lookup():
+    return lambda: Card(Suites.HEARTS, "Q")
+
+
+@benchmark("deck_take_52_cards")
+def _deck_take_52_cards():
+    cards = CARDS
+
+    def take_52_cards():
+        deck = Deck()
+        for card in cards:
+            deck.take_card(card)
+
+    return take_52_cards
+
+
+@benchmark("deck_fill_52_cards")
+def _deck_fill_52_cards():
+    deck = Deck()
+    return deck.fill_deck_with_52_cards
+
+
+@benchmark("deck_reset_and_shuffle")
+def _deck_reset_and_shuffle():
+    deck = Deck()
+    return deck.reset_deck_and_shuffle
+
+
+@benchmark("shoe_draw_card")
+def _shoe_draw_card():
+    shoe = Shoe(seed=0)
+
+    def draw_card():
+        shoe.shuffle_if_cut_card_reached()
+        return shoe.draw_card()
+
+    return draw_card
+
+
+for _num_of_cards in HAND_SIZES:
+    @benchmark("deck_game_value_%d_cards" % _num_of_cards)
+    def _deck_game_value(num_of_cards=_num_of_cards):
+        game = _ScriptedGame(num_of_players=0)
+        hand = _hand_of(num_of_cards)
+        return lambda: game._get_deck_game_value(hand)
+
+    @benchmark("hand_value_%d_cards" % _num_of_cards)
+    def _hand_value(num_of_cards=_num_of_cards):
+        hand = _hand_of(num_of_cards)
+        return lambda: hand.value
+
+
+@benchmark("play_round_%d_players" % NUM_OF_SCRIPTED_PLAYERS)
+def _play_round():
+    game = _ScriptedGame(NUM_OF_SCRIPTED_PLAYERS)
+    loop = asyncio.new_event_loop()
+    return lambda: loop.run_until_complete(game.play_round())
+
+
+@benchmark("engine_round_%d_seats" % NUM_OF_SCRIPTED_PLAYERS)
+def _engine_round():
+    engine = BlackJackEngine(Shoe(seed=0))
+    bets = [10] * NUM_OF_SCRIPTED_PLAYERS
+    return lambda: engine.play_round(bets, BASIC_STRATEGY)
+
+
+def run_benchmark(name, min_time=DEFAULT_MIN_TIME, repeats=DEFAULT_REPEATS):
+    timer = timeit.Timer(BENCHMARKS[name]())
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))  # autorange aims at 0.2 seconds
+    seconds_per_call = [total / number for total in timer.repeat(repeat=repeats, number=number)]
+    return {
+        "best": min(seconds_per_call),
+        "median": statistics.median(seconds_per_call),
+        "calls_per_repeat": number,
+        "repeats": repeats,
+    }
+
+
+def run_benchmarks(names, min_time=DEFAULT_MIN_TIME, repeats=DEFAULT_REPEATS):
+    return {name: run_benchmark(name, min_time, repeats) for name in names}
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """{name: best time / baseline's best time} of the benchmarks in both, and the names of those that regressed"""
+    ratios = {
+        name: result["best"] / baseline[name]["best"] for name, result in results.items() if name in baseline
+    }
+    return ratios, [name for name, ratio in ratios.items() if ratio > threshold]
+
+
+def _format_seconds(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return "%.2f%s" % (seconds / scale, unit)
+    return "%.1fns" % (seconds / 1e-9)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the game core")
+    parser.add_argument("--filter", default="", help="Only run the benchmarks whose name contains this")
+    parser.add_argument("--min-time", type=float, default=DEFAULT_MIN_TIME, help="Seconds per repeat")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS)
+    parser.add_argument("--save", help="Save the results as JSON to this file")
+    parser.add_argument("--compare", help="Compare the results with a baseline saved with --save")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Slowdown ratio of a regression")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS if args.filter in name]
+    results = run_benchmarks(names, args.min_time, args.repeats)
+
+    if args.save:
+        with open(args.save, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+    ratios, regressions = {}, []
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            ratios, regressions = compare(results, json.load(baseline_file), args.threshold)
+
+    if args.json:
+        print(json.dumps({"results": results, "ratios": ratios, "regressions": regressions}, indent=2))
+    else:
+        for name, result in results.items():
+            line = "%-28s best %10s  median %10s" % (
+                name, _format_seconds(result["best"]), _format_seconds(result["median"])
+            )
+            if name in ratios:
+                line += "  %.2fx baseline%s" % (ratios[name], "  REGRESSION" if name in regressions else "")
+            print(line)
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,155 +1,55 @@
-from enum import Enum
-import random
 import logging
 import abc
 import asyncio
+import contextvars
 
-class NoMoreCardsInDeckError(Exception):
-    pass
-
+from cards import (
+    Actions,
+    Hand,
+    RoundPhases,
+    Shoe,
+    ACE_VALUE,
+    DEFAULT_NUM_OF_DECKS_IN_SHOE,
+    DEFAULT_SHOE_PENETRATION,
+)
+from engine import Outcomes, RoundState
+import tracing
 
-class CardAlreadyInDeckError(Exception):
-    pass
+logger = logging.getLogger(__name__)
 
 
 class PlayerHasNoMoneyError(Exception):
     pass
 
 
-SAME_AS_THE_BET = 1
-ONE_AND_A_HALF_TIMES_THE_BET = 1.5
-TWICE_AS_THE_BET = 2
-ACE_VALUE = 11
-
-
-class Suites(Enum):
-    HEARTS = 1
-    DIAMONDS = 2
-    SPADES = 3
-    CLUBS = 4
-
+# The game whose round the running code belongs to. Tasks started during a round (e.g. the players' bets) inherit it.
+current_table = contextvars.ContextVar("current_table", default=None)
 
-class Actions(Enum):
-    HIT = 1
-    STAND = 2
-    BET = 3
-    SKIP = 4
-    DOUBLE = 5
-    SURRENDER = 6
 
-
-SUITES_TO_ICON = {
-    Suites.HEARTS: "♥",
-    Suites.CLUBS: "♣",
-    Suites.DIAMONDS: "♦",
-    Suites.SPADES: "♠",
+# What players type for each action
+COMMANDS = {
+    "h": Actions.HIT,
+    "hit": Actions.HIT,
+    "s": Actions.STAND,
+    "stand": Actions.STAND,
+    "b": Actions.BET,
+    "bet": Actions.BET,
+    "skip": Actions.SKIP,
+    "d": Actions.DOUBLE,
+    "surrender": Actions.SURRENDER,
 }
 
-ALL_CARD_RANKS = list(range(2, 11)) + list("JQKA")
-
-
-class Card(object):
-    def __init__(self, suit, rank):
-        self._suit = suit
-        self._rank = rank
-
-    @property
-    def suit(self):
-        return self._suit
-
-    @property
-    def rank(self):
-        return self._rank
-
-    @property
-    def text_image(self):
-        return "[%s of %s ]" % (self.rank, SUITES_TO_ICON[self.suit])
-
-    def __eq__(self, other):
-        return self.suit == other.suit and self.rank == other.rank
-
-    def __str__(self):
-        return "<Card %s of %s>" % (self.rank, self.suit.name)
-
-    def __repr__(self):
-        return str(self)
-
-    def __hash__(self):
-        return hash(str(self.rank) + str(self.suit.name))
-
-
-class Deck(object):
-    def __init__(self):
-        self._deck = []
-
-    def __eq__(self, other):  # implemented only for sorted decks
-
-        if len(self._deck) != len(other._deck):
-            return False
-
-        for i in range(len(self._deck)):
-            if self._deck[i] != other._deck[i]:
-                return False
-        return True
-
-    def __len__(self):
-        return len(self._deck)
-
-    def shuffle(self):
-        random.shuffle(self._deck)
-
-    @property
-    def cards(self):
-        return self._deck
-
-    @property
-    def return_deck_as_icons(self):
-        cards_image_list = []
-
-        for card in self.cards:
-            cards_image_list.append(card.text_image)
-
-        str_of_deck_as_icons = ", ".join(cards_image_list)
-        return str_of_deck_as_icons
-
-    def draw_card(self):
-        try:
-            return self._deck.pop()
-        except IndexError:
-            raise NoMoreCardsInDeckError()
-
-    def take_card(self, card, top_of_deck=True):
-        if card in self._deck:
-            raise CardAlreadyInDeckError("Card %s already in deck" % card)
-
-        if top_of_deck:
-            self._deck.append(card)
-        else:
-            self._deck.insert(0, card)
-
-    def empty_all_cards(self):
-        for _ in self.cards:
-            self._deck.pop()
-
-    def fill_deck_with_52_cards(self):
-        self._deck = []
-        for card_rank in ALL_CARD_RANKS:
-            for suit in Suites:
-                self._deck.append(Card(suit, card_rank))
-
-    def reset_deck_and_shuffle(self):
-        self._deck = []
-        self.fill_deck_with_52_cards()
-        self.shuffle()
-
 
 class Player(abc.ABC):
+    """A seated player: his cards, his money and the messages to him. How he is asked for his decisions is up to his
+    game, see AwaitedPlayer."""
+
     def __init__(self, name: str, id: str, amount_of_money: int = 0) -> None:
-        self.cards = Deck()
+        self.cards = Hand()
         self._name = name
         self._amount_of_money = amount_of_money
         self._id = id
-        logging.info("Player Created with name: %s. money: %d", name, amount_of_money)
+        logger.info("Player Created with name: %s. money: %d", name, amount_of_money)
 
     def __str__(self):
         return self._name
@@ -158,24 +58,13 @@ class Player(abc.ABC):
     def id(self):
         return self._id
 
-    @abc.abstractmethod
-    def _get_input_from_user(
-            self, msg
-    ):  # method to request strings (i.e names, how many players, etc)
-        pass
-
-    @abc.abstractmethod
-    async def get_cmd(self, msg, list_of_valid_actions):
-        pass
-
-    async def _bet_is_valid(self, bet):
-        logging.debug("Validating Bet")
+    def invalid_bet_message(self, bet):
+        """The message telling the player why bet isn't a valid bet, None if it is"""
         try:
             bet = int(bet)
         except ValueError:
-            logging.info(f"Got a non valid bet from %s", self.get_player_name)
-            await self.msg_to_user("Enter a positive number")
-            return False
+            logger.info("Got a non valid bet from %s", self.get_player_name)
+            return "Enter a positive number"
 
         if self.remaining_money == 0:
             raise PlayerHasNoMoneyError(
@@ -183,67 +72,13 @@ class Player(abc.ABC):
             )
 
         if bet > self.remaining_money:
-            logging.info("%s tried to bet more than he has", self.get_player_name)
-            await self.msg_to_user(
-                "You don't have %s$! you can place a bet up to %d"
-                % (bet, self.remaining_money)
-            )
-            return False
+            logger.info("%s tried to bet more than he has", self.get_player_name)
+            return "You don't have %s$! you can place a bet up to %d" % (bet, self.remaining_money)
 
         elif bet < 0:
-            logging.info("%s tried to bet a negative number", self.get_player_name)
-            await self.msg_to_user("Enter a positive number")
-            return False
-        logging.debug("Bet is valid")
-        return True
-
-    async def _convert_command_to_Action(self, user_input):
-        logging.debug("Converting user input %s to command", user_input)
-        try:
-            user_input = user_input.strip().lower()
-
-            if user_input == "h" or user_input == "hit":
-                logging.info("accepted decision from %s, HIT", self.get_player_name)
-                return Actions.HIT
-
-            if user_input == "s" or user_input == "stand":
-                logging.info("accepted decision from %s, STAND", self.get_player_name)
-                return Actions.STAND
-
-            if user_input == "b" or user_input == "bet":
-                logging.info("accepted decision from %s, BET", self.get_player_name)
-                return Actions.BET
-
-            if user_input == "skip":
-                logging.info("accepted decision from %s, SKIP", self.get_player_name)
-                return Actions.SKIP
-
-            if user_input == "d":
-                logging.info(
-                    "accepted decision from %s, Double Down", self.get_player_name
-                )
-                return Actions.DOUBLE
-
-            if user_input == "surrender":
-                logging.info(
-                    "accepted decision from %s, Surrender", self.get_player_name
-                )
-                return Actions.SURRENDER
-
-            else:
-                await self.msg_to_user("Not a valid command!")
-                logging.info(
-                    "%s typed the following invalid command: %s.",
-                    self.get_player_name,
-                    user_input,
-                )
-                return None
-
-        except AttributeError:
-            logging.exception(
-                f"{self.get_player_name} typed {user_input}, not a string"
-            )
-            await self.msg_to_user("Enter a valid command according to the instructions")
+            logger.info("%s tried to bet a negative number", self.get_player_name)
+            return "Enter a positive number"
+        return None
 
     @property
     def get_player_name(self):
@@ -261,16 +96,14 @@ class Player(abc.ABC):
 
     def get_money(self, amount_to_get):
         self._amount_of_money += amount_to_get
-        logging.debug(
-            f"{self.get_player_name} got {amount_to_get} and now has {self.remaining_money}"
+        logger.debug(
+            "%s got %s and now has %s", self.get_player_name, amount_to_get, self.remaining_money
         )
 
     def give_money(self, amount_to_give):
         self._amount_of_money -= amount_to_give
-        logging.debug(
-            f"{self.get_player_name} paid {amount_to_give} and has {self._amount_of_money} left",
-            self.get_player_name,
-            self._amount_of_money,
+        logger.debug(
+            "%s paid %s and has %s left", self.get_player_name, amount_to_give, self._amount_of_money
         )
         return amount_to_give
 
@@ -283,17 +116,93 @@ class Player(abc.ABC):
         return self._amount_of_money
 
 
+class AwaitedPlayer(Player):
+    """A player whose game awaits his answers, like BlackJackGameBase does"""
+
+    @abc.abstractmethod
+    async def get_cmd(self, msg, list_of_valid_actions):
+        pass
+
+    @abc.abstractmethod
+    async def get_bet(self):
+        """The amount the player bets, None if he didn't place a bet in time"""
+        pass
+
+    async def _bet_is_valid(self, bet):
+        logger.debug("Validating Bet")
+        message = self.invalid_bet_message(bet)
+        if message is not None:
+            await self.msg_to_user(message)
+            return False
+        logger.debug("Bet is valid")
+        return True
+
+    async def _convert_command_to_Action(self, user_input):
+        logger.debug("Converting user input %s to command", user_input)
+        try:
+            action = COMMANDS.get(user_input.strip().lower())
+        except AttributeError:
+            logger.exception(
+                "%s typed %s, not a string", self.get_player_name, user_input
+            )
+            await self.msg_to_user("Enter a valid command according to the instructions")
+            return None
+
+        if action is None:
+            await self.msg_to_user("Not a valid command!")
+            logger.info(
+                "%s typed the following invalid command: %s.",
+                self.get_player_name,
+                user_input,
+            )
+            return None
+
+        logger.info("accepted decision from %s, %s", self.get_player_name, action.name)
+        return action
+
+
 class BlackJackGameBase(abc.ABC):
-    def __init__(self):
+    def __init__(
+            self,
+            num_of_decks=DEFAULT_NUM_OF_DECKS_IN_SHOE,
+            penetration=DEFAULT_SHOE_PENETRATION,
+            betting_deadline=None,
+    ):
+        self._betting_deadline = betting_deadline  # seconds. None waits for every player to bet or skip.
         self._players_bet = {}
         self.players = []
-        self._players_in_round = []
-        self._dealers_cards = Deck()
-        self._game_deck = Deck()
+        self._round = None  # The RoundState of the round, once the cards are dealt
+        self._round_players = []  # The players of the round's seats
+        self._players_in_round = []  # The players of the round who didn't win, lose or surrender yet
+        self._paid_seats = set()
+        self._dealers_cards = Hand()
+        self._game_deck = Shoe(num_of_decks=num_of_decks, penetration=penetration)
+        self._player_joined = asyncio.Event()
+        self._phase = None
+        self._phase_span = tracing.NO_SPAN
+        self._hole_card_revealed = False
+        self.table_name = "table"  # The room this game is played in, in traces
+
+    @property
+    def phase(self):
+        """The RoundPhases the current round is in, None between rounds"""
+        return self._phase
+
+    async def _start_phase(self, phase):
+        # Called as the round moves to each of RoundPhases. Subclasses can extend it, e.g. to flush messages
+        logger.debug("Round phase is now %s", phase)
+        self._phase = phase
+        self._phase_span.end()
+        self._phase_span = self._trace_span(phase.name.lower())
+
+    def _trace_span(self, name, player=None, track=None):
+        """A tracing span of this table (see tracing.py), on the table's track unless given another one"""
+        return tracing.table_span(self.table_name, name, player.get_player_name if player is not None else None, track)
 
     def add_player(self, player):
-        logging.info("Player added")
+        logger.info("Player added")
         self.players.append(player)
+        self._player_joined.set()
 
     @abc.abstractmethod
     def remove_player_from_game(self, player_id):
@@ -321,9 +230,39 @@ class BlackJackGameBase(abc.ABC):
     async def output_msg_to_game(self, msg):
         pass
 
+    async def output_table_to_game(self, msg_format, *args):
+        """Shows a change of the cards on the table. msg_format is only formatted with args here, so games that send
+        the table as structured state (see table_state) can skip the text altogether."""
+        await self.output_msg_to_game(msg_format % args)
+
+    def table_state(self):
+        """The table as plain data: the round's phase, and the card codes of the dealer and of each seat, keyed by the
+        player's id. The dealer's hole card is None until it is revealed."""
+        dealer_cards = list(self._dealers_cards.codes)
+        if len(dealer_cards) == 2 and not self._hole_card_revealed and self._phase in (
+                RoundPhases.DEAL,
+                RoundPhases.DECISIONS,
+        ):
+            dealer_cards[1] = None
+
+        return {
+            "phase": self._phase.name if self._phase is not None else None,
+            "dealer": dealer_cards,
+            "seats": {
+                player.id: {
+                    "seat": seat,
+                    "name": player.get_player_name,
+                    "money": player.remaining_money,
+                    "bet": self._players_bet.get(player, 0),
+                    "cards": list(player.cards.codes),
+                }
+                for seat, player in enumerate(self.players)
+            },
+        }
+
     def _get_deck_game_value(self, deck):
 
-        logging.debug("getting deck_game_value of a deck " + deck.return_deck_as_icons)
+        logger.debug("getting deck_game_value of a deck %s", deck)
 
         total_aces = 0
 
@@ -336,10 +275,10 @@ class BlackJackGameBase(abc.ABC):
             card_values.append(self.get_card_value(card))
 
         if sum(card_values) <= 21:
-            logging.debug("deck_game_value is %d", sum(card_values))
+            logger.debug("deck_game_value is %d", sum(card_values))
             return sum(card_values)
         elif sum(card_values) > 21 and total_aces == 0:
-            logging.debug("deck_game_value is %d", sum(card_values))
+            logger.debug("deck_game_value is %d", sum(card_values))
             return sum(card_values)
         else:  # Reduce values of aces
 
@@ -353,7 +292,7 @@ class BlackJackGameBase(abc.ABC):
                 option = card_values_without_aces + 11 * n + 1 * (total_aces - n)
                 # If we are bust, no need for this option
                 if option > 21:
-                    logging.debug("[-] Skipping option %s", option)
+                    logger.debug("[-] Skipping option %s", option)
                     continue
 
                 options.append(option)
@@ -364,7 +303,7 @@ class BlackJackGameBase(abc.ABC):
 
             best_option = min(options, key=lambda x: 21 - x)
 
-            logging.debug("deck_game_value is %d", best_option)
+            logger.debug("deck_game_value is %d", best_option)
 
             return best_option
 
@@ -373,69 +312,18 @@ class BlackJackGameBase(abc.ABC):
         for player in players_in_round:
             player.cards.empty_all_cards()
 
-    def _player_has_blackjack(self, player):
-        return self._get_deck_game_value(player.cards) == 21
-
-    def _dealer_has_blackjack(self):
-        return self._get_deck_game_value(self._dealers_cards) == 21
-
-    async def _return_money_to_players_with_blackjack(self):
-        for player in self._players_in_round:
-            if self._player_has_blackjack(player):
-                player.get_money(self._players_bet[player])
-                await self.output_msg_to_game("%s is in a tie with the dealer." % player)
-                self._players_bet[player] = 0
-                self._players_in_round.remove(player)
-
-    async def _players_without_blackjack_lose_their_bet(self):
-        for player in self._players_in_round:
-            if not self._player_has_blackjack(player):
-                await self.output_msg_to_game("%s lost" % player)
-                self._players_bet[player] = 0
-
-    async def _handle_naturals_before_players_can_decide(self):
-        await self.output_msg_to_game(
-            "Dealer's hand: %s" % self._dealers_cards.return_deck_as_icons
-        )
-        if self._dealer_has_blackjack():
-            await self.output_msg_to_game(
-                "Dealer has Blackjack - %s" % self._dealers_cards.return_deck_as_icons
-            )
-            await self._return_money_to_players_with_blackjack()
-            return
-
-        # If dealer doesn't have blackjack
-        for player in self._players_in_round.copy():
-            if self._player_has_blackjack(player):
-                logging.info("%s has BJ and is getting payed", player.get_player_name)
-                await self._pay_player(player, ONE_AND_A_HALF_TIMES_THE_BET)
-                self._players_bet[player] = 0
-                self._players_in_round.remove(player)
-                await self.output_msg_to_game(
-                    "%s won 1.5 times his bet" % player.get_player_name
-                )
-
     async def _wait_for_players(self):
-        while len(self.players) == 0:
-            await asyncio.sleep(1)
-            continue
-        logging.info("First player has joined the room")
+        with self._trace_span("waiting for players"):
+            while len(self.players) == 0:
+                self._player_joined.clear()
+                await self._player_joined.wait()
+        logger.info("First player has joined the room")
         return
 
-    async def _pay_player(self, player, multiplier):
-        bet = self._players_bet[player]
-        amount_to_pay = bet * multiplier
-        logging.info("%s is getting payed %d$", player, amount_to_pay)
-        await player.msg_to_user("%s, you won %d$" % (player.get_player_name, amount_to_pay))
-        player.get_money(amount_to_pay)
-
-    async def _take_bets_from_players(self):
-        logging.info("Checking if room has players")
-        await self._wait_for_players()
-        logging.info("BlackJackGame is starting to take bets from players.")
-        for player in self.players:
-
-            logging.debug(
+    async def _take_bet_from_player(self, player):
+        # Players bet at the same time, so each of them gets a track of their own
+        with self._trace_span("bet", player, track="%s / %s" % (self.table_name, player.get_player_name)):
+            logger.debug(
                 "take_bets_from_players: trying to take a command from %s", player
             )
 
@@ -444,7 +332,7 @@ class BlackJackGameBase(abc.ABC):
                 "To bet, type 'B'. To skip this round, type 'Skip'", allowed_actions
             )
 
-            logging.debug(
+            logger.debug(
                 "take_bets_from_players: Got command %s from %s",
                 command,
                 player.get_player_name,
@@ -455,52 +343,35 @@ class BlackJackGameBase(abc.ABC):
 
             elif command == Actions.BET:
                 bet = await player.get_bet()
-                logging.info("%s is betting %d$", player.get_player_name, bet)
+                if bet is None:  # Player didn't place a bet in time
+                    return
+                logger.info("%s is betting %d$", player.get_player_name, bet)
                 self._players_bet[player] = player.give_money(bet)
 
-    async def _handle_winners_and_losers(self):
-
-        dealers_hand_total = self._get_deck_game_value(self._dealers_cards)
-
-        for player in self._players_in_round:
-
-            # The state of the game checks that player is not bust before paying him, so no need to recheck it
-            if self._get_deck_game_value(player.cards) > dealers_hand_total:
-                logging.info(
-                    "%s beat the dealer, he had %d in his pot",
-                    player,
-                    self._players_bet[player],
-                )
-                await player.msg_to_user(
-                    "%s, You beat the dealer! you get twice your bet"
-                    % player.get_player_name
-                )
-                await self.output_msg_to_game(
-                    "%s, has beat the dealer!" % player.get_player_name
-                )
-                await self._pay_player(player, TWICE_AS_THE_BET)
-
-            elif self._get_deck_game_value(player.cards) == dealers_hand_total:
-                logging.info(
-                    "%s and the dealer are in a tie, he had %d in his pot",
-                    player,
-                    self._players_bet[player],
-                )
-                await player.msg_to_user(
-                    "%s, You are tied with the dealer! you get 1.5 times your bet"
-                    % player.get_player_name
-                )
-                await self._pay_player(
-                    player, SAME_AS_THE_BET
-                )  # This is a tie, just give his money back
-
-            else:  # Player lost, take his money. NOTE: The game doesn't do anything with the money, just takes it from users and deletes it.
-                logging.info(
-                    "%s lost, he had %d in his pot", player, self._players_bet[player]
+    async def _take_bets_from_players(self):
+        logger.info("Checking if room has players")
+        await self._wait_for_players()
+        logger.info("BlackJackGame is starting to take bets from players.")
+
+        # All players bet at the same time. Players who didn't bet by the deadline sit the round out.
+        betting_players = list(self.players)
+        betting_tasks = [
+            asyncio.create_task(self._take_bet_from_player(player)) for player in betting_players
+        ]
+        done, pending = await asyncio.wait(betting_tasks, timeout=self._betting_deadline)
+
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        for player, task in zip(betting_players, betting_tasks):
+            if task in pending:
+                logger.info("%s didn't bet in time and sits this round out", player.get_player_name)
+                await player.msg_to_user("Betting is over, you sit this round out")
+            elif task.exception() is not None:
+                logger.error(
+                    "Failed taking a bet from %s", player.get_player_name, exc_info=task.exception()
                 )
-                await player.msg_to_user("%s, You lost" % player.get_player_name)
-                await self.output_msg_to_game("%s lost" % player.get_player_name)
-                self._players_bet[player] = 0
 
     def _return_lists_of_players_with_and_without_money(self):
         players_with_money = []
@@ -518,175 +389,243 @@ class BlackJackGameBase(abc.ABC):
         pass
 
     async def play_round(self):
+        round_span = self._trace_span("round")
+        table_token = current_table.set(self)
+        try:
+            await self._play_round()
+        finally:
+            current_table.reset(table_token)
+            self._phase = None
+            self._phase_span.end()
+            self._phase_span = tracing.NO_SPAN
+            round_span.end()
+
+    async def _play_round(self):
         # while there are players with money, open new rounds
         # kick players without money
         self._dealers_cards.empty_all_cards()
+        for player in self.players:
+            player.cards.empty_all_cards()
 
         self._players_bet = {}
+        self._round_players = []
+        self._players_in_round = []
+        self._paid_seats = set()
+        self._round = None
+        self._hole_card_revealed = False
 
-        self._game_deck.reset_deck_and_shuffle()
+        if self._game_deck.shuffle_if_cut_card_reached():
+            await self.output_msg_to_game("The cut card came out, shuffling the shoe")
 
+        await self._start_phase(RoundPhases.BETTING)
         await self._take_bets_from_players()
 
-        for player in self._players_bet:  # Only players who bet play the round
-            self._players_in_round.append(player)
-
-        if len(self._players_in_round) == 0:
+        # Only players who bet play the round, in their seats' order
+        round_players = [player for player in self.players if player in self._players_bet]
+        self._round_players = self._players_in_round = round_players
+        if len(round_players) == 0:
             await self.output_msg_to_game("No Players in this round")
             return
 
         # =======================================================
         # Deal cards
         # =======================================================
-        for _ in range(2):
-            for player in self._players_in_round:
-                player.take_card(self._game_deck.draw_card())
-            self._dealers_cards.take_card(self._game_deck.draw_card())
-
-        logging.info("play_round: cards were dealt to players")
-
-        cards_as_icons_dictionary = (
-            self.get_players_in_round_decks_as_icons_in_a_dictionary()
+        await self._start_phase(RoundPhases.DEAL)
+        round_state = self._round = RoundState(
+            [self._players_bet[player] for player in round_players],
+            [player.remaining_money for player in round_players],
+            [player.cards for player in round_players],
+            self._dealers_cards,
         )
+        round_state.deal(self._game_deck)
+        logger.info("play_round: cards were dealt to players")
 
-        await self.output_msg_to_game(
-            "Dealers Cards: %s, 🂠" % self._dealers_cards.cards[0].text_image
+        await self.output_table_to_game(
+            "Dealers Cards: %s, 🂠", self._dealers_cards.cards[0].text_image
         )
-
-        for player in self._players_in_round:
-            await self.output_msg_to_game(
-                "%s Cards: %s"
-                % (player.get_player_name, cards_as_icons_dictionary[player])
+        for player in round_players:
+            await self.output_table_to_game(
+                "%s Cards: %s", player.get_player_name, player.cards
             )
 
-        # =======================================================
-        # Check for blackjacks
-        # =======================================================
-        if any(self._player_has_blackjack(player) for player in self._players_in_round):
+        if round_state.hole_card_revealed:  # Someone has a blackjack
             await self._handle_naturals_before_players_can_decide()
             # Some players won, the round continues without them
-
-        for player in self._players_in_round.copy():
-            player_action = None
-            allowed_commands = [
-                Actions.HIT,
-                Actions.DOUBLE,
-                Actions.STAND,
-                Actions.SURRENDER,
-            ]
-            logging.debug("play_round: trying to get command from %s", player)
-            while (
-                    not player_action == Actions.STAND
-                    and not player_action == Actions.SURRENDER
-                    and not player_action == Actions.DOUBLE
-            ):  # player can hit until he's bust
+            self._players_in_round = [round_players[seat] for seat in round_state.seats_in_round]
+
+        await self._start_phase(RoundPhases.DECISIONS)
+        while round_state.phase == RoundPhases.DECISIONS:
+            seat = round_state.seat
+            player = round_players[seat]
+            decisions_span = self._trace_span("decisions", player)
+            logger.debug("play_round: trying to get command from %s", player)
+            while round_state.seat == seat:  # player can hit until he's bust
                 msg = (
                     f"{player.get_player_name} - To Hit type 'H'\nTo stand type 'S'\n"
                     "To Double down type 'D'\n"
                     "To Surrender and get half your money back, type 'Surrender'\n"
                 )
+                with self._trace_span("await decision", player):
+                    player_action = await player.get_cmd(msg, list(round_state.allowed_actions))
+                await self._play_decision(player_action)
+            decisions_span.end()
+            logger.debug("%s has stand or was removed if he was bust", player)
 
-                player_action = await player.get_cmd(msg, allowed_commands)
-
-                if player_action == Actions.HIT:
-                    try:
-                        allowed_commands.remove(
-                            Actions.DOUBLE
-                        )  # players can't double down after hitting
-                    except ValueError:
-                        pass  # already removed this option when player previously hit
-                    player.take_card(self._game_deck.draw_card())
-                    logging.info("%s said HIT", player)
-                    await self.output_msg_to_game(
-                        "%s's deck: %s"
-                        % (player.get_player_name, player.cards.return_deck_as_icons)
-                    )
-
-                if player_action == Actions.DOUBLE:
-                    logging.info("%s said DOUBLE DOWN", player)
-                    players_bet = self._players_bet[player]
-
-                    if (
-                            players_bet <= player.remaining_money
-                    ):  # check if can double down
-                        player.take_card(self._game_deck.draw_card())
-                        await self.output_msg_to_game(
-                            "%s's deck: %s"
-                            % (
-                                player.get_player_name,
-                                player.cards.return_deck_as_icons,
-                            )
-                        )
-                        self._players_bet[player] += player.give_money(players_bet)
-
-                    else:
-                        await player.msg_to_user(
-                            "%s - You don't have enough to double down"
-                            % player.get_player_name
-                        )
-                        logging.info(
-                            "%s tried to double down, but doesnt have enough money",
-                            player.get_player_name,
-                        )
-
-                if player_action == Actions.STAND:
-                    logging.info("%s said STAND", player)
-
-                if player_action == Actions.SURRENDER:
-                    logging.info(
-                        "%s said SURRENDER, giving him half the bet back", player
-                    )
-                    players_bet = self._players_bet[player]
-                    player.get_money(players_bet * 0.5)
-                    self._players_bet[player] = 0
-                    self._players_in_round.remove(player)
-                    await self.output_msg_to_game("%s said SURRENDER" % player)
-
-                if self._get_deck_game_value(player.cards) > 21:
-                    logging.info(
-                        "%s is bust after hitting too much "
-                        + player.cards.return_deck_as_icons,
-                        player,
-                    )
-                    await self.output_msg_to_game(
-                        "Player %s is bust: %s"
-                        % (player, player.cards.return_deck_as_icons)
-                    )
-                    self._players_bet[player.get_player_name] = 0
-                    self._players_in_round.remove(player)
-                    break
-
-            logging.debug("%s has stand or was removed if he was bust", player)
-
+        self._players_in_round = [round_players[seat] for seat in round_state.seats_in_round]
         if len(self._players_in_round) == 0:
-            logging.info("No players left, returning.")
+            logger.info("No players left, returning.")
             await self.output_msg_to_game("No more players, game over")
+            round_state.play_dealer(self._game_deck)
+            round_state.settle()
             return
 
         # =======================================================
         # Dealer takes cards until he has 17 or higher, then check who won
         # =======================================================
-        while self._get_deck_game_value(self._dealers_cards) < 17:
-            self._dealers_cards.take_card(self._game_deck.draw_card())
-            logging.info("Dealer took another card")
-            await self.output_msg_to_game(
-                "Dealer's deck: %s" % self._dealers_cards.return_deck_as_icons
-            )
+        await self._start_phase(RoundPhases.DEALER)
+        round_state.play_dealer(self._game_deck)
+        self._hole_card_revealed = True
+        await self.output_table_to_game("Dealer's deck: %s", self._dealers_cards)
+
+        await self._start_phase(RoundPhases.SETTLEMENT)
+        round_state.settle()
+        await self._announce_results()
+        await self._pay_seats()
+
+    async def _send(self, messages):
+        """Sends the (player, text) messages of the round helpers below, player None being the whole table"""
+        for player, text in messages:
+            if player is None:
+                await self.output_msg_to_game(text)
+            else:
+                await player.msg_to_user(text)
 
-        if self._get_deck_game_value(self._dealers_cards) > 21:
-            logging.debug("Dealer is bust, paying remaining players twice their bet")
-            await self.output_msg_to_game(
-                "Dealer is bust! \n%s - you get twice your bet"
-                % str(self._players_in_round).strip("[]")
-            )
+    async def _handle_naturals_before_players_can_decide(self):
+        self._hole_card_revealed = True
+        await self.output_table_to_game("Dealer's hand: %s", self._dealers_cards)
+        await self._send(announce_naturals(self._round, self._round_players, self._paid_seats))
+
+    async def _play_decision(self, action):
+        seat = self._round.seat
+        player = self._round_players[seat]
+        num_of_cards = len(player.cards)
+        messages = play_decision(self._round, self._round_players, self._paid_seats, action, self._game_deck)
+        self._players_bet[player] = self._round.bets[seat]
+        if len(player.cards) != num_of_cards:
+            await self.output_table_to_game("%s's deck: %s", player.get_player_name, player.cards)
+        await self._send(messages)
+
+    async def _announce_results(self):
+        await self._send(announce_results(self._round, self._round_players))
+
+    async def _pay_seats(self):
+        await self._send(pay_seats(self._round, self._round_players, self._paid_seats))
 
-            for player in self._players_in_round:
-                await self._pay_player(player, TWICE_AS_THE_BET)
-            return
+    async def _pay_player(self, player, multiplier):
+        """Pays player multiplier times his bet, bet included"""
+        amount_to_pay = self._players_bet[player] * multiplier
+        logger.info("%s is getting payed %d$", player, amount_to_pay)
+        await player.msg_to_user("%s, you won %d$" % (player.get_player_name, amount_to_pay))
+        player.get_money(amount_to_pay)
 
-        else:
-            return await self._handle_winners_and_losers()
+    async def _handle_winners_and_losers(self):
+        """Settles the players left in the round against the dealer's hand as it is, and pays them"""
+        players = self._players_in_round
+        round_state = RoundState(
+            [self._players_bet[player] for player in players],
+            hands=[player.cards for player in players],
+            dealers_hand=self._dealers_cards,
+        )
+        round_state.phase = RoundPhases.SETTLEMENT  # The cards are already dealt and the dealer played
+        round_state.settle()
+        await self._send(announce_results(round_state, players))
+        await self._send(pay_seats(round_state, players, set()))
+        for seat, player in enumerate(players):
+            if round_state.outcomes[seat] == Outcomes.LOSE:
+                self._players_bet[player] = 0
 
-        # =======================================================
-        # Round over
-        # =======================================================
+
+# =======================================================
+# Announcing and paying rounds
+# =======================================================
+# Every game plays its rounds through an engine.RoundState, with round_players the player of each of its seats and
+# paid_seats the seats already paid. The helpers below return the messages to send as (player, text) pairs, player
+# None being the whole table, and each game sends them its own way.
+
+def announce_naturals(round_state, round_players, paid_seats):
+    """The blackjacks of the deal. Pays the seats they ended."""
+    messages = []
+    if round_state.dealers_hand.value == 21:
+        messages.append((None, "Dealer has Blackjack - %s" % round_state.dealers_hand.return_deck_as_icons))
+    for seat, player in enumerate(round_players):
+        if round_state.outcomes[seat] == Outcomes.TIE:
+            messages.append((None, "%s is in a tie with the dealer." % player))
+        elif round_state.outcomes[seat] == Outcomes.NATURAL:
+            logger.info("%s has BJ and is getting payed", player.get_player_name)
+            messages.append((None, "%s won 1.5 times his bet" % player.get_player_name))
+    return messages + pay_seats(round_state, round_players, paid_seats)
+
+
+def play_decision(round_state, round_players, paid_seats, action, shoe):
+    """Plays the decision of the seat deciding, and takes the extra bet of a double down from its player. Pays the
+    seat if it surrendered."""
+    seat = round_state.seat
+    player = round_players[seat]
+    bet = round_state.bets[seat]
+    round_state.decide(action, shoe)
+    logger.info("%s said %s", player, action.name)
+
+    messages = []
+    if round_state.bets[seat] != bet:  # Doubled down
+        player.give_money(bet)
+    elif action == Actions.DOUBLE:
+        logger.info("%s tried to double down, but doesnt have enough money", player.get_player_name)
+        messages.append((player, "%s - You don't have enough to double down" % player.get_player_name))
+
+    if round_state.outcomes[seat] == Outcomes.SURRENDER:
+        messages.append((None, "%s said SURRENDER" % player))
+        messages.extend(pay_seats(round_state, round_players, paid_seats))
+    elif round_state.outcomes[seat] == Outcomes.BUST:
+        logger.info("%s is bust after hitting too much %s", player, round_state.hands[seat])
+        messages.append((None, "Player %s is bust: %s" % (player, round_state.hands[seat].return_deck_as_icons)))
+    return messages
+
+
+def announce_results(round_state, round_players):
+    """Who won, tied or lost against the dealer, once the round is settled"""
+    if round_state.dealer_bust:
+        logger.debug("Dealer is bust, paying remaining players twice their bet")
+        winners = ", ".join(round_players[seat].get_player_name for seat in round_state.seats_in_round)
+        return [(None, "Dealer is bust! \n%s - you get twice your bet" % winners)]
+
+    messages = []
+    for seat in round_state.seats_in_round:
+        player = round_players[seat]
+        if round_state.outcomes[seat] == Outcomes.WIN:
+            logger.info("%s beat the dealer, he had %d in his pot", player, round_state.bets[seat])
+            messages.append((player, "%s, You beat the dealer! you get twice your bet" % player.get_player_name))
+            messages.append((None, "%s, has beat the dealer!" % player.get_player_name))
+        elif round_state.outcomes[seat] == Outcomes.TIE:
+            logger.info("%s and the dealer are in a tie, he had %d in his pot", player, round_state.bets[seat])
+            messages.append(
+                (player, "%s, You are tied with the dealer! you get your bet back" % player.get_player_name)
+            )
+        else:
+            logger.info("%s lost, he had %d in his pot", player, round_state.bets[seat])
+            messages.append((player, "%s, You lost" % player.get_player_name))
+            messages.append((None, "%s lost" % player.get_player_name))
+    return messages
+
+
+def pay_seats(round_state, round_players, paid_seats):
+    """Pays the seats of the round that have a payout and weren't paid yet, and adds them to paid_seats"""
+    messages = []
+    for seat, payout in enumerate(round_state.payouts):
+        if payout and seat not in paid_seats:
+            paid_seats.add(seat)
+            player = round_players[seat]
+            logger.info("%s is getting payed %d$", player, payout)
+            if round_state.outcomes[seat] in (Outcomes.NATURAL, Outcomes.WIN):
+                messages.append((player, "%s, you won %d$" % (player.get_player_name, payout)))
+            player.get_money(payout)
+    return messages
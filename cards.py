@@ -0,0 +1,399 @@
+"""Cards, decks, hands and shoes, and the actions and phases of a round.
+
+The games (blackjack_base, server) and the round rules (engine) all build on them, so they have no dependencies of
+their own.
+"""
+from enum import Enum
+import logging
+import random
+
+logger = logging.getLogger(__name__)
+
+class NoMoreCardsInDeckError(Exception):
+    pass
+
+
+class CardAlreadyInDeckError(Exception):
+    pass
+
+SAME_AS_THE_BET = 1
+ONE_AND_A_HALF_TIMES_THE_BET = 1.5
+TWICE_AS_THE_BET = 2
+ACE_VALUE = 11
+
+MIN_NUM_OF_DECKS_IN_SHOE = 1
+MAX_NUM_OF_DECKS_IN_SHOE = 8
+DEFAULT_NUM_OF_DECKS_IN_SHOE = 6
+DEFAULT_SHOE_PENETRATION = 0.75  # Share of the shoe dealt before the cut card comes out
+
+
+class Suites(Enum):
+    HEARTS = 1
+    DIAMONDS = 2
+    SPADES = 3
+    CLUBS = 4
+
+
+class Actions(Enum):
+    HIT = 1
+    STAND = 2
+    BET = 3
+    SKIP = 4
+    DOUBLE = 5
+    SURRENDER = 6
+
+
+
+class RoundPhases(Enum):
+    BETTING = 1
+    DEAL = 2
+    DECISIONS = 3
+    DEALER = 4
+    SETTLEMENT = 5
+
+
+SUITES_TO_ICON = {
+    Suites.HEARTS: "♥",
+    Suites.CLUBS: "♣",
+    Suites.DIAMONDS: "♦",
+    Suites.SPADES: "♠",
+}
+
+ALL_CARD_RANKS = list(range(2, 11)) + list("JQKA")
+
+NUM_OF_CARDS_IN_DECK = len(ALL_CARD_RANKS) * len(Suites)
+
+# Cards are encoded as ints 0-51 in the same order fill_deck_with_52_cards lays them out:
+# code = rank index * 4 + suit index.
+_SUITES_BY_INDEX = tuple(Suites)
+_SUIT_INDEX = {suit: index for index, suit in enumerate(_SUITES_BY_INDEX)}
+_RANK_INDEX = {rank: index for index, rank in enumerate(ALL_CARD_RANKS)}
+
+
+def _normalize_rank(rank):
+    if type(rank) is str and rank.isdigit():
+        rank = int(rank)
+    if rank not in _RANK_INDEX:
+        raise ValueError("%r is not a valid card rank" % (rank,))
+    return rank
+
+
+class Card(object):
+    """A playing card.
+
+    There are exactly 52 Card instances: Card(suit, rank) always returns the interned instance for that card,
+    so cards are never allocated during a game and equality / hashing are reduced to an int compare.
+    """
+
+    __slots__ = ("_suit", "_rank", "_code")
+
+    _interned = {}
+
+    def __new__(cls, suit, rank):
+        try:
+            return cls._interned[(suit, rank)]
+        except KeyError:
+            pass
+        except TypeError:  # unhashable rank
+            raise ValueError("%r is not a valid card rank" % (rank,))
+
+        normalized_rank = _normalize_rank(rank)
+        card = cls._interned.get((suit, normalized_rank))
+
+        if card is None:
+            card = object.__new__(cls)
+            card._suit = suit
+            card._rank = normalized_rank
+            card._code = _RANK_INDEX[normalized_rank] * len(Suites) + _SUIT_INDEX[suit]
+            cls._interned[(suit, normalized_rank)] = card
+
+        cls._interned[(suit, rank)] = card
+        return card
+
+    @property
+    def suit(self):
+        return self._suit
+
+    @property
+    def rank(self):
+        return self._rank
+
+    @property
+    def code(self):
+        return self._code
+
+    @property
+    def text_image(self):
+        return "[%s of %s ]" % (self.rank, SUITES_TO_ICON[self.suit])
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, Card):
+            return NotImplemented
+        return self._code == other._code
+
+    def __str__(self):
+        return "<Card %s of %s>" % (self.rank, self.suit.name)
+
+    def __repr__(self):
+        return str(self)
+
+    def __hash__(self):
+        return self._code
+
+    def __reduce__(self):
+        return card_from_code, (self._code,)
+
+
+CARDS = tuple(
+    Card(suit, card_rank) for card_rank in ALL_CARD_RANKS for suit in Suites
+)  # CARDS[card.code] is card
+
+
+def card_from_code(code):
+    return CARDS[code]
+
+
+# Game value of each card code, counting aces as 1. Hand adds the extra 10 for a soft ace.
+HARD_CARD_VALUES = tuple(
+    1 if card.rank == "A" else (card.rank if type(card.rank) is int else 10) for card in CARDS
+)
+
+
+class Deck(object):
+    """An ordered pile of cards, stored as a bytearray of card codes. The top of the deck is the end of the array.
+
+    Hands dealt from a multi-deck Shoe can hold the same card twice, so they are created with allow_duplicates=True.
+    """
+
+    def __init__(self, allow_duplicates=False):
+        self._deck = bytearray()
+        self._allow_duplicates = allow_duplicates
+        self._cards_in_deck = 0  # bitmask of card codes, for O(1) duplicate checks
+
+    def __eq__(self, other):  # implemented only for sorted decks
+        return self._deck == other._deck
+
+    def __len__(self):
+        return len(self._deck)
+
+    def __str__(self):
+        return self.return_deck_as_icons
+
+    def shuffle(self):
+        random.shuffle(self._deck)
+
+    @property
+    def cards(self):
+        return [CARDS[code] for code in self._deck]
+
+    @property
+    def codes(self):
+        return bytes(self._deck)
+
+    @property
+    def return_deck_as_icons(self):
+        return ", ".join(CARDS[code].text_image for code in self._deck)
+
+    def draw_card(self):
+        try:
+            code = self._deck.pop()
+        except IndexError:
+            raise NoMoreCardsInDeckError()
+        self._cards_in_deck &= ~(1 << code)
+        return CARDS[code]
+
+    def take_card(self, card, top_of_deck=True):
+        if not self._allow_duplicates:
+            card_bit = 1 << card.code
+            if self._cards_in_deck & card_bit:
+                raise CardAlreadyInDeckError("Card %s already in deck" % card)
+            self._cards_in_deck |= card_bit
+
+        if top_of_deck:
+            self._deck.append(card.code)
+        else:
+            self._deck.insert(0, card.code)
+
+    def empty_all_cards(self):
+        del self._deck[:]
+        self._cards_in_deck = 0
+
+    def fill_deck_with_52_cards(self):
+        self._deck = bytearray(range(NUM_OF_CARDS_IN_DECK))
+        self._cards_in_deck = (1 << NUM_OF_CARDS_IN_DECK) - 1
+
+    def reset_deck_and_shuffle(self):
+        self.fill_deck_with_52_cards()
+        self.shuffle()
+
+
+class Hand(Deck):
+    """The cards a player or the dealer holds.
+
+    Keeps a running hard total and ace count while cards are taken, so the hand's value, soft / bust / blackjack
+    status are O(1) reads. The values are the same as BlackJackGameBase._get_deck_game_value of the same cards.
+    """
+
+    def __init__(self):
+        super().__init__(allow_duplicates=True)
+        self._hard_total = 0
+        self._num_of_aces = 0
+
+    def take_card(self, card, top_of_deck=True):
+        super().take_card(card, top_of_deck)
+        self._hard_total += HARD_CARD_VALUES[card.code]
+        self._num_of_aces += card.rank == "A"
+
+    def draw_card(self):
+        card = super().draw_card()
+        self._hard_total -= HARD_CARD_VALUES[card.code]
+        self._num_of_aces -= card.rank == "A"
+        return card
+
+    def empty_all_cards(self):
+        super().empty_all_cards()
+        self._hard_total = 0
+        self._num_of_aces = 0
+
+    @property
+    def value(self):
+        hard_total = self._hard_total
+        if hard_total > 21:
+            return hard_total + (ACE_VALUE - 1) * self._num_of_aces  # bust, every ace is reported as 11
+        if self._num_of_aces and hard_total + ACE_VALUE - 1 <= 21:
+            return hard_total + ACE_VALUE - 1
+        return hard_total
+
+    @property
+    def hard_total(self):
+        return self._hard_total
+
+    @property
+    def is_soft(self):
+        return self._num_of_aces > 0 and self._hard_total + ACE_VALUE - 1 <= 21
+
+    @property
+    def is_bust(self):
+        return self._hard_total > 21
+
+    @property
+    def is_blackjack(self):
+        return len(self._deck) == 2 and self.value == 21
+
+
+class Shoe(object):
+    """The dealing shoe: num_of_decks decks shuffled together, with a cut card placed at `penetration`.
+
+    The cards are shuffled once into a buffer of card codes and drawing only advances an index. The shoe is
+    reshuffled between rounds, once the cut card came out (see shuffle_if_cut_card_reached).
+
+    Without a seed, the shoe draws a random 64 bit one, so its shuffles can be replayed from the seed and the number
+    of shuffles (see hand_history).
+    """
+
+    def __init__(
+            self,
+            num_of_decks=DEFAULT_NUM_OF_DECKS_IN_SHOE,
+            penetration=DEFAULT_SHOE_PENETRATION,
+            seed=None,
+    ):
+        if not MIN_NUM_OF_DECKS_IN_SHOE <= num_of_decks <= MAX_NUM_OF_DECKS_IN_SHOE:
+            raise ValueError(
+                "A shoe holds %d to %d decks, got %r"
+                % (MIN_NUM_OF_DECKS_IN_SHOE, MAX_NUM_OF_DECKS_IN_SHOE, num_of_decks)
+            )
+        if not 0 < penetration <= 1:
+            raise ValueError("Penetration must be in (0, 1], got %r" % (penetration,))
+
+        self._num_of_decks = num_of_decks
+        self._penetration = penetration
+        self._cards = bytearray(range(NUM_OF_CARDS_IN_DECK)) * num_of_decks
+        self._cut_card_position = max(1, int(len(self._cards) * penetration))
+        self._seed = seed if seed is not None else random.getrandbits(64)
+        self._random = random.Random(self._seed)
+        self._num_of_shuffles = 0
+        self._position = 0
+        self.shuffle()
+
+    def __len__(self):  # cards left in the shoe
+        return len(self._cards) - self._position
+
+    @property
+    def num_of_decks(self):
+        return self._num_of_decks
+
+    @property
+    def penetration(self):
+        return self._penetration
+
+    @property
+    def seed(self):
+        return self._seed
+
+    @property
+    def num_of_shuffles(self):
+        return self._num_of_shuffles
+
+    @property
+    def position(self):
+        return self._position
+
+    @property
+    def cut_card_reached(self):
+        return self._position >= self._cut_card_position
+
+    def shuffle(self):
+        self._random.shuffle(self._cards)
+        self._num_of_shuffles += 1
+        self._position = 0
+        logger.debug("Shoe of %d decks shuffled", self._num_of_decks)
+
+    def shuffle_if_cut_card_reached(self):
+        if self.cut_card_reached:
+            self.shuffle()
+            return True
+        return False
+
+    def draw_code(self):
+        if self._position == len(self._cards):
+            # Only reachable with a penetration close to 1. Reshuffle rather than stopping the round.
+            logger.info("Shoe ran out of cards in the middle of a round, reshuffling")
+            self.shuffle()
+        code = self._cards[self._position]
+        self._position += 1
+        return code
+
+    def draw_card(self):
+        return CARDS[self.draw_code()]
+
+    def to_dict(self):
+        """The shoe as plain data: its cards and position, and the seed and number of shuffles its next shuffles
+        follow from"""
+        return {
+            "num_of_decks": self._num_of_decks,
+            "penetration": self._penetration,
+            "cut_card_position": self._cut_card_position,
+            "seed": self._seed,
+            "num_of_shuffles": self._num_of_shuffles,
+            "position": self._position,
+            "cards": self._cards.hex(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """The shoe of to_dict, without shuffling it. Its next shuffles are the ones the original shoe would make."""
+        shoe = cls.__new__(cls)
+        shoe._num_of_decks = data["num_of_decks"]
+        shoe._penetration = data["penetration"]
+        shoe._cards = bytearray.fromhex(data["cards"])
+        shoe._cut_card_position = data["cut_card_position"]
+        shoe._seed = data["seed"]
+        shoe._random = random.Random(shoe._seed)
+        scratch_cards = bytearray(len(shoe._cards))
+        for _ in range(data["num_of_shuffles"]):  # The shuffles already made, which only depend on the shoe's size
+            shoe._random.shuffle(scratch_cards)
+        shoe._num_of_shuffles = data["num_of_shuffles"]
+        shoe._position = data["position"]
+        return shoe
@@ -1,23 +1,27 @@
+import aiohttp
 import socketio
 import logging
 import asyncio
+import log_setup
+import protocol
 
 
-LOG_FORMAT = "%(asctime)s | %(levelname)s | %(name)s | %(module)s | %(lineno)d | %(process)d | %(message)s"
-logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
 
 SERVER_ADDRESS = 'http://127.0.0.1:8000'
 BJ_NAMESPACE = "/blackjack"
 sio = socketio.AsyncClient(logger=True)
 
+table = protocol.TableStateReplica()
+
 
 @sio.event(namespace=BJ_NAMESPACE)
 async def connect():
-    logging.info('Connected to server')
+    logger.info('Connected to server')
 
 
 async def send_user_details():
-    logging.info("Requesting name")
+    logger.info("Requesting name")
     money = None
     name = input("Welcome to my BlackJack game. What's your name?\n")
     while len(name) == 0:
@@ -39,18 +43,41 @@ def handle_msg(data):
     print(data)
 
 
-@sio.on("send_input", namespace=BJ_NAMESPACE)
-async def send_input(msg):
-    logging.debug("Requesting user input")
-    res = input(msg)
-    await sio.emit(event='get input from user', data=res, namespace=BJ_NAMESPACE)
+@sio.on(protocol.STATE_EVENT, namespace=BJ_NAMESPACE)
+async def handle_table_state(message):
+    if not table.receive(message):
+        logger.debug("Missed table state %s, asking for a snapshot", message["base"])
+        await sio.emit(protocol.STATE_REQUEST_EVENT, namespace=BJ_NAMESPACE)
+        return
+
+    await sio.emit(protocol.STATE_ACK_EVENT, data=message["seq"], namespace=BJ_NAMESPACE)
+    print(protocol.render_table(table.state))
+
+
+@sio.on(protocol.PROMPT_EVENT, namespace=BJ_NAMESPACE)
+async def send_input(prompt):
+    logger.debug("Requesting user input")
+    res = input(prompt["text"])
+    await sio.emit(event=protocol.ANSWER_EVENT, data=protocol.answer_message(prompt, res), namespace=BJ_NAMESPACE)
+
+
+async def find_server_address():
+    # With several server workers, the one we should play on may not be the one we know
+    async with aiohttp.ClientSession() as session:
+        async with session.get(SERVER_ADDRESS + "/assign") as response:
+            return (await response.json())["address"]
 
 
 async def main():
-    logging.info("Attempting connection")
-    await sio.connect(SERVER_ADDRESS, namespaces=BJ_NAMESPACE)
+    server_address = await find_server_address()
+    logger.info("Attempting connection to %s", server_address)
+    await sio.connect(server_address, namespaces=BJ_NAMESPACE)
     await send_user_details()
     await sio.wait()
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    log_listener = log_setup.setup_logging(logging.DEBUG)
+    try:
+        asyncio.run(main())
+    finally:
+        log_listener.stop()
@@ -0,0 +1,341 @@
+"""Runs the server as several worker processes on one box.
+
+Every room is owned by the worker it was opened on, and the players of a room are all connected to its owner:
+- RoomRegistry maps rooms to their owner and their number of players. It is shared by the workers through a JSON
+  file, locked with fcntl, and also hands out the room numbers so they are unique across workers. The numbers of
+  closed rooms are handed out again.
+- Clients ask any worker where to play with GET /assign, which answers with the address of the worker owning the most
+  populated room that isn't full (or of the least busy worker, which opens a new room), then connect to that worker
+  and stay on it.
+- Socket.IO broadcasts go through BrokerClientManager, a pub/sub client manager over Broker, a small TCP fan-out
+  server that stands in for Redis. Messages to a player or to a room are sent directly by the worker they are
+  connected to.
+
+The registry and the broker are only addressed by a path and a host:port, so the same workers can be spread over
+several boxes with a shared file system and a broker any of them can reach.
+
+Usage: python cluster.py --workers 4 --port 8000
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import fcntl
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+
+from socketio.asyncio_pubsub_manager import AsyncPubSubManager
+
+import log_setup
+
+logger = logging.getLogger(__name__)
+
+WORKER_ID_VARIABLE = "BJ_WORKER_ID"
+WORKER_ADDRESS_VARIABLE = "BJ_WORKER_ADDRESS"
+REGISTRY_PATH_VARIABLE = "BJ_REGISTRY_PATH"
+BROKER_ADDRESS_VARIABLE = "BJ_BROKER_ADDRESS"
+
+DEFAULT_BROKER_PORT = 7999
+BROKER_RECONNECT_DELAY = 1  # seconds
+OCCUPANCY_REPORT_INTERVAL = 0.5  # seconds
+
+
+class RoomRegistry(object):
+    """Rooms, their owner worker and their number of players, in a JSON file shared by the workers.
+
+    Every call locks the file for its whole read-modify-write, so concurrent calls from several processes are
+    serialized. Calls block on the lock and the file, so a serving worker makes the ones it makes while serving
+    (claiming rooms, occupancy changes and assignments) through a BackgroundRoomRegistry.
+    """
+
+    def __init__(self, path):
+        self._path = path
+
+    @contextlib.contextmanager
+    def _locked(self, write=True):
+        with open(self._path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+            try:
+                try:
+                    with open(self._path) as registry_file:
+                        registry = json.load(registry_file)
+                except FileNotFoundError:
+                    registry = {"workers": {}, "rooms": {}}
+
+                yield registry
+
+                if write:
+                    temp_path = "%s.%d.tmp" % (self._path, os.getpid())
+                    with open(temp_path, "w") as registry_file:
+                        json.dump(registry, registry_file)
+                    os.replace(temp_path, self._path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def register_worker(self, worker_id, address):
+        with self._locked() as registry:
+            registry["workers"][worker_id] = address
+
+    def unregister_worker(self, worker_id):
+        with self._locked() as registry:
+            registry["workers"].pop(worker_id, None)
+            registry["rooms"] = {
+                room: details for room, details in registry["rooms"].items() if details["worker"] != worker_id
+            }
+
+    def claim_room(self, worker_id):
+        """The lowest room number that isn't taken, for a new room owned by worker_id"""
+        with self._locked() as registry:
+            room_number = next(number for number in itertools.count() if str(number) not in registry["rooms"])
+            registry["rooms"][str(room_number)] = {"worker": worker_id, "players": 0}
+        return room_number
+
+    def release_room(self, room_number):
+        with self._locked() as registry:
+            registry["rooms"].pop(str(room_number), None)
+
+    def update_occupancy(self, room_number, num_of_players):
+        self.update_occupancies({room_number: num_of_players})
+
+    def update_occupancies(self, num_of_players_by_room):
+        with self._locked() as registry:
+            for room_number, num_of_players in num_of_players_by_room.items():
+                if str(room_number) in registry["rooms"]:
+                    registry["rooms"][str(room_number)]["players"] = num_of_players
+
+    def owner_address(self, room_number):
+        with self._locked(write=False) as registry:
+            room = registry["rooms"].get(str(room_number))
+            return registry["workers"].get(room["worker"]) if room is not None else None
+
+    def assign(self, max_number_of_players_in_room):
+        """Address of the worker a new player should connect to, None if there are no workers"""
+        with self._locked(write=False) as registry:
+            workers = registry["workers"]
+            rooms = [details for details in registry["rooms"].values() if details["worker"] in workers]
+
+            vacant_rooms = [details for details in rooms if details["players"] < max_number_of_players_in_room]
+            if vacant_rooms:
+                return workers[max(vacant_rooms, key=lambda details: details["players"])["worker"]]
+
+            if not workers:
+                return None
+            players_by_worker = {worker_id: 0 for worker_id in workers}
+            for details in rooms:
+                players_by_worker[details["worker"]] += details["players"]
+            return workers[min(players_by_worker, key=players_by_worker.get)]
+
+
+class BackgroundRoomRegistry(object):
+    """Makes the calls of a serving worker to a RoomRegistry on a thread of its own, so the event loop never waits on
+    the registry's lock and file.
+
+    Calls run one at a time, in the order they were made. Occupancy changes are coalesced: a room's latest number of
+    players is reported at most every report_interval seconds, along with the other rooms' changes, in a single call.
+    Concurrent assignments share the same call.
+    """
+
+    def __init__(self, registry, report_interval=OCCUPANCY_REPORT_INTERVAL):
+        self.registry = registry
+        self._report_interval = report_interval
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="room-registry")
+        self._pending_occupancy = {}  # room number -> its latest number of players
+        self._report_timer = None
+        self._assignment = None  # Future of the assignment in progress
+
+    def _run(self, call, *args):
+        future = asyncio.get_running_loop().run_in_executor(self._executor, call, *args)
+        future.add_done_callback(_log_registry_failure)
+        return future
+
+    def update_occupancy(self, room_number, num_of_players):
+        self._pending_occupancy[room_number] = num_of_players
+        if self._report_timer is None:
+            self._report_timer = asyncio.get_running_loop().call_later(self._report_interval, self._report_occupancy)
+
+    def _report_occupancy(self):
+        self._report_timer = None
+        pending_occupancy, self._pending_occupancy = self._pending_occupancy, {}
+        self._run(self.registry.update_occupancies, pending_occupancy)
+
+    async def claim_room(self, worker_id):
+        return await self._run(self.registry.claim_room, worker_id)
+
+    def release_room(self, room_number):
+        self._pending_occupancy.pop(room_number, None)
+        self._run(self.registry.release_room, room_number)
+
+    async def assign(self, max_number_of_players_in_room):
+        if self._assignment is None:
+            self._assignment = self._run(self.registry.assign, max_number_of_players_in_room)
+            self._assignment.add_done_callback(self._assignment_done)
+        return await asyncio.shield(self._assignment)
+
+    def _assignment_done(self, _):
+        self._assignment = None
+
+    def close(self):
+        """Reports the pending occupancy changes and waits for the calls in progress"""
+        if self._report_timer is not None:
+            self._report_timer.cancel()
+            self._report_timer = None
+        if self._pending_occupancy:
+            self._executor.submit(self.registry.update_occupancies, self._pending_occupancy)
+            self._pending_occupancy = {}
+        self._executor.shutdown(wait=True)
+
+
+def _log_registry_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("A room registry call failed", exc_info=future.exception())
+
+
+class Broker(object):
+    """Sends every line a connection writes to all the connections, the writer included, like a pub/sub channel"""
+
+    def __init__(self):
+        self._writers = set()
+
+    async def _handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while line := await reader.readline():
+                for subscriber in self._writers:
+                    subscriber.write(line)
+        except ConnectionError:
+            logger.info("Broker connection lost")
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info("Broker listening on %s", ", ".join(str(sock.getsockname()) for sock in server.sockets))
+        return server
+
+
+class BrokerClientManager(AsyncPubSubManager):
+    """Socket.IO client manager that shares broadcasts between the workers through a Broker.
+
+    Rooms are owned by a single worker, so a room or a player with participants on this worker has all of them here,
+    and its messages are sent locally without a round trip through the broker.
+    """
+
+    name = "broker"
+
+    def __init__(self, address, channel="socketio", write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        host, port = address.rsplit(":", 1)
+        self._host, self._port = host, int(port)
+        self._connection = None
+        self._connection_lock = asyncio.Lock()
+
+    async def emit(self, event, data, namespace=None, room=None, skip_sid=None, callback=None, **kwargs):
+        if room is not None and room in self.rooms.get(namespace or "/", {}):
+            kwargs["ignore_queue"] = True
+        return await super().emit(
+            event, data, namespace=namespace, room=room, skip_sid=skip_sid, callback=callback, **kwargs
+        )
+
+    async def _connect(self):
+        async with self._connection_lock:
+            while self._connection is None:
+                try:
+                    self._connection = await asyncio.open_connection(self._host, self._port)
+                except OSError:
+                    logger.exception("Can't connect to the broker at %s:%d", self._host, self._port)
+                    await asyncio.sleep(BROKER_RECONNECT_DELAY)
+            return self._connection
+
+    async def _publish(self, data):
+        _, writer = await self._connect()
+        writer.write(json.dumps({"channel": self.channel, "data": data}).encode() + b"\n")
+        await writer.drain()
+
+    async def _listen(self):
+        reader, _ = await self._connect()
+        while True:
+            line = await reader.readline()
+            if not line:
+                self._connection = None
+                raise ConnectionError("The broker closed the connection")
+            message = json.loads(line)
+            if message["channel"] == self.channel:
+                yield message["data"]
+
+
+def registry_from_environment():
+    path = os.environ.get(REGISTRY_PATH_VARIABLE)
+    return RoomRegistry(path) if path else None
+
+
+def client_manager_from_environment():
+    address = os.environ.get(BROKER_ADDRESS_VARIABLE)
+    return BrokerClientManager(address) if address else None
+
+
+def worker_id_from_environment():
+    return os.environ.get(WORKER_ID_VARIABLE, "0")
+
+
+def worker_address_from_environment(default):
+    return os.environ.get(WORKER_ADDRESS_VARIABLE, default)
+
+
+async def run_cluster(num_of_workers, host, port, broker_port, registry_path):
+    broker_server = await Broker().serve(host, broker_port)
+    workers = []
+    for worker_index in range(num_of_workers):
+        worker_port = port + worker_index
+        environment = dict(
+            os.environ,
+            **{
+                WORKER_ID_VARIABLE: str(worker_index),
+                WORKER_ADDRESS_VARIABLE: "http://%s:%d" % (host, worker_port),
+                REGISTRY_PATH_VARIABLE: registry_path,
+                BROKER_ADDRESS_VARIABLE: "%s:%d" % (host, broker_port),
+            }
+        )
+        workers.append(subprocess.Popen(
+            [sys.executable, "server.py", "--host", host, "--port", str(worker_port)],
+            env=environment,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ))
+        logger.info("Started worker %d on port %d", worker_index, worker_port)
+
+    try:
+        while all(worker.poll() is None for worker in workers):
+            await asyncio.sleep(1)
+        logger.error("A worker exited, stopping the cluster")
+    finally:
+        for worker in workers:
+            worker.terminate()
+        broker_server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the blackjack server as several worker processes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8000, help="Port of the first worker, the others follow it")
+    parser.add_argument("--broker-port", type=int, default=DEFAULT_BROKER_PORT)
+    parser.add_argument("--registry", default=os.path.join(tempfile.gettempdir(), "blackjack-rooms.json"))
+    args = parser.parse_args()
+
+    log_listener = log_setup.setup_logging()
+    for stale_file in (args.registry, args.registry + ".lock"):
+        if os.path.exists(stale_file):
+            os.remove(stale_file)
+    try:
+        asyncio.run(run_cluster(args.workers, args.host, args.port, args.broker_port, args.registry))
+    finally:
+        log_listener.stop()
+
+
+if __name__ == "__main__":
+    main()
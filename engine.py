@@ -0,0 +1,331 @@
+"""Headless blackjack round engine.
+
+Plays full rounds with the rules of RoundState, without coroutines, messages or logging.
+Players' decisions come from a strategy callback, which makes the engine suitable for bots and simulations:
+
+    strategy(hand, dealer_upcard, allowed_actions) -> Actions
+
+`hand` is the seat's Hand, `dealer_upcard` the dealer's face up Card and `allowed_actions` a tuple of Actions.
+
+The rules themselves are in RoundState, which the engine drives with the strategy, and the online rooms and
+blackjack_base.BlackJackGameBase with their players' answers.
+"""
+from collections import namedtuple
+from enum import Enum
+
+from cards import (
+    Actions,
+    Hand,
+    RoundPhases,
+    Shoe,
+    card_from_code,
+    DEFAULT_NUM_OF_DECKS_IN_SHOE,
+    DEFAULT_SHOE_PENETRATION,
+    SAME_AS_THE_BET,
+    ONE_AND_A_HALF_TIMES_THE_BET,
+    TWICE_AS_THE_BET,
+)
+
+SURRENDER_MULTIPLIER = 0.5
+ENGINE_TABLE_NAME = "engine"
+
+FIRST_DECISION_ACTIONS = (Actions.HIT, Actions.DOUBLE, Actions.STAND, Actions.SURRENDER)
+DECISION_ACTIONS_AFTER_HIT = (Actions.HIT, Actions.STAND, Actions.SURRENDER)  # No double down after hitting
+_ACTIONS_ENDING_DECISIONS = (Actions.STAND, Actions.DOUBLE, Actions.SURRENDER)
+
+
+TableRules = namedtuple("TableRules", ["num_of_decks", "penetration"])
+
+TABLE_RULES = {
+    "default": TableRules(DEFAULT_NUM_OF_DECKS_IN_SHOE, DEFAULT_SHOE_PENETRATION),
+    "single-deck": TableRules(1, 0.65),
+    "double-deck": TableRules(2, 0.7),
+    "eight-deck": TableRules(8, 0.8),
+}
+
+
+class Outcomes(Enum):
+    NATURAL = 1  # Blackjack on the deal, paid ONE_AND_A_HALF_TIMES_THE_BET
+    WIN = 2
+    TIE = 3
+    LOSE = 4
+    BUST = 5
+    SURRENDER = 6
+
+
+# bet is the final bet (doubled after a double down), payout the money returned to the player at the end of the
+# round, bet included. The player's net result for the round is payout - bet.
+SeatResult = namedtuple("SeatResult", ["bet", "payout", "outcome", "value", "num_of_cards"])
+RoundResult = namedtuple("RoundResult", ["seats", "dealer_upcard", "dealer_value", "dealer_drew", "dealer_bust"])
+
+
+class InvalidStrategyActionError(Exception):
+    pass
+
+
+class InvalidRoundEventError(Exception):
+    pass
+
+
+class RoundState(object):
+    """One round as an explicit state machine. It is the only implementation of the rules of a round.
+
+    The round only moves forward when it is given an event: deal() in the DEAL phase, one decide() per decision of
+    the seat at the cursor in the DECISIONS phase, play_dealer() in the DEALER phase and settle() in the SETTLEMENT
+    phase. Cards are drawn from the shoe passed to each event, so the state itself is small and holds no coroutine,
+    and to_dict / from_dict turn it into plain data and back, e.g. to snapshot a room waiting for a player.
+
+    bankrolls, if given, is the money each seat has left after placing its bet, to check if it can double down.
+    """
+
+    def __init__(self, bets, bankrolls=None, hands=None, dealers_hand=None):
+        num_of_seats = len(bets)
+        self.phase = RoundPhases.DEAL
+        self.bets = list(bets)
+        self.bankrolls = list(bankrolls) if bankrolls is not None else None
+        self.payouts = [0] * num_of_seats
+        self.outcomes = [None] * num_of_seats
+        self.actions = [bytearray() for _ in range(num_of_seats)]  # The Actions values each seat decided, in order
+        self.hands = hands if hands is not None else [Hand() for _ in range(num_of_seats)]
+        self.dealers_hand = dealers_hand if dealers_hand is not None else Hand()
+        self.seats_in_round = list(range(num_of_seats))
+        self.deciding_seats = ()  # The seats left in the round after the naturals, in the order they decide
+        self.cursor = 0  # Index in deciding_seats of the seat deciding
+        self.allowed_actions = FIRST_DECISION_ACTIONS
+        self.hole_card_revealed = False
+        self.dealer_drew = False
+        self.settled = False
+        # Where the round's first card was in the shoe, set by whoever deals the round, for the hand history
+        self.shoe_shuffles = None
+        self.shoe_position = None
+
+    @property
+    def seat(self):
+        """The seat deciding, None outside of the DECISIONS phase"""
+        if self.phase != RoundPhases.DECISIONS:
+            return None
+        return self.deciding_seats[self.cursor]
+
+    @property
+    def dealer_upcard(self):
+        return self.dealers_hand.cards[0] if len(self.dealers_hand) else None
+
+    @property
+    def dealer_bust(self):
+        return self.dealer_drew and self.dealers_hand.is_bust
+
+    def _expect_phase(self, phase):
+        if self.phase != phase or self.settled:
+            raise InvalidRoundEventError(
+                "Expected the round to be in %s, it is in %s" % (phase, "the end" if self.settled else self.phase)
+            )
+
+    def deal(self, shoe):
+        self._expect_phase(RoundPhases.DEAL)
+        hands = self.hands
+        dealers_hand = self.dealers_hand
+        for hand in hands:
+            hand.take_card(shoe.draw_card())
+        dealers_hand.take_card(shoe.draw_card())
+        for hand in hands:
+            hand.take_card(shoe.draw_card())
+        dealers_hand.take_card(shoe.draw_card())
+
+        # Check for blackjacks
+        if any(hands[seat].value == 21 for seat in self.seats_in_round):
+            self.hole_card_revealed = True
+            if dealers_hand.value == 21:
+                naturals_outcome, naturals_multiplier = Outcomes.TIE, SAME_AS_THE_BET
+            else:
+                naturals_outcome, naturals_multiplier = Outcomes.NATURAL, ONE_AND_A_HALF_TIMES_THE_BET
+
+            for seat in range(len(hands)):
+                if hands[seat].value == 21:
+                    self.payouts[seat] = self.bets[seat] * naturals_multiplier
+                    self.outcomes[seat] = naturals_outcome
+                    self.seats_in_round.remove(seat)
+
+        self.deciding_seats = tuple(self.seats_in_round)
+        self.cursor = 0
+        self.allowed_actions = FIRST_DECISION_ACTIONS
+        self.phase = RoundPhases.DECISIONS if self.deciding_seats else RoundPhases.DEALER
+
+    def decide(self, action, shoe):
+        """Plays the decision of the seat at the cursor, and moves the cursor to the next seat once its decisions
+        are over"""
+        if self.phase != RoundPhases.DECISIONS:
+            self._expect_phase(RoundPhases.DECISIONS)
+        if action not in self.allowed_actions:
+            raise InvalidStrategyActionError(
+                "Strategy returned %s, allowed actions are %s" % (action, self.allowed_actions)
+            )
+
+        seat = self.deciding_seats[self.cursor]
+        hand = self.hands[seat]
+        self.actions[seat].append(action.value)
+        if action is Actions.HIT:
+            self.allowed_actions = DECISION_ACTIONS_AFTER_HIT
+            hand.take_card(shoe.draw_card())
+            if not hand.is_bust:
+                return
+
+        elif action is Actions.DOUBLE:
+            bankrolls = self.bankrolls
+            bet = self.bets[seat]
+            if bankrolls is None or bet <= bankrolls[seat]:
+                hand.take_card(shoe.draw_card())
+                if bankrolls is not None:
+                    bankrolls[seat] -= bet
+                self.bets[seat] = bet * 2
+
+        elif action is Actions.SURRENDER:
+            self.payouts[seat] = self.bets[seat] * SURRENDER_MULTIPLIER
+            self.outcomes[seat] = Outcomes.SURRENDER
+            self.seats_in_round.remove(seat)
+
+        if hand.is_bust:
+            self.outcomes[seat] = Outcomes.BUST
+            self.seats_in_round.remove(seat)
+
+        # The seat's decisions are over
+        self.cursor += 1
+        self.allowed_actions = FIRST_DECISION_ACTIONS
+        if self.cursor == len(self.deciding_seats):
+            self.phase = RoundPhases.DEALER
+
+    def play_dealer(self, shoe):
+        """The dealer takes cards until he has 17 or higher, if any seat is left in the round"""
+        self._expect_phase(RoundPhases.DEALER)
+        self.dealer_drew = len(self.seats_in_round) > 0
+        if self.dealer_drew:
+            self.hole_card_revealed = True
+            dealers_hand = self.dealers_hand
+            while dealers_hand.value < 17:
+                dealers_hand.take_card(shoe.draw_card())
+        self.phase = RoundPhases.SETTLEMENT
+
+    def settle(self):
+        self._expect_phase(RoundPhases.SETTLEMENT)
+        dealers_hand = self.dealers_hand
+        dealers_hand_total = dealers_hand.value
+        for seat in self.seats_in_round:
+            players_hand_total = self.hands[seat].value
+            if dealers_hand.is_bust or players_hand_total > dealers_hand_total:
+                self.payouts[seat] = self.bets[seat] * TWICE_AS_THE_BET
+                self.outcomes[seat] = Outcomes.WIN
+            elif players_hand_total == dealers_hand_total:
+                self.payouts[seat] = self.bets[seat] * SAME_AS_THE_BET
+                self.outcomes[seat] = Outcomes.TIE
+            else:
+                self.outcomes[seat] = Outcomes.LOSE
+        self.settled = True
+
+    def result(self):
+        hands = self.hands
+        return RoundResult(
+            seats=tuple(
+                SeatResult(bet, payout, outcome, hand.value, len(hand))
+                for bet, payout, outcome, hand in zip(self.bets, self.payouts, self.outcomes, hands)
+            ),
+            dealer_upcard=self.dealer_upcard,
+            dealer_value=self.dealers_hand.value,
+            dealer_drew=self.dealer_drew,
+            dealer_bust=self.dealer_bust,
+        )
+
+    def to_dict(self):
+        return {
+            "phase": self.phase.name,
+            "bets": list(self.bets),
+            "bankrolls": list(self.bankrolls) if self.bankrolls is not None else None,
+            "payouts": list(self.payouts),
+            "outcomes": [outcome.name if outcome is not None else None for outcome in self.outcomes],
+            "actions": [list(actions) for actions in self.actions],
+            "hands": [list(hand.codes) for hand in self.hands],
+            "dealer": list(self.dealers_hand.codes),
+            "seats_in_round": list(self.seats_in_round),
+            "deciding_seats": list(self.deciding_seats),
+            "cursor": self.cursor,
+            "allowed_actions": [action.name for action in self.allowed_actions],
+            "hole_card_revealed": self.hole_card_revealed,
+            "dealer_drew": self.dealer_drew,
+            "settled": self.settled,
+            "shoe_shuffles": self.shoe_shuffles,
+            "shoe_position": self.shoe_position,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        round_state = cls(data["bets"], data["bankrolls"])
+        round_state.phase = RoundPhases[data["phase"]]
+        round_state.payouts = list(data["payouts"])
+        round_state.outcomes = [Outcomes[outcome] if outcome is not None else None for outcome in data["outcomes"]]
+        round_state.actions = [bytearray(actions) for actions in data["actions"]]
+        for hand, codes in zip(round_state.hands, data["hands"]):
+            for code in codes:
+                hand.take_card(card_from_code(code))
+        for code in data["dealer"]:
+            round_state.dealers_hand.take_card(card_from_code(code))
+        round_state.seats_in_round = list(data["seats_in_round"])
+        round_state.deciding_seats = tuple(data["deciding_seats"])
+        round_state.cursor = data["cursor"]
+        round_state.allowed_actions = tuple(Actions[action] for action in data["allowed_actions"])
+        round_state.hole_card_revealed = data["hole_card_revealed"]
+        round_state.dealer_drew = data["dealer_drew"]
+        round_state.settled = data["settled"]
+        round_state.shoe_shuffles = data["shoe_shuffles"]
+        round_state.shoe_position = data["shoe_position"]
+        return round_state
+
+
+class BlackJackEngine(object):
+    """Plays rounds on a shoe. Given a hand_history.HandHistoryWriter, the engine records every round to it."""
+
+    def __init__(self, shoe=None, history=None, table_name=ENGINE_TABLE_NAME):
+        self._shoe = shoe if shoe is not None else Shoe()
+        self._history = history
+        self._table_name = table_name
+        self._hands = []
+        self._dealers_hand = Hand()
+
+    @property
+    def shoe(self):
+        return self._shoe
+
+    def _hands_for_seats(self, num_of_seats):
+        while len(self._hands) < num_of_seats:
+            self._hands.append(Hand())
+        hands = self._hands[:num_of_seats]
+        for hand in hands:
+            hand.empty_all_cards()
+        return hands
+
+    def play_round(self, bets, strategy, bankrolls=None):
+        """Plays one round with a seat for each bet and returns its RoundResult.
+
+        bankrolls, if given, is the money each seat has left after placing its bet. It is only used to check if a
+        seat can afford to double down, like BlackJackGameBase does.
+        """
+        shoe = self._shoe
+        shoe.shuffle_if_cut_card_reached()
+
+        self._dealers_hand.empty_all_cards()
+        round_state = RoundState(bets, bankrolls, self._hands_for_seats(len(bets)), self._dealers_hand)
+        history = self._history
+        if history is not None:
+            round_state.shoe_shuffles, round_state.shoe_position = shoe.num_of_shuffles, shoe.position
+        round_state.deal(shoe)
+
+        hands = round_state.hands
+        dealer_upcard = round_state.dealer_upcard
+        deciding_seats = round_state.deciding_seats
+        decide = round_state.decide
+        while round_state.phase is RoundPhases.DECISIONS:
+            hand = hands[deciding_seats[round_state.cursor]]
+            decide(strategy(hand, dealer_upcard, round_state.allowed_actions), shoe)
+
+        round_state.play_dealer(shoe)
+        round_state.settle()
+        if history is not None:
+            history.record(self._table_name, round_state, shoe)
+        return round_state.result()
@@ -0,0 +1,406 @@
+"""Append-only binary history of the completed rounds, for audits and offline analysis.
+
+Every round is one fixed-width record (RECORD, or RECORD_DTYPE for NumPy): its room, when it ended, the shoe's seed
+and where the round's first card was in it, and for every seat the bet, the payout, the outcome, the card codes and
+the actions decided, in order. Records are appended to segment files in a directory, numbered per writer:
+hands-<writer id>-000000.bin, hands-<writer id>-000001.bin and so on. The writer id defaults to the writer's process
+id, so the workers of a server can share a directory. Every segment starts with a small header naming the format, and
+a new writer always starts a new segment, so segments are never rewritten.
+
+HandHistoryWriter packs records into a batch on the caller's thread, and a writer thread appends the full batches to
+the segments, so the event loop never waits on the disk. HandHistoryReader memory maps the segments: iterating it
+unpacks the records straight from the mapped files, and arrays() returns them as NumPy structured arrays backed by
+the files, without copying them:
+
+    with HandHistoryReader("/var/lib/blackjack/hands") as reader:
+        for records in reader.arrays():
+            print(records["payouts"].sum() - records["bets"].sum())
+
+Hands with more than MAX_CARDS_IN_HAND cards keep their first cards only, their record still has their real number of
+cards. Tables have MAX_SEATS seats at most.
+
+Usage: python server.py --hand-history /var/lib/blackjack/hands
+"""
+import logging
+import mmap
+import os
+import queue
+import re
+import struct
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from cards import Actions, Shoe
+from engine import Outcomes
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"BJHH"
+FORMAT_VERSION = 1
+MAX_SEATS = 7
+MAX_CARDS_IN_HAND = 12  # Also the most actions a seat can record
+ROOM_NAME_SIZE = 16
+DEFAULT_SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_BATCH_SIZE = 1024  # records
+DEFAULT_FLUSH_INTERVAL = 1  # seconds
+
+# Record flags
+DEALER_DREW = 1
+NO_SEED = 2  # The shoe's seed isn't a 64 bit unsigned integer, so the record can't replay the shoe
+
+SEGMENT_HEADER = struct.Struct("<4sHH")  # MAGIC, FORMAT_VERSION, RECORD.size
+RECORD = struct.Struct(
+    "<dQ{seats}d{seats}d{room}sIHBBBB{cards}s{seats}s{seats}s{seat_cards}s{seat_cards}s4x".format(
+        seats=MAX_SEATS, room=ROOM_NAME_SIZE, cards=MAX_CARDS_IN_HAND, seat_cards=MAX_SEATS * MAX_CARDS_IN_HAND
+    )
+)
+RECORD_DTYPE = np.dtype([
+    ("timestamp", "<f8"),
+    ("shoe_seed", "<u8"),
+    ("bets", "<f8", (MAX_SEATS,)),
+    ("payouts", "<f8", (MAX_SEATS,)),
+    ("room", "S%d" % ROOM_NAME_SIZE),
+    ("shoe_shuffles", "<u4"),
+    ("shoe_position", "<u2"),
+    ("num_of_decks", "u1"),
+    ("num_of_seats", "u1"),
+    ("dealer_num_of_cards", "u1"),
+    ("flags", "u1"),
+    ("dealer_cards", "u1", (MAX_CARDS_IN_HAND,)),
+    ("outcomes", "u1", (MAX_SEATS,)),  # Outcomes values
+    ("num_of_cards", "u1", (MAX_SEATS,)),
+    ("cards", "u1", (MAX_SEATS, MAX_CARDS_IN_HAND)),
+    ("actions", "u1", (MAX_SEATS, MAX_CARDS_IN_HAND)),  # Actions values, 0 after the seat's last action
+    ("reserved", "V4"),
+])
+
+_SEGMENT_NAME = re.compile(r"hands-(\w+)-(\d+)\.bin$")
+_WRITER_ID = re.compile(r"\w+")
+_EMPTY_SEATS = (0,) * MAX_SEATS
+_CARDS_OFFSET = RECORD_DTYPE.fields["cards"][1]
+_ACTIONS_OFFSET = RECORD_DTYPE.fields["actions"][1]
+_OUTCOME_VALUES = {None: 0, **{outcome: outcome.value for outcome in Outcomes}}
+_OUTCOMES = {value: outcome for outcome, value in _OUTCOME_VALUES.items()}
+_ACTIONS = {action.value: action for action in Actions}
+
+# shoe_seed is None if the record's shoe can't be replayed. Cards are card codes.
+HandRecord = namedtuple(
+    "HandRecord",
+    ["timestamp", "room", "shoe_seed", "num_of_decks", "shoe_shuffles", "shoe_position", "dealer_cards",
+     "dealer_drew", "seats"],
+)
+SeatRecord = namedtuple("SeatRecord", ["bet", "payout", "outcome", "num_of_cards", "cards", "actions"])
+
+
+def segment_path(directory, writer_id, index):
+    return os.path.join(directory, "hands-%s-%06d.bin" % (writer_id, index))
+
+
+def segments(directory):
+    """The (writer id, index) of the segments in directory, each writer's in order"""
+    matches = (_SEGMENT_NAME.match(name) for name in os.listdir(directory))
+    return sorted((match.group(1), int(match.group(2))) for match in matches if match is not None)
+
+
+def segment_indexes(directory, writer_id):
+    """The indexes of writer_id's segments in directory, in order"""
+    return [index for segment_writer_id, index in segments(directory) if segment_writer_id == writer_id]
+
+
+def pack_round(buffer, offset, timestamp, table_name, round_state, shoe):
+    """Packs a settled RoundState into buffer, a bytearray, at offset, as a RECORD"""
+    num_of_seats = len(round_state.bets)
+    if num_of_seats > MAX_SEATS:
+        raise ValueError("A hand history record holds %d seats at most, got %d" % (MAX_SEATS, num_of_seats))
+    empty_seats = _EMPTY_SEATS[num_of_seats:]
+
+    flags = DEALER_DREW if round_state.dealer_drew else 0
+    seed = shoe.seed
+    if type(seed) is not int or not 0 <= seed < 1 << 64:
+        seed = 0
+        flags |= NO_SEED
+
+    hands = round_state.hands
+    RECORD.pack_into(
+        buffer,
+        offset,
+        timestamp,
+        seed,
+        *round_state.bets, *empty_seats,
+        *round_state.payouts, *empty_seats,
+        table_name.encode(),
+        round_state.shoe_shuffles or 0,
+        round_state.shoe_position or 0,
+        shoe.num_of_decks,
+        num_of_seats,
+        len(round_state.dealers_hand),
+        flags,
+        round_state.dealers_hand.codes,
+        bytes([_OUTCOME_VALUES[outcome] for outcome in round_state.outcomes]),
+        bytes(map(len, hands)),
+        b"",  # The cards and the actions are zero filled, then copied in place
+        b"",
+    )
+    cards_offset = offset + _CARDS_OFFSET
+    actions_offset = offset + _ACTIONS_OFFSET
+    for hand, actions in zip(hands, round_state.actions):
+        codes = hand.codes[:MAX_CARDS_IN_HAND]
+        buffer[cards_offset:cards_offset + len(codes)] = codes
+        actions = actions[:MAX_CARDS_IN_HAND]
+        buffer[actions_offset:actions_offset + len(actions)] = actions
+        cards_offset += MAX_CARDS_IN_HAND
+        actions_offset += MAX_CARDS_IN_HAND
+
+
+def unpack_round(buffer, offset):
+    """The HandRecord packed in buffer at offset"""
+    fields = RECORD.unpack_from(buffer, offset)
+    timestamp, seed = fields[:2]
+    bets = fields[2:2 + MAX_SEATS]
+    payouts = fields[2 + MAX_SEATS:2 + 2 * MAX_SEATS]
+    (
+        room, shuffles, position, num_of_decks, num_of_seats, dealer_num_of_cards, flags, dealer_cards, outcomes,
+        num_of_cards, cards, actions,
+    ) = fields[2 + 2 * MAX_SEATS:]
+
+    seats = []
+    for seat in range(num_of_seats):
+        hand_start = seat * MAX_CARDS_IN_HAND
+        seats.append(SeatRecord(
+            bet=bets[seat],
+            payout=payouts[seat],
+            outcome=_OUTCOMES[outcomes[seat]],
+            num_of_cards=num_of_cards[seat],
+            cards=cards[hand_start:hand_start + min(num_of_cards[seat], MAX_CARDS_IN_HAND)],
+            actions=tuple(_ACTIONS[action] for action in actions[hand_start:hand_start + MAX_CARDS_IN_HAND] if action),
+        ))
+    return HandRecord(
+        timestamp=timestamp,
+        room=room.rstrip(b"\0").decode(),
+        shoe_seed=None if flags & NO_SEED else seed,
+        num_of_decks=num_of_decks,
+        shoe_shuffles=shuffles,
+        shoe_position=position,
+        dealer_cards=dealer_cards[:dealer_num_of_cards],
+        dealer_drew=bool(flags & DEALER_DREW),
+        seats=tuple(seats),
+    )
+
+
+def replay_shoe(record):
+    """A new Shoe holding the cards of the record's shoe, about to deal the record's first card"""
+    shoe = Shoe(num_of_decks=record.num_of_decks, seed=record.shoe_seed)
+    for _ in range(record.shoe_shuffles - 1):
+        shoe.shuffle()
+    for _ in range(record.shoe_position):
+        shoe.draw_code()
+    return shoe
+
+
+class HandHistoryWriter(object):
+    """Appends records to a new segment of directory, and to the next ones once a segment is full.
+
+    Writers sharing a directory must have ids of their own, made of letters, digits and underscores: their process id
+    by default, which is unique among the running processes.
+
+    record() packs the round into the current batch, and hands the batch to a writer thread once it is full. The
+    writer thread appends the batches to the segment, and takes the records of the current batch itself when no batch
+    came in for flush_interval seconds, so they are written on quiet servers too. close() writes what is left and
+    waits for the thread.
+    """
+
+    def __init__(
+            self,
+            directory,
+            segment_max_bytes=DEFAULT_SEGMENT_MAX_BYTES,
+            batch_size=DEFAULT_BATCH_SIZE,
+            flush_interval=DEFAULT_FLUSH_INTERVAL,
+            writer_id=None,
+    ):
+        writer_id = str(os.getpid()) if writer_id is None else writer_id
+        if not _WRITER_ID.fullmatch(writer_id):
+            raise ValueError("A hand history writer id is made of letters, digits and underscores, got %r" % writer_id)
+        os.makedirs(directory, exist_ok=True)
+        self.writer_id = writer_id
+        self._directory = directory
+        self._segment_max_records = max(1, (segment_max_bytes - SEGMENT_HEADER.size) // RECORD.size)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._batch_lock = threading.Lock()  # Guards the current batch, which the writer thread takes when idle
+        self._batch = bytearray(batch_size * RECORD.size)
+        self._batch_length = 0  # records
+        self._segment = None
+        self._segment_index = max(segment_indexes(directory, writer_id), default=-1)
+        self._segment_length = 0  # records
+        self._batches = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write_batches, name="hand-history", daemon=True)
+        self._thread.start()
+
+    def record(self, table_name, round_state, shoe):
+        """Records a settled round of table_name, dealt from shoe"""
+        with self._batch_lock:
+            pack_round(self._batch, self._batch_length * RECORD.size, time.time(), table_name, round_state, shoe)
+            self._batch_length += 1
+            if self._batch_length == self._batch_size:
+                self._batches.put(self._take_batch())
+
+    def flush(self):
+        """Hands the records packed so far to the writer thread"""
+        with self._batch_lock:
+            if self._batch_length:
+                self._batches.put(self._take_batch())
+
+    def _take_batch(self):
+        """The records of the current batch, which starts over. Called with the batch lock held."""
+        if self._batch_length == self._batch_size:
+            batch = self._batch
+            self._batch = bytearray(self._batch_size * RECORD.size)
+        else:
+            batch = self._batch[:self._batch_length * RECORD.size]
+        self._batch_length = 0
+        return batch
+
+    def close(self):
+        self.flush()
+        self._batches.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        """The next batch handed to the writer thread, or the records of the current batch if none came in
+        flush_interval seconds. None once the writer is closed."""
+        try:
+            return self._batches.get(timeout=self._flush_interval)
+        except queue.Empty:
+            with self._batch_lock:
+                return self._take_batch()
+
+    def _write_batches(self):
+        try:
+            while (batch := self._next_batch()) is not None:
+                if not batch:
+                    continue
+                try:
+                    self._write(memoryview(batch))
+                except OSError:
+                    logger.exception("Failed writing %d hand history records", len(batch) // RECORD.size)
+        finally:
+            if self._segment is not None:
+                self._segment.close()
+
+    def _write(self, batch):
+        while batch:
+            if self._segment is None or self._segment_length == self._segment_max_records:
+                self._open_next_segment()
+            num_of_records = min(len(batch) // RECORD.size, self._segment_max_records - self._segment_length)
+            self._segment.write(batch[:num_of_records * RECORD.size])
+            self._segment_length += num_of_records
+            batch = batch[num_of_records * RECORD.size:]
+        self._segment.flush()
+
+    def _open_next_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+        self._segment_index += 1
+        self._segment = open(segment_path(self._directory, self.writer_id, self._segment_index), "xb")
+        self._segment.write(SEGMENT_HEADER.pack(MAGIC, FORMAT_VERSION, RECORD.size))
+        self._segment_length = 0
+        logger.info("Writing the hand history to segment %d of writer %s", self._segment_index, self.writer_id)
+
+
+class HandHistoryReader(object):
+    """The records of the segments of directory, as they were when the reader was opened. Each writer's records are
+in the order they were written, and the writers' segments follow each other in the order of their ids.
+
+    Segments are memory mapped, so the records are only read from the disk as they are used. The arrays returned by
+    arrays() are backed by the mappings: close the reader once they are no longer used.
+    """
+
+    def __init__(self, directory):
+        self._segments = []  # (mmap of the segment, its number of records)
+        try:
+            for writer_id, index in segments(directory):
+                self._map_segment(segment_path(directory, writer_id, index))
+        except Exception:
+            self.close()
+            raise
+
+    def _map_segment(self, path):
+        with open(path, "rb") as segment_file:
+            size = os.fstat(segment_file.fileno()).st_size
+            if size < SEGMENT_HEADER.size:  # The writer just created it
+                return
+            segment = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._segments.append((segment, (size - SEGMENT_HEADER.size) // RECORD.size))
+        if SEGMENT_HEADER.unpack_from(segment) != (MAGIC, FORMAT_VERSION, RECORD.size):
+            raise ValueError("%s isn't a hand history segment of version %d" % (path, FORMAT_VERSION))
+
+    def __len__(self):
+        return sum(num_of_records for _, num_of_records in self._segments)
+
+    def __iter__(self):
+        for segment, num_of_records in self._segments:
+            for offset in range(SEGMENT_HEADER.size, SEGMENT_HEADER.size + num_of_records * RECORD.size, RECORD.size):
+                yield unpack_round(segment, offset)
+
+    def arrays(self):
+        """A NumPy array of RECORD_DTYPE viewing each segment's records"""
+        return [
+            np.frombuffer(segment, dtype=RECORD_DTYPE, count=num_of_records, offset=SEGMENT_HEADER.size)
+            for segment, num_of_records in self._segments
+        ]
+
+    def close(self):
+        for segment, _ in self._segments:
+            segment.close()
+        self._segments = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+_writer = None
+
+
+def enable(directory, segment_max_bytes=DEFAULT_SEGMENT_MAX_BYTES):
+    global _writer
+    disable()
+    _writer = HandHistoryWriter(directory, segment_max_bytes)
+    return _writer
+
+
+def disable():
+    global _writer
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+
+
+def is_enabled():
+    return _writer is not None
+
+
+def record(table_name, round_state, shoe):
+    """Records a settled round to the hand history, if it is enabled"""
+    if _writer is not None:
+        _writer.record(table_name, round_state, shoe)
+
+
+def add_arguments(parser):
+    parser.add_argument("--hand-history", help="Append a binary record of every round to segments in this directory")
+    parser.add_argument(
+        "--hand-history-segment-bytes",
+        type=int,
+        default=DEFAULT_SEGMENT_MAX_BYTES,
+        help="Size of a hand history segment",
+    )
+
+
+def enable_from_arguments(args):
+    if args.hand_history:
+        enable(args.hand_history, args.hand_history_segment_bytes)
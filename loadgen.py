@@ -0,0 +1,316 @@
+"""Load generator: many headless bot clients playing on the server.
+
+Bots speak the same /blackjack namespace events as client.py. They join with get_new_player_data, answer the
+prompts (see protocol.PROMPT_EVENT) and follow the table through the structured table state. Betting
+prompts are answered with a fixed bet, playing prompts with a strategy from strategies.py, after a think time drawn
+from a configurable distribution.
+
+The bots are spread over a few processes, each running its share of them in one event loop. At the end the
+processes' stats are merged into a report of connect latencies, prompt round trips, rounds per second and errors. A
+round trip is measured from an answer that the server follows up with another prompt to the same bot (a bet, or a hit
+that didn't bust) to that prompt, so it doesn't include think times or other players' turns.
+
+Usage: python loadgen.py --bots 1000 --processes 4 --duration 60 --think-time 0.5
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import random
+import time
+
+import aiohttp
+import socketio
+
+import log_setup
+import protocol
+from cards import CARDS, Actions, Hand
+from engine import FIRST_DECISION_ACTIONS, DECISION_ACTIONS_AFTER_HIT
+from strategies import STRATEGIES
+
+logger = logging.getLogger(__name__)
+
+BJ_NAMESPACE = "/blackjack"
+BET = 10
+
+ACTION_INPUTS = {
+    Actions.HIT: "h",
+    Actions.STAND: "s",
+    Actions.DOUBLE: "d",
+    Actions.SURRENDER: "surrender",
+}
+
+THINK_TIME_DISTRIBUTIONS = {
+    "fixed": lambda rng, mean: mean,
+    "uniform": lambda rng, mean: rng.uniform(0, 2 * mean),
+    "exponential": lambda rng, mean: rng.expovariate(1 / mean) if mean > 0 else 0,
+}
+
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return None
+    return sorted_samples[min(len(sorted_samples) - 1, int(fraction * len(sorted_samples)))]
+
+
+class LoadStats(object):
+    def __init__(self):
+        self.bots = 0
+        self.connected = 0
+        self.rounds = 0  # Rounds the bots bet on
+        self.prompts = 0
+        self.errors = {}  # error kind -> count
+        self.connect_latencies = []
+        self.round_trips = []
+
+    def add_error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def merge(self, other):
+        for attribute in ("bots", "connected", "rounds", "prompts"):
+            setattr(self, attribute, getattr(self, attribute) + getattr(other, attribute))
+        for kind, count in other.errors.items():
+            self.errors[kind] = self.errors.get(kind, 0) + count
+        self.connect_latencies.extend(other.connect_latencies)
+        self.round_trips.extend(other.round_trips)
+        return self
+
+    @staticmethod
+    def _latency_summary(samples):
+        samples = sorted(samples)
+        return {
+            "count": len(samples),
+            "p50": percentile(samples, 0.5),
+            "p90": percentile(samples, 0.9),
+            "p99": percentile(samples, 0.99),
+            "max": samples[-1] if samples else None,
+        }
+
+    def as_dict(self, elapsed_seconds):
+        return {
+            "bots": self.bots,
+            "connected": self.connected,
+            "rounds": self.rounds,
+            "rounds_per_second": self.rounds / elapsed_seconds,
+            "prompts": self.prompts,
+            "errors": dict(self.errors),
+            "connect_latency": self._latency_summary(self.connect_latencies),
+            "round_trip": self._latency_summary(self.round_trips),
+        }
+
+
+class Bot(object):
+    def __init__(self, name, server_address, strategy, think_time, think_distribution, money, stats, rng):
+        self._name = name
+        self._server_address = server_address
+        self._strategy = strategy
+        self._think_time = think_time
+        self._think_distribution = THINK_TIME_DISTRIBUTIONS[think_distribution]
+        self._money = money
+        self._stats = stats
+        self._rng = rng
+        self._table = protocol.TableStateReplica()
+        self._answered_at = None  # when the last answer expecting another prompt was sent
+
+        self._sio = socketio.AsyncClient(reconnection=False)
+        self._sio.on("message", self._on_message, namespace=BJ_NAMESPACE)
+        self._sio.on(protocol.PROMPT_EVENT, self._on_prompt, namespace=BJ_NAMESPACE)
+        self._sio.on(protocol.STATE_EVENT, self._on_table_state, namespace=BJ_NAMESPACE)
+        self._sio.on("disconnect", self._on_disconnect, namespace=BJ_NAMESPACE)
+        self._playing = False
+
+    async def _on_message(self, data):
+        pass
+
+    async def _on_disconnect(self):
+        if self._playing:
+            self._stats.add_error("disconnected")
+
+    async def _on_table_state(self, message):
+        if not self._table.receive(message):
+            await self._sio.emit(protocol.STATE_REQUEST_EVENT, namespace=BJ_NAMESPACE)
+            return
+        await self._sio.emit(protocol.STATE_ACK_EVENT, data=message["seq"], namespace=BJ_NAMESPACE)
+
+        if self._answered_at is not None and self._my_hand().is_bust:
+            self._answered_at = None  # The hit busted, no prompt will follow
+
+    def _my_seat(self):
+        state = self._table.state
+        if state is None:
+            return None
+        return state["seats"].get(self._sio.get_sid(namespace=BJ_NAMESPACE))
+
+    def _my_hand(self):
+        hand = Hand()
+        seat = self._my_seat()
+        for code in seat["cards"] if seat is not None else ():
+            hand.take_card(CARDS[code])
+        return hand
+
+    def _decide(self):
+        state = self._table.state
+        if self._my_seat() is None or not state["dealer"] or state["dealer"][0] is None:
+            return Actions.STAND  # Didn't get the table yet
+
+        hand = self._my_hand()
+        allowed_actions = FIRST_DECISION_ACTIONS if len(hand) == 2 else DECISION_ACTIONS_AFTER_HIT
+        return self._strategy(hand, CARDS[state["dealer"][0]], allowed_actions)
+
+    def _answer(self, kind):
+        if kind == protocol.PromptKinds.BET_OR_SKIP:
+            seat = self._my_seat()
+            if seat is not None and seat["money"] < BET:
+                return "skip"
+            self._stats.rounds += 1
+            return "b"
+        if kind == protocol.PromptKinds.BET_AMOUNT:
+            return str(BET)
+        return ACTION_INPUTS[self._decide()]
+
+    async def _on_prompt(self, prompt):
+        if self._answered_at is not None:
+            self._stats.round_trips.append(time.perf_counter() - self._answered_at)
+            self._answered_at = None
+        self._stats.prompts += 1
+        try:
+            answer = self._answer(protocol.prompt_kind(prompt))
+        except Exception:
+            logger.exception("%s failed answering %r", self._name, prompt)
+            self._stats.add_error("bad prompt")
+            answer = "s"
+
+        await asyncio.sleep(self._think_distribution(self._rng, self._think_time))
+        if answer in ("b", ACTION_INPUTS[Actions.HIT]):
+            self._answered_at = time.perf_counter()
+        await self._sio.emit(
+            protocol.ANSWER_EVENT, data=protocol.answer_message(prompt, answer), namespace=BJ_NAMESPACE
+        )
+
+    async def play(self, duration):
+        start = time.perf_counter()
+        try:
+            await self._sio.connect(self._server_address, namespaces=BJ_NAMESPACE, transports=["websocket"])
+        except Exception:
+            self._stats.add_error("connect failed")
+            return
+        self._stats.connect_latencies.append(time.perf_counter() - start)
+        self._stats.connected += 1
+
+        self._playing = True
+        try:
+            await self._sio.emit("get_new_player_data", data=(self._name, str(self._money)), namespace=BJ_NAMESPACE)
+            await asyncio.sleep(max(0, duration - (time.perf_counter() - start)))
+        finally:
+            self._playing = False
+            await self._sio.disconnect()
+
+
+async def find_server_address(entry_address):
+    """The address /assign sends new players to, like client.py. Falls back to entry_address."""
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(entry_address + "/assign") as response:
+                return (await response.json())["address"] or entry_address
+    except (aiohttp.ClientError, ValueError, KeyError):
+        return entry_address
+
+
+async def run_bots(first_bot_index, num_of_bots, args):
+    stats = LoadStats()
+    stats.bots = num_of_bots
+    rng = random.Random(args.seed + first_bot_index)
+    strategy = STRATEGIES[args.strategy]
+
+    async def start_bot(bot_index):
+        await asyncio.sleep(args.ramp_up * (bot_index - first_bot_index) / num_of_bots)
+        server_address = await find_server_address(args.server)
+        bot = Bot(
+            "bot-%d" % bot_index, server_address, strategy, args.think_time, args.think_distribution, args.money,
+            stats, rng,
+        )
+        await bot.play(args.duration)
+
+    results = await asyncio.gather(
+        *(start_bot(bot_index) for bot_index in range(first_bot_index, first_bot_index + num_of_bots)),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            stats.add_error(type(result).__name__)
+    return stats
+
+
+def _run_bots_in_process(task):
+    first_bot_index, num_of_bots, args = task
+    log_listener = log_setup.setup_logging(logging.WARNING)  # The parent's listener thread isn't in this process
+    try:
+        return asyncio.run(run_bots(first_bot_index, num_of_bots, args))
+    finally:
+        log_listener.stop()
+
+
+def generate_load(args):
+    bots_per_process = [
+        args.bots // args.processes + (process_index < args.bots % args.processes)
+        for process_index in range(args.processes)
+    ]
+    tasks = [
+        (sum(bots_per_process[:process_index]), num_of_bots, args)
+        for process_index, num_of_bots in enumerate(bots_per_process)
+        if num_of_bots
+    ]
+
+    stats = LoadStats()
+    with multiprocessing.Pool(processes=len(tasks)) as pool:
+        for process_stats in pool.imap_unordered(_run_bots_in_process, tasks):
+            stats.merge(process_stats)
+    return stats
+
+
+def _print_report(report):
+    print("Bots:            %d (%d connected)" % (report["bots"], report["connected"]))
+    print("Rounds:          %d (%.2f per second)" % (report["rounds"], report["rounds_per_second"]))
+    print("Prompts:         %d" % report["prompts"])
+    for title, key in (("Connect latency", "connect_latency"), ("Round trip", "round_trip")):
+        summary = report[key]
+        if summary["count"]:
+            print("%-16s p50 %.1fms, p90 %.1fms, p99 %.1fms, max %.1fms" % (
+                title + ":", summary["p50"] * 1000, summary["p90"] * 1000, summary["p99"] * 1000,
+                summary["max"] * 1000,
+            ))
+    print("Errors:          %s" % (report["errors"] or "none"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play many bots on the blackjack server and measure it")
+    parser.add_argument("--server", default="http://127.0.0.1:8000")
+    parser.add_argument("--bots", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--duration", type=float, default=60, help="Seconds each bot plays")
+    parser.add_argument("--ramp-up", type=float, default=5, help="Seconds over which the bots connect")
+    parser.add_argument("--strategy", choices=sorted(STRATEGIES), default="basic")
+    parser.add_argument("--think-time", type=float, default=0.5, help="Mean seconds before answering a prompt")
+    parser.add_argument("--think-distribution", choices=sorted(THINK_TIME_DISTRIBUTIONS), default="exponential")
+    parser.add_argument("--money", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    log_listener = log_setup.setup_logging(logging.WARNING)
+    start = time.perf_counter()
+    try:
+        stats = generate_load(args)
+    finally:
+        log_listener.stop()
+    report = stats.as_dict(time.perf_counter() - start)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""Logging setup for the server.
+
+Log calls on the event loop only build a LogRecord and put it on a queue. A QueueListener thread formats the records
+and writes them, so slow terminals or files never block a round. The arguments that may change once the call returns
+(anything but strings, numbers and enums, e.g. a player's hand) are rendered when the record is queued, the message
+itself is only merged by the listener. Each module logs to its own logger (named after the
+module, e.g. "blackjack_base" or "server"), so the level of each subsystem can be set at startup:
+
+    python server.py --log-level INFO --log-levels blackjack_base=WARNING,cluster=DEBUG
+
+In production, --debug-sample-rate 0.01 keeps DEBUG on but only lets 1 in 100 DEBUG records through.
+"""
+import enum
+import functools
+import itertools
+import logging
+import logging.handlers
+import numbers
+import queue
+import re
+
+LOG_FORMAT = "%(asctime)s | %(levelname)s | %(name)s | %(module)s | %(lineno)d | %(process)d | %(message)s"
+DEFAULT_FILE_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_FILE_BACKUP_COUNT = 3
+
+
+class DebugSampler(logging.Filter):
+    """Lets through one in every 1 / rate DEBUG records, and every record of a higher level"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self._every = max(1, round(1 / rate)) if rate > 0 else None
+        self._debug_records = itertools.count()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        return self._every is not None and next(self._debug_records) % self._every == 0
+
+
+# Arguments of these types can't change once the log call returns, so they are formatted by the listener as they are
+_IMMUTABLE_ARGUMENT_TYPES = (str, numbers.Number, bytes, enum.Enum, type(None))
+_PLAIN_ARGUMENT_TYPES = frozenset((str, int, float, bool, type(None)))  # The usual ones, checked first as it's faster
+_CONVERSION_SPECIFIER = re.compile(
+    r"%(?:\((?P<key>[^)]*)\))?[-#0 +]*(?P<width>\*|\d+)?(?:\.(?P<precision>\*|\d+))?[hlL]?(?P<conversion>[a-zA-Z%])"
+)
+_RENDERERS = {"s": str, "r": repr, "a": ascii}
+
+
+class _RenderedArgument(object):
+    """An argument rendered when its record was queued, which %s, %r and %a all format as it was"""
+
+    __slots__ = ("_text",)
+
+    def __init__(self, text):
+        self._text = text
+
+    def __str__(self):
+        return self._text
+
+    __repr__ = __str__
+
+
+@functools.lru_cache(maxsize=1024)
+def _conversions(msg):
+    """The conversion of each argument of a %-format message, in order, and the keys of a mapping's arguments"""
+    conversions = []
+    keys = []
+    for match in _CONVERSION_SPECIFIER.finditer(msg):
+        conversion = match.group("conversion")
+        if conversion == "%":
+            continue
+        if match.group("key") is not None:
+            keys.append((match.group("key"), conversion))
+            continue
+        conversions.extend("d" for group in ("width", "precision") if match.group(group) == "*")
+        conversions.append(conversion)
+    return tuple(conversions), tuple(keys)
+
+
+def _snapshot(argument, conversion):
+    if type(argument) in _PLAIN_ARGUMENT_TYPES or conversion not in _RENDERERS:
+        return argument
+    if isinstance(argument, _IMMUTABLE_ARGUMENT_TYPES):
+        return argument
+    return _RenderedArgument(_RENDERERS[conversion](argument))
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Renders the arguments that may change once the call returns. Merging them into the message, the timestamp,
+        # the format and any traceback are left to the listener's thread.
+        prepared = logging.LogRecord.__new__(logging.LogRecord)
+        prepared.__dict__.update(record.__dict__)  # Other handlers of the logger get the record as it was
+        args = record.args
+        if not args:
+            return prepared
+        msg = record.msg
+        if type(msg) is not str:
+            prepared.msg = record.getMessage()
+            prepared.args = None
+            return prepared
+
+        conversions, keys = _conversions(msg)
+        if isinstance(args, dict) and keys:
+            prepared.args = {key: _snapshot(args[key], conversion) for key, conversion in keys if key in args}
+        elif isinstance(args, tuple) and len(args) == len(conversions):
+            prepared.args = tuple(map(_snapshot, args, conversions))
+        else:  # Arguments that don't match the message are merged here, where a mismatch is reported to the caller
+            prepared.msg = record.getMessage()
+            prepared.args = None
+        return prepared
+
+
+def parse_levels(levels):
+    """'server=DEBUG,blackjack_base=WARNING' -> {'server': 'DEBUG', 'blackjack_base': 'WARNING'}"""
+    subsystem_levels = {}
+    for assignment in filter(None, levels.split(",")):
+        name, _, level = assignment.partition("=")
+        if not level:
+            raise ValueError("Expected subsystem=LEVEL, got %r" % assignment)
+        subsystem_levels[name.strip()] = level.strip().upper()
+    return subsystem_levels
+
+
+def setup_logging(level=logging.INFO, subsystem_levels=None, debug_sample_rate=1.0, handler=None):
+    """Routes every log record through a queue to handler (stderr by default) on a background thread.
+
+    Returns the started QueueListener. Stopping it flushes the records left in the queue.
+    """
+    if handler is None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    if debug_sample_rate < 1:
+        queue_handler.addFilter(DebugSampler(debug_sample_rate))
+
+    root_logger = logging.getLogger()
+    for old_handler in root_logger.handlers[:]:
+        root_logger.removeHandler(old_handler)
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(level)
+    for name, subsystem_level in (subsystem_levels or {}).items():
+        logging.getLogger(name).setLevel(subsystem_level)
+
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def add_arguments(parser):
+    parser.add_argument("--log-level", default="INFO")
+    parser.add_argument(
+        "--log-levels", type=parse_levels, default={}, help="Levels per subsystem, e.g. blackjack_base=WARNING"
+    )
+    parser.add_argument(
+        "--debug-sample-rate", type=float, default=1.0, help="Fraction of the DEBUG records that are logged"
+    )
+
+
+def setup_logging_from_arguments(args):
+    return setup_logging(args.log_level.upper(), args.log_levels, args.debug_sample_rate)
+
+
+def add_rotating_file(logger_name, path, max_bytes=DEFAULT_FILE_MAX_BYTES, backup_count=DEFAULT_FILE_BACKUP_COUNT):
+    """Also writes the records of a logger to a size-rotated file of its own, from a background thread too.
+
+    Returns the started QueueListener.
+    """
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    logging.getLogger(logger_name).addHandler(LazyQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    return listener
@@ -0,0 +1,157 @@
+"""Event loop lag monitor, with the rooms and phases of slow task steps.
+
+Every room plays its rounds on the server's single event loop, so a coroutine hogging the loop delays all the rooms.
+LoopMonitor measures it in two ways:
+- A sampler task sleeps for a fixed interval and measures how late it wakes up. That lag is how long any ready
+  callback waited to run, and goes to the blackjack_event_loop_lag_seconds histogram.
+- Every step of the tasks created while monitoring (the code a task runs between two awaits that suspend it) is
+  timed. Steps longer than a threshold are counted by room and round phase (see blackjack_base.current_table) in
+  blackjack_slow_callbacks_total and blackjack_slow_callback_seconds_total, and logged to the "loop_monitor" logger,
+  which log_setup.add_rotating_file can send to a file of its own.
+
+Steps are timed by a task factory wrapping each task's coroutine, rather than by patching asyncio's Handle, as Sanic
+runs on uvloop, whose handles are not asyncio's. Timing a step costs a few hundred nanoseconds. Plain callbacks, such
+as the rooms' timers, are only reported if they time themselves and call record_callback.
+"""
+import asyncio
+import collections.abc
+import logging
+import time
+
+import metrics
+from blackjack_base import current_table
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_INTERVAL = 0.1  # seconds
+DEFAULT_SLOW_CALLBACK_THRESHOLD = 0.05  # seconds
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+NO_ROOM = "none"
+BETWEEN_ROUNDS = "none"
+
+loop_lag = metrics.histogram(
+    "blackjack_event_loop_lag_seconds", "How late the event loop ran a callback scheduled to run", buckets=LAG_BUCKETS
+)
+slow_callbacks = metrics.counter(
+    "blackjack_slow_callbacks_total",
+    "Task steps that ran longer than the slow callback threshold",
+    label_names=("room", "phase"),
+)
+slow_callback_seconds = metrics.counter(
+    "blackjack_slow_callback_seconds_total",
+    "Time spent running slow task steps",
+    label_names=("room", "phase"),
+)
+
+
+class _TimedCoroutine(collections.abc.Coroutine):
+    """Runs a task's coroutine, timing each of its steps"""
+
+    __slots__ = ("_coro", "_threshold")
+
+    def __init__(self, coro, threshold):
+        self._coro = coro
+        self._threshold = threshold
+
+    def _step(self, resume, *args):
+        table = current_table.get()
+        phase = table.phase if table is not None else None
+        started_at = time.perf_counter()
+        try:
+            return resume(*args)
+        finally:
+            duration = time.perf_counter() - started_at
+            if duration > self._threshold:
+                if table is None:  # The step may have handled an event of a room, which sets the table
+                    table = current_table.get()
+                    phase = table.phase if table is not None else None
+                _record_slow_step(_describe_coroutine(self._coro), table, phase, duration)
+
+    def send(self, value):
+        return self._step(self._coro.send, value)
+
+    def throw(self, *args):
+        return self._step(self._coro.throw, *args)
+
+    def close(self):
+        return self._coro.close()
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+
+def _describe_coroutine(coro):
+    """The task's coroutine, and the coroutine it is suspended in after the slow step"""
+    description = getattr(coro, "__qualname__", repr(coro))
+    innermost = None
+    awaited = getattr(coro, "cr_await", None)
+    while hasattr(awaited, "cr_await"):
+        innermost = awaited
+        awaited = awaited.cr_await
+    if innermost is not None:
+        description += ", suspended in %s" % innermost.__qualname__
+    return description
+
+
+def _record_slow_step(description, table, phase, duration):
+    room = table.table_name if table is not None else NO_ROOM
+    phase_name = phase.name if phase is not None else BETWEEN_ROUNDS
+    slow_callbacks.labels(room, phase_name).inc()
+    slow_callback_seconds.labels(room, phase_name).inc(duration)
+    logger.warning(
+        "Slow task step took %.1fms in %s, phase %s: %s", duration * 1000, room, phase_name, description
+    )
+
+
+class LoopMonitor(object):
+    def __init__(
+            self,
+            sample_interval=DEFAULT_SAMPLE_INTERVAL,
+            slow_callback_threshold=DEFAULT_SLOW_CALLBACK_THRESHOLD,
+    ):
+        self._sample_interval = sample_interval
+        self._slow_callback_threshold = slow_callback_threshold
+        self._sampler_task = None
+        self._previous_task_factory = None
+
+    def _create_task(self, loop, coro, **kwargs):
+        timed_coro = _TimedCoroutine(coro, self._slow_callback_threshold)
+        if self._previous_task_factory is not None:
+            return self._previous_task_factory(loop, timed_coro, **kwargs)
+        return asyncio.Task(timed_coro, loop=loop, **kwargs)
+
+    def start(self):
+        """Starts monitoring the running loop and the tasks created from now on"""
+        loop = asyncio.get_running_loop()
+        self._previous_task_factory = loop.get_task_factory()
+        loop.set_task_factory(self._create_task)
+        self._sampler_task = asyncio.create_task(self._sample_lag())
+
+    def stop(self):
+        asyncio.get_running_loop().set_task_factory(self._previous_task_factory)
+        if self._sampler_task is not None:
+            self._sampler_task.cancel()
+            self._sampler_task = None
+
+    def record_callback(self, description, table, started_at):
+        """Reports a plain callback of table that started running at started_at (a time.perf_counter()) if it was
+        slow, while monitoring"""
+        if self._sampler_task is None:
+            return
+        duration = time.perf_counter() - started_at
+        if duration > self._slow_callback_threshold:
+            _record_slow_step(description, table, table.phase if table is not None else None, duration)
+
+    async def _sample_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected_at = loop.time() + self._sample_interval
+            await asyncio.sleep(self._sample_interval)
+            loop_lag.observe(max(0, loop.time() - expected_at))
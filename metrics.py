@@ -0,0 +1,185 @@
+"""In-process metrics, rendered in the Prometheus text exposition format.
+
+The server is a single threaded event loop, so metrics are plain attributes updated without locks. Labeled metrics
+create a child per label value up front (or on first use), so updating one is an attribute increment on an object
+that already exists. Values that are cheaper to read than to track, like the number of open rooms, are Gauges with a
+function called only when the metrics are rendered.
+"""
+import bisect
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace('"', '\\"')) for name, value in pairs)
+
+
+class _Metric(object):
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=(), label_values=()):
+        self.name = name
+        self.documentation = documentation
+        self._label_names = tuple(label_names)
+        self._children = {}
+        for values in label_values:
+            self.labels(*values)
+
+    def labels(self, *label_values):
+        child = self._children.get(label_values)
+        if child is None:
+            child = self._children[label_values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        """(suffix, label values, extra label pairs, value) of every sample"""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.documentation),
+            "# TYPE %s %s" % (self.name, self.metric_type),
+        ]
+        for suffix, label_values, extra_labels, value in self._samples():
+            lines.append("%s%s%s %s" % (
+                self.name, suffix, _format_labels(self._label_names, label_values, extra_labels), _format_value(value)
+            ))
+        return "\n".join(lines)
+
+
+class _CounterChild(object):
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    metric_type = "counter"
+
+    def __init__(self, name, documentation, label_names=(), label_values=()):
+        super().__init__(name, documentation, label_names, label_values)
+        if not self._label_names:
+            self._unlabeled = self.labels()
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._unlabeled.value += amount
+
+    @property
+    def value(self):
+        return self._unlabeled.value
+
+    def _samples(self):
+        for label_values, child in self._children.items():
+            yield "", label_values, (), child.value
+
+
+class Gauge(_Metric):
+    """A value that goes up and down. With function, the value is function() at render time."""
+
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, function=None):
+        super().__init__(name, documentation)
+        self._function = function
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def _samples(self):
+        yield "", (), (), self._function() if self._function is not None else self.value
+
+
+class _HistogramChild(object):
+    __slots__ = ("upper_bounds", "counts", "sum")
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)  # The last one counts the values above every bucket
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), label_values=(), buckets=DEFAULT_BUCKETS):
+        self._upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, label_names, label_values)
+        if not self._label_names:
+            self._unlabeled = self.labels()
+
+    def _new_child(self):
+        return _HistogramChild(self._upper_bounds)
+
+    def observe(self, value):
+        self._unlabeled.observe(value)
+
+    def _samples(self):
+        for label_values, child in self._children.items():
+            cumulative_count = 0
+            for upper_bound, count in zip(self._upper_bounds + (float("inf"),), child.counts):
+                cumulative_count += count
+                yield "_bucket", label_values, (("le", _format_value(upper_bound)),), cumulative_count
+            yield "_sum", label_values, (), child.sum
+            yield "_count", label_values, (), cumulative_count
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError("A metric named %s is already registered" % metric.name)
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+def counter(name, documentation, label_names=(), label_values=(), registry=REGISTRY):
+    return registry.register(Counter(name, documentation, label_names, label_values))
+
+
+def gauge(name, documentation, function=None, registry=REGISTRY):
+    return registry.register(Gauge(name, documentation, function))
+
+
+def histogram(name, documentation, label_names=(), label_values=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+    return registry.register(Histogram(name, documentation, label_names, label_values, buckets))
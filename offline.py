@@ -1,28 +1,35 @@
 import logging
 import asyncio
 from blackjack_base import (
-    Player,
+    AwaitedPlayer,
     BlackJackGameBase,
 )
 import uuid
+import log_setup
 
-logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
 
 
-class OffLinePlayer(Player):
+class OffLinePlayer(AwaitedPlayer):
     def __init__(self, name: str, id: str, amount_of_money: int = 0):
         super().__init__(name, id, amount_of_money)
 
     def _get_input_from_user(self, msg):
         return input(msg)
 
-    def get_cmd(self, msg, list_of_valid_actions):
+    async def get_bet(self):
+        bet = self._get_input_from_user("Place your bet: ")
+        while not await self._bet_is_valid(bet):
+            bet = self._get_input_from_user("Place your bet: ")
+        return int(bet)
+
+    async def get_cmd(self, msg, list_of_valid_actions):
         while True:
             user_input = self._get_input_from_user(msg)
-            logging.info("Got input from user: %s", user_input)
-            user_action = self._convert_command_to_Action(user_input)
+            logger.info("Got input from user: %s", user_input)
+            user_action = await self._convert_command_to_Action(user_input)
             if user_action not in list_of_valid_actions:
-                logging.info(
+                logger.info(
                     "Got un-allowed Action %s from %s",
                     user_action,
                     self.get_player_name,
@@ -30,8 +37,7 @@ class OffLinePlayer(Player):
                 continue
             return user_action
 
-    @staticmethod
-    def msg_to_user(msg):
+    async def msg_to_user(self, msg):
         print(msg)
 
 
@@ -43,37 +49,37 @@ class BlackJackGameOffLine(BlackJackGameBase):
         self._create_players()
 
     def _take_num_of_players(self):
-        logging.debug("BlackJack game taking number of players from user")
+        logger.debug("BlackJack game taking number of players from user")
 
         while self._num_of_players <= 0:
             try:
                 self._num_of_players = int(
                     self.get_input_from_user("Enter number of players: ")
                 )
-                logging.info(
+                logger.info(
                     "BlackJack game created with %d players", self._num_of_players
                 )
 
                 if self._num_of_players < 0:
-                    self.output_msg_to_game("Enter a positive integer!")
+                    print("Enter a positive integer!")
                 else:
                     break
 
             except ValueError:
-                self.output_msg_to_game("Enter a positive integer!")
+                print("Enter a positive integer!")
                 self._num_of_players = 0
 
     def _create_players(self):
         for i in range(self._num_of_players):
             money_of_player = -1
             msg = "Enter players name: "
-            logging.debug("Taking players name")
+            logger.debug("Taking players name")
 
             name = self.get_input_from_user(msg)
 
             while (money_of_player < 0) or (not type(money_of_player) is int):
                 try:
-                    logging.debug("Taking %s amount of money", name)
+                    logger.debug("Taking %s amount of money", name)
                     money_of_player = int(
                         self.get_input_from_user(
                             "%s - How much money do you have?\n" % name
@@ -81,11 +87,11 @@ class BlackJackGameOffLine(BlackJackGameBase):
                     )
 
                     if money_of_player < 0:
-                        self.output_msg_to_game("Enter a positive number!!")
+                        print("Enter a positive number!!")
                         continue
 
                 except ValueError:
-                    logging.exception("User entered an illegal value")
+                    logger.exception("User entered an illegal value")
                     continue
 
             player = OffLinePlayer(
@@ -98,10 +104,10 @@ class BlackJackGameOffLine(BlackJackGameBase):
 
     def _end_connection_with_player(self, player_id):
         player = self.players[player_id]
-        logging.info("Ending connection with player")
-        player.msg_to_user("You don't have any money left. Reconnect to play again.")
+        logger.info("Ending connection with player")
+        print("You don't have any money left. Reconnect to play again.")
 
-    def output_msg_to_game(self, msg):
+    async def output_msg_to_game(self, msg):
         print(msg)
 
     @staticmethod
@@ -115,4 +121,8 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    log_listener = log_setup.setup_logging(logging.DEBUG)
+    try:
+        asyncio.run(main())
+    finally:
+        log_listener.stop()
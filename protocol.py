@@ -0,0 +1,155 @@
+"""Structured table state protocol between the server and its clients.
+
+The server sends a room's table, as built by BlackJackGameBase.table_state, in STATE_EVENT messages:
+
+    {"v": PROTOCOL_VERSION, "seq": 7, "state": {...}}             a snapshot of the whole table
+    {"v": PROTOCOL_VERSION, "seq": 8, "base": 7, "delta": {...}}  the changes since the state numbered base
+
+Cards are card codes (see Card.code), and the dealer's hole card is None until it is revealed. A delta holds the top
+level fields that changed and, under "seats", the full seat of every player whose seat changed, or None for players
+who left. Clients acknowledge each state they applied with STATE_ACK_EVENT and its seq, and the server sends them
+deltas against the last state they acknowledged. States can be published faster than they are acknowledged, so
+clients keep the last states they received (see TableStateReplica), and ask for a snapshot with STATE_REQUEST_EVENT
+when a delta's base isn't one of them.
+
+The server asks a player for input with PROMPT_EVENT and a prompt_message, numbered per player, naming the
+PromptKinds it asks for so clients don't have to parse its text. The player answers with ANSWER_EVENT and an
+answer_message carrying the prompt's id, so the server can drop answers to prompts it no longer waits for, like
+keystrokes typed after a decision timed out.
+"""
+from collections import OrderedDict
+from enum import Enum
+
+from cards import CARDS
+
+PROTOCOL_VERSION = 1
+
+STATE_EVENT = "table_state"
+STATE_ACK_EVENT = "table_state_ack"
+STATE_REQUEST_EVENT = "table_state_request"
+PROMPT_EVENT = "send_input"
+ANSWER_EVENT = "get input from user"
+
+HIDDEN_CARD_ICON = "🂠"
+STATES_KEPT_BY_CLIENTS = 16
+MAX_ANSWER_LENGTH = 64  # characters, well above any valid command or bet
+
+
+def snapshot_message(seq, state):
+    return {"v": PROTOCOL_VERSION, "seq": seq, "state": state}
+
+
+def delta_message(seq, base_seq, delta):
+    return {"v": PROTOCOL_VERSION, "seq": seq, "base": base_seq, "delta": delta}
+
+
+class PromptKinds(Enum):
+    BET_OR_SKIP = 1
+    BET_AMOUNT = 2
+    DECISION = 3
+
+
+def prompt_message(prompt_id, kind, text):
+    return {"id": prompt_id, "kind": kind.name, "text": text}
+
+
+def prompt_kind(prompt):
+    """The PromptKinds of a prompt_message"""
+    return PromptKinds[prompt["kind"]]
+
+
+def answer_message(prompt, answer):
+    """The answer to a prompt_message"""
+    return {"id": prompt["id"], "input": answer}
+
+
+def parse_answer(message):
+    """(prompt id, input) of an answer_message. Raises ValueError if it isn't one."""
+    if not isinstance(message, dict):
+        raise ValueError("An answer must be a dict, got %s" % type(message).__name__)
+    prompt_id, answer = message.get("id"), message.get("input")
+    if not isinstance(prompt_id, int) or not isinstance(answer, str) or len(answer) > MAX_ANSWER_LENGTH:
+        raise ValueError("An answer needs an int id and an input of at most %d characters" % MAX_ANSWER_LENGTH)
+    return prompt_id, answer
+
+
+def state_delta(old_state, new_state):
+    delta = {key: value for key, value in new_state.items() if key != "seats" and old_state.get(key) != value}
+
+    old_seats, new_seats = old_state["seats"], new_state["seats"]
+    seats = {seat_id: seat for seat_id, seat in new_seats.items() if old_seats.get(seat_id) != seat}
+    seats.update({seat_id: None for seat_id in old_seats if seat_id not in new_seats})
+    if seats:
+        delta["seats"] = seats
+    return delta
+
+
+def apply_delta(state, delta):
+    """The state after delta, as a new dict"""
+    new_state = dict(state)
+    seats = dict(state["seats"])
+    for key, value in delta.items():
+        if key == "seats":
+            for seat_id, seat in value.items():
+                if seat is None:
+                    seats.pop(seat_id, None)
+                else:
+                    seats[seat_id] = seat
+        else:
+            new_state[key] = value
+
+    new_state["seats"] = dict(sorted(seats.items(), key=lambda item: item[1]["seat"]))
+    return new_state
+
+
+class TableStateReplica(object):
+    """A client's copy of the table, built from the STATE_EVENT messages it receives"""
+
+    def __init__(self, num_of_states_kept=STATES_KEPT_BY_CLIENTS):
+        self._states = OrderedDict()  # seq -> state, oldest first
+        self._num_of_states_kept = num_of_states_kept
+
+    @property
+    def seq(self):
+        return next(reversed(self._states), None)
+
+    @property
+    def state(self):
+        return self._states[self.seq] if self._states else None
+
+    def receive(self, message):
+        """Applies a STATE_EVENT message. Returns False if it's a delta against a state the client doesn't have, and
+        the client should ask for a snapshot."""
+        if message["v"] != PROTOCOL_VERSION:
+            raise ValueError("Unsupported table state protocol version %s" % message["v"])
+
+        if "state" in message:
+            state = message["state"]
+        elif message["base"] in self._states:
+            state = apply_delta(self._states[message["base"]], message["delta"])
+        else:
+            return False
+
+        self._states[message["seq"]] = state
+        self._states.move_to_end(message["seq"])
+        while len(self._states) > self._num_of_states_kept:
+            self._states.popitem(last=False)
+        return True
+
+
+def _cards_as_icons(codes):
+    return ", ".join(HIDDEN_CARD_ICON if code is None else CARDS[code].text_image for code in codes)
+
+
+def render_table(state):
+    """The table as text, for clients that print it"""
+    lines = ["Dealer's cards: %s" % _cards_as_icons(state["dealer"])]
+    for seat in state["seats"].values():
+        line = "%s (%s$ left" % (seat["name"], seat["money"])
+        if seat["bet"]:
+            line += ", betting %s$" % seat["bet"]
+        line += ")"
+        if seat["cards"]:
+            line += ": %s" % _cards_as_icons(seat["cards"])
+        lines.append(line)
+    return "\n".join(lines)
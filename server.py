@@ -1,11 +1,35 @@
+import argparse
 import logging
-from blackjack_base import Player, BlackJackGameBase
+from blackjack_base import (
+    COMMANDS,
+    Player,
+    announce_naturals,
+    announce_results,
+    current_table,
+    pay_seats,
+    play_decision,
+)
+from cards import Actions, RoundPhases, Shoe
+from engine import RoundState
+from protocol import PromptKinds
 import socketio
 import sanic
+import sanic.response
 import asyncio
+import collections
+import functools
+import heapq
+import itertools
+import time
+import cluster
+import hand_history
+import log_setup
+import loop_monitor
+import metrics
+import protocol
+import tracing
 
-LOG_FORMAT = "%(asctime)s | %(levelname)s | %(name)s | %(module)s | %(lineno)d | %(process)d | %(message)s"
-logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
 
 # =========================================================================================================
 # ************************************************* Server ************************************************
@@ -13,132 +37,659 @@ logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
 
 BJ_NAMESPACE = "/blackjack"
 
-sio = socketio.AsyncServer(async_mode='sanic')
+# Set by cluster.py when the server runs as one of several workers, None when it runs alone
+registry = cluster.registry_from_environment()
+# The calls made while serving go through it, off the event loop
+background_registry = cluster.BackgroundRoomRegistry(registry) if registry is not None else None
+WORKER_ID = cluster.worker_id_from_environment()
+
+emits = metrics.counter("blackjack_socketio_emits_total", "Socket.IO events sent, a broadcast counting once")
+connects = metrics.counter("blackjack_connects_total", "Clients that connected")
+disconnects = metrics.counter("blackjack_disconnects_total", "Clients that disconnected")
+rounds_started = metrics.counter("blackjack_rounds_started_total", "Rounds started")
+rounds_completed = metrics.counter("blackjack_rounds_completed_total", "Rounds that ended without an error")
+round_duration = metrics.histogram("blackjack_round_duration_seconds", "Duration of a round, betting included")
+decision_wait = metrics.histogram(
+    "blackjack_decision_wait_seconds",
+    "Time players took to decide, by the action decided (BET for a bet amount)",
+    label_names=("action",),
+    label_values=[(action.name,) for action in Actions],
+)
+default_actions_taken = metrics.counter(
+    "blackjack_default_actions_total",
+    "Decisions taken by the server for players who didn't answer in time",
+    label_names=("action",),
+    label_values=[(Actions.SKIP.name,), (Actions.STAND.name,)],
+)
+
+# Why client events get dropped
+RATE_LIMITED = "rate_limited"
+NOT_SEATED = "not_seated"
+MALFORMED = "malformed"
+STALE = "stale"
+shed_connections = metrics.counter("blackjack_shed_connections_total", "Connections refused as the server was full")
+evicted_rooms = metrics.counter("blackjack_evicted_rooms_total", "Rooms closed after being idle for their TTL")
+dropped_client_events = metrics.counter(
+    "blackjack_dropped_client_events_total",
+    "Events from clients that were dropped, by reason",
+    label_names=("reason",),
+    label_values=[(reason,) for reason in (RATE_LIMITED, NOT_SEATED, MALFORMED, STALE)],
+)
+
+
+class CountingAsyncServer(socketio.AsyncServer):
+    async def emit(self, *args, **kwargs):
+        emits.inc()  # send is an emit too
+        return await super().emit(*args, **kwargs)
+
+
+sio = CountingAsyncServer(async_mode='sanic', client_manager=cluster.client_manager_from_environment())
 app = sanic.Sanic(name=__name__)
 sio.attach(app)
 
-games_list = []  # room numbers and game numbers are always equal.
 MAX_NUMBER_OF_PLAYERS_IN_ROOM = 6
+INTER_ROUND_DELAY = 3  # seconds between the end of a round and the start of the next one
+BETTING_DEADLINE = 30  # seconds players have to bet at the start of a round
+
+# Seconds a player has for each decision before the server decides for him, and how long before that he is warned
+DecisionTimeouts = collections.namedtuple("DecisionTimeouts", ["betting", "playing", "grace_period"])
+DEFAULT_DECISION_TIMEOUTS = DecisionTimeouts(betting=20, playing=15, grace_period=5)
+
+# Caps keeping the worker's memory bounded, new connections are refused once they are reached. A room without players
+# stays open room_idle_ttl seconds for the clients it was assigned to that didn't sit yet, then it is evicted.
+ServerLimits = collections.namedtuple("ServerLimits", ["max_rooms", "max_seated_players", "room_idle_ttl"])
+DEFAULT_LIMITS = ServerLimits(max_rooms=1000, max_seated_players=5000, room_idle_ttl=60)
+
+OUTBOX_FLUSH_DELAY = 0.05  # seconds a message can wait in a room's outbox before it is sent
+CLIENT_EVENTS_PER_SECOND = 20  # sustained rate of answers and player data a client can send
+CLIENT_EVENTS_BURST = 40
+# Clients ack every table state, which can be sent once per outbox flush, so acks and snapshot requests get a budget
+# of their own rather than using up the one of the answers
+STATE_EVENTS_PER_SECOND = 2 / OUTBOX_FLUSH_DELAY
+STATE_EVENTS_BURST = 40
+STATE_HISTORY_SIZE = 16  # table states a room keeps to send deltas against
+
+
+class RoomIndex(object):
+    """The open rooms by room number, and bucketed by their number of players.
+
+    Finding the most populated room that isn't full scans the MAX_NUMBER_OF_PLAYERS_IN_ROOM buckets, whatever the
+    number of rooms. Rooms must report every change in their number of players with update_occupancy. With a
+    cluster.BackgroundRoomRegistry, removed rooms and occupancy changes are reported to it too.
+    """
+
+    def __init__(self, max_number_of_players_in_room: int, registry=None):
+        self._registry = registry
+        self._rooms = {}
+        self._rooms_by_num_of_players = [{} for _ in range(max_number_of_players_in_room + 1)]  # ordered sets
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def __iter__(self):
+        return iter(self._rooms.values())
+
+    def get(self, room_number: int):
+        return self._rooms.get(room_number)
+
+    def add(self, game) -> None:
+        self._rooms[game.room_number] = game
+        self._rooms_by_num_of_players[game.num_of_players_in_room][game.room_number] = game
+
+    def remove(self, game) -> None:
+        del self._rooms[game.room_number]
+        del self._rooms_by_num_of_players[game.num_of_players_in_room][game.room_number]
+        if self._registry is not None:
+            self._registry.release_room(game.room_number)
+
+    def update_occupancy(self, game, previous_num_of_players: int) -> None:
+        if game.room_number not in self._rooms:
+            return
+        del self._rooms_by_num_of_players[previous_num_of_players][game.room_number]
+        self._rooms_by_num_of_players[game.num_of_players_in_room][game.room_number] = game
+        if self._registry is not None:
+            self._registry.update_occupancy(game.room_number, game.num_of_players_in_room)
+
+    def most_populated_vacant_room(self):
+        for num_of_players in range(len(self._rooms_by_num_of_players) - 2, -1, -1):
+            for game in self._rooms_by_num_of_players[num_of_players].values():
+                return game
+        return None
+
+
+class TokenBucket(object):
+    """Allows rate events per second on average, and up to burst at once"""
+
+    __slots__ = ("_rate", "_burst", "_tokens", "_updated_at")
+
+    def __init__(self, rate: float, burst: float):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class RoomNumbers(object):
+    """Hands out the lowest room number that isn't taken, so the numbers of closed rooms are reused"""
+
+    def __init__(self):
+        self._next_room_number = 0
+        self._released = []  # heap
+
+    def claim(self) -> int:
+        if self._released:
+            return heapq.heappop(self._released)
+        self._next_room_number += 1
+        return self._next_room_number - 1
+
+    def release(self, room_number: int) -> None:
+        heapq.heappush(self._released, room_number)
+
+
+limits = DEFAULT_LIMITS
+rooms = RoomIndex(MAX_NUMBER_OF_PLAYERS_IN_ROOM, background_registry)
+room_numbers = RoomNumbers()  # Without a cluster.RoomRegistry, which hands out the numbers across workers
+players_by_sid = {}  # sid -> (game, player) of every seated player. Kept by BlackJackGameOnline.
+rate_limits = {}  # sid -> TokenBucket of every connected client that sent an answer or his player data
+state_rate_limits = {}  # sid -> TokenBucket of every connected client that acked a state or asked for a snapshot
+_background_tasks = set()
+
+metrics.gauge("blackjack_active_rooms", "Open rooms", function=lambda: len(rooms))
+metrics.gauge("blackjack_seated_players", "Players seated in a room", function=lambda: len(players_by_sid))
+metrics.gauge(
+    "blackjack_prompted_players",
+    "Seated players the server is waiting for an answer from",
+    function=lambda: sum(player.prompt is not None for _, player in players_by_sid.values()),
+)
+
+
+@app.route("/metrics")
+async def export_metrics(request):
+    return sanic.response.text(metrics.REGISTRY.render(), content_type="text/plain; version=0.0.4")
+
+
+@app.route("/assign")
+async def assign_worker(request):
+    # Clients ask any worker where to connect. Without a cluster, this server is the only choice.
+    own_address = cluster.worker_address_from_environment("%s://%s" % (request.scheme, request.host))
+    if registry is None:
+        return sanic.response.json({"address": own_address})
+    address = await background_registry.assign(MAX_NUMBER_OF_PLAYERS_IN_ROOM)
+    return sanic.response.json({"address": address or own_address})
+
+
+@app.listener("before_server_start")
+async def register_worker(app, loop):
+    if registry is not None:
+        registry.register_worker(WORKER_ID, cluster.worker_address_from_environment(None))
+
+
+@app.listener("after_server_stop")
+async def unregister_worker(app, loop):
+    if registry is not None:
+        background_registry.close()
+        registry.unregister_worker(WORKER_ID)
+
+
+event_loop_monitor = loop_monitor.LoopMonitor()
+
+
+@app.listener("after_server_start")
+async def start_loop_monitor(app, loop):
+    event_loop_monitor.start()
+
+
+@app.listener("before_server_stop")
+async def stop_loop_monitor(app, loop):
+    event_loop_monitor.stop()
+
+
+def _run_in_background(coro):
+    """Runs coro in a task, keeping a reference to the task until it is done"""
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def room_name(room_number: int) -> str:
+    # Socket.IO treats a falsy room as "everyone", so room 0 can't be addressed by its number
+    return "room-%d" % room_number
 
 
 @sio.event(namespace=BJ_NAMESPACE)
 async def connect(sid: str, evniron):
-    logging.info(f"Client {sid} connected")
-    room_number = find_most_populated_room()
+    room_number = await find_most_populated_room()
+    if room_number is None:
+        logger.warning("Refusing the connection of %s, the server is full", sid)
+        shed_connections.inc()
+        raise socketio.exceptions.ConnectionRefusedError("The server is full")
+    logger.info("Client %s connected", sid)
+    connects.inc()
     await sio.emit("connect", to=sid, namespace=BJ_NAMESPACE)
-    sio.enter_room(sid=sid, room=room_number, namespace=BJ_NAMESPACE)
+    sio.enter_room(sid=sid, room=room_name(room_number), namespace=BJ_NAMESPACE)
     await sio.save_session(sid, {"room_number": room_number}, namespace=BJ_NAMESPACE)
-    logging.info(f"Finished processing connection for {sid}")
+    logger.info("Finished processing connection for %s", sid)
+
+
+def rate_limited(sid: str, buckets=None, rate=CLIENT_EVENTS_PER_SECOND, burst=CLIENT_EVENTS_BURST) -> bool:
+    """Takes a token from the client's bucket in buckets (rate_limits by default). Checked first by the client event
+    handlers, so a flood of events is dropped before doing any work."""
+    if buckets is None:
+        buckets = rate_limits
+    bucket = buckets.get(sid)
+    if bucket is None:
+        bucket = buckets[sid] = TokenBucket(rate, burst)
+    if bucket.take():
+        return False
+    dropped_client_events.labels(RATE_LIMITED).inc()
+    return True
+
+
+def state_rate_limited(sid: str) -> bool:
+    return rate_limited(sid, state_rate_limits, STATE_EVENTS_PER_SECOND, STATE_EVENTS_BURST)
+
+
+@sio.event(namespace=BJ_NAMESPACE)
+async def disconnect(sid: str):
+    logger.info("Client %s disconnected", sid)
+    disconnects.inc()
+    rate_limits.pop(sid, None)
+    state_rate_limits.pop(sid, None)
+    seat = players_by_sid.get(sid)
+    if seat is not None:
+        game, _ = seat
+        game.remove_player_from_game(sid)
 
 
 @sio.on('get_new_player_data', namespace=BJ_NAMESPACE)
 async def process_new_player_data(sid: str, name: str, money: str):
+    if rate_limited(sid):
+        return
+    if sid in players_by_sid:
+        logger.info("%s sent his player data again, he is already seated", sid)
+        return
     try:
         assert (money := int(money)) > 0
         await add_player_to_room(sid, name, money)
     except (ValueError, AssertionError):
-        logging.exception(f"Bad 'money' argument from username {name}, SID {sid}")
+        logger.exception("Bad 'money' argument from username %s, SID %s", name, sid)
         await sio.emit(event='message', to=sid, data="Server received bad input, disconnecting", namespace=BJ_NAMESPACE)
         await sio.disconnect(sid=sid)
-        # TODO: check if room needs to be deleted
 
 
-@sio.on('get input from user', namespace=BJ_NAMESPACE)
-async def put_user_input_into_player_instance_queue(sid, data):
-    client_session = await sio.get_session(sid, namespace=BJ_NAMESPACE)  # Can't be done in one line
-    client_room_num = client_session["room_number"]
-    player = [x for x in games_list[client_room_num].players if x.id == sid][0]  # get player instance from room
-    await player.put_user_input_in_queue(data)
+@sio.on(protocol.ANSWER_EVENT, namespace=BJ_NAMESPACE)
+async def answer_prompt(sid, data):
+    if rate_limited(sid):
+        return
+    try:
+        game, player = players_by_sid[sid]
+    except KeyError:
+        logger.info("Got input from %s, who isn't seated in a room", sid)
+        dropped_client_events.labels(NOT_SEATED).inc()
+        return
+    try:
+        prompt_id, user_input = protocol.parse_answer(data)
+    except ValueError:
+        logger.info("Got a malformed answer from %s", sid)
+        dropped_client_events.labels(MALFORMED).inc()
+        return
+
+    dropped_reason = game.answer(player, prompt_id, user_input)
+    if dropped_reason is not None:
+        logger.debug("Dropped input from %s: %s", sid, dropped_reason)
+        dropped_client_events.labels(dropped_reason).inc()
+
+
+@sio.on(protocol.STATE_ACK_EVENT, namespace=BJ_NAMESPACE)
+async def acknowledge_table_state(sid, seq):
+    if state_rate_limited(sid):
+        return
+    try:
+        game, _ = players_by_sid[sid]
+    except KeyError:
+        return
+    game.acknowledge_table_state(sid, seq)
 
 
-def find_most_populated_room() -> int:
-    logging.debug("Searching for room")
-    if len(games_list) == 0:
-        open_room(0)
-        return 0
+@sio.on(protocol.STATE_REQUEST_EVENT, namespace=BJ_NAMESPACE)
+async def send_table_state_snapshot(sid):
+    if state_rate_limited(sid):
+        return
     try:
-        return sorted([x for x in games_list if x.num_of_players_in_room < MAX_NUMBER_OF_PLAYERS_IN_ROOM],
-                      key=lambda game: game.num_of_players_in_room)[-1].room_number
-    except IndexError:
-        logging.info("All rooms are full")
-        open_room()
-        return games_list[-1].room_number
+        game, _ = players_by_sid[sid]
+    except KeyError:
+        return
+    await game.send_table_state_snapshot(sid)
+
+
+async def find_most_populated_room():
+    """The number of the room a new player should sit in, opening a room if they are all full. None if the server is
+    full."""
+    logger.debug("Searching for room")
+    if len(players_by_sid) >= limits.max_seated_players:
+        logger.warning("%d players are seated, the server is full", len(players_by_sid))
+        return None
+    game = rooms.most_populated_vacant_room()
+    if game is None:
+        if len(rooms) >= limits.max_rooms:
+            logger.warning("All the %d rooms are full, the server is full", len(rooms))
+            return None
+        logger.info("All rooms are full")
+        game = await open_room()
+    return game.room_number
+
+
+async def open_room():
+    room_num = await background_registry.claim_room(WORKER_ID) if registry is not None else room_numbers.claim()
+    logger.info("Opening room # %d", room_num)
+    game_instance = BlackJackGameOnline(room_num=room_num, idle_ttl=limits.room_idle_ttl)
+    rooms.add(game_instance)
+    game_instance.start_idle_timer()  # Until its first player sits
+    return game_instance
 
 
-def open_room(room_num: int = None) -> None:
-    if room_num is None:
-        room_num = games_list[-1].room_number + 1
-    logging.info("Opening room # %d", room_num)
-    game_instance = BlackJackGameOnline(room_num=room_num)
-    games_list.append(game_instance)
-    asyncio.create_task(game_instance.play_round())
+def close_room(game) -> None:
+    logger.info("Closing room # %d", game.room_number)
+    rooms.remove(game)
+    if registry is None:
+        room_numbers.release(game.room_number)
+    # Clients assigned to the room that didn't sit leave it, so they don't get the messages of the next room with its
+    # number
+    _run_in_background(sio.close_room(room_name(game.room_number), namespace=BJ_NAMESPACE))
 
 
 async def add_player_to_room(sid: str, name: str, money: int) -> None:
     player = SocketioPlayer(name=name, sid=sid, amount_of_money=int(money))
     client_session = await sio.get_session(sid, namespace=BJ_NAMESPACE)  # Can't be done in one line
     client_room_num = client_session["room_number"]
-    games_list[client_room_num].add_player(player=player)
+    game = rooms.get(client_room_num)
+
+    if game is None or game.num_of_players_in_room >= MAX_NUMBER_OF_PLAYERS_IN_ROOM:
+        # The room was closed or filled up since the client connected, move it to another one
+        sio.leave_room(sid=sid, room=room_name(client_room_num), namespace=BJ_NAMESPACE)
+        client_room_num = await find_most_populated_room()
+        if client_room_num is None:
+            shed_connections.inc()
+            await sio.emit(event='message', to=sid, data="The server is full, disconnecting", namespace=BJ_NAMESPACE)
+            await sio.disconnect(sid=sid, namespace=BJ_NAMESPACE)
+            return
+        await sio.save_session(sid, {"room_number": client_room_num}, namespace=BJ_NAMESPACE)
+        game = rooms.get(client_room_num)
+
+    # Also when the client's room was closed and its number reused, as closing a room empties it
+    sio.enter_room(sid=sid, room=room_name(client_room_num), namespace=BJ_NAMESPACE)
+
+    game.add_player(player=player)
     msg = "Welcome to room %d %s" % (client_room_num, name)
     await send_msg_to_room(msg, client_room_num)
+    await game.send_table_state_snapshot(sid)
 
 
 async def send_msg_to_room(msg, room):
-    await sio.send(data=msg, room=room, namespace=BJ_NAMESPACE)
+    await sio.send(data=msg, room=room_name(room), namespace=BJ_NAMESPACE)
+
+
+class RoomOutbox(object):
+    """Buffers the messages a room sends to all its clients or to one of its players, and its prompts.
+
+    flush cuts everything buffered so far into a frame, sent as a single message per recipient (the texts joined by new
+    lines), followed by the prompts. Rooms flush when the round moves to another phase, and at the latest flush_delay
+    seconds after a message was buffered, or right after the event that prompted a player. If the table changed since
+    the last flush, the frame starts with publish_state(), so clients get the cards before the messages about them.
+    """
+
+    def __init__(self, room_number: int, flush_delay: float = OUTBOX_FLUSH_DELAY, publish_state=None):
+        self._room_number = room_number
+        self._flush_delay = flush_delay
+        self._publish_state = publish_state
+        self._messages = {}  # recipient's sid, or None for the whole room -> texts in the order they were sent
+        self._prompts = {}  # sid -> the last prompt message of the player
+        self._table_changed = False
+        self._flush_timer = None
+        self._flush_lock = asyncio.Lock()  # Keeps frames in order, as each one is sent by a task of its own
+        self._sending = set()
+
+    def __len__(self):
+        return sum(len(texts) for texts in self._messages.values()) + len(self._prompts)
+
+    def add(self, text: str, sid: str = None) -> None:
+        self._messages.setdefault(sid, []).append(text)
+        self._schedule_flush()
+
+    def table_changed(self) -> None:
+        self._table_changed = True
+        self._schedule_flush()
+
+    def prompt(self, sid: str, message: dict) -> None:
+        self._prompts[sid] = message
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+        self._flush_timer = asyncio.get_running_loop().call_soon(self._flush_when_due)
+
+    def _schedule_flush(self):
+        if self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().call_later(self._flush_delay, self._flush_when_due)
+
+    def _flush_when_due(self):
+        self._flush_timer = None
+        self.flush()
+
+    def flush(self) -> asyncio.Task:
+        """Cuts a frame of everything buffered. Returns the task sending it, which ends once the earlier frames and
+        this one are sent."""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+        messages, self._messages = self._messages, {}
+        prompts, self._prompts = self._prompts, {}
+        table_changed, self._table_changed = self._table_changed, False
+        state_publication = self._publish_state() if table_changed and self._publish_state is not None else None
+        sending = asyncio.ensure_future(self._send(state_publication, messages, prompts))
+        self._sending.add(sending)
+        sending.add_done_callback(self._sending.discard)
+        return sending
+
+    async def _send(self, state_publication, messages, prompts):
+        async with self._flush_lock:
+            try:
+                if state_publication is not None:
+                    await state_publication
+                for sid, texts in messages.items():
+                    if sid is None:
+                        await send_msg_to_room("\n".join(texts), self._room_number)
+                    else:
+                        await sio.send(data="\n".join(texts), to=sid, namespace=BJ_NAMESPACE)
+                for sid, message in prompts.items():
+                    await sio.emit(protocol.PROMPT_EVENT, data=message, to=sid, namespace=BJ_NAMESPACE)
+            except Exception:
+                logger.exception("Failed sending the messages of room # %d", self._room_number)
+
+
+class TableStateChannel(object):
+    """Sends a room's table states to its players with the structured protocol (see protocol.py).
+
+    Every published state gets the next seq. A player gets a delta against the last state he acknowledged, or a
+    snapshot if he didn't acknowledge any of the last history_size states, e.g. right after he joined.
+    """
+
+    def __init__(self, history_size: int = STATE_HISTORY_SIZE):
+        self._seq = 0
+        self._states = collections.OrderedDict()  # seq -> state, oldest first
+        self._history_size = history_size
+        self._acknowledged_seqs = {}  # sid -> seq
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    def acknowledge(self, sid: str, seq: int) -> None:
+        if seq in self._states and seq > self._acknowledged_seqs.get(sid, 0):
+            self._acknowledged_seqs[sid] = seq
+
+    def forget(self, sid: str) -> None:
+        self._acknowledged_seqs.pop(sid, None)
+
+    async def publish(self, state: dict, sids) -> None:
+        if self._states and self._states[self._seq] == state:
+            return
+        self._seq += 1
+        self._states[self._seq] = state
+        if len(self._states) > self._history_size:
+            self._states.popitem(last=False)
+
+        messages = {}  # base seq, or None for a snapshot -> message. Players in sync share the same delta.
+        for sid in sids:
+            base_seq = self._acknowledged_seqs.get(sid)
+            if base_seq not in self._states:
+                base_seq = None
+            if base_seq not in messages:
+                messages[base_seq] = self._message(base_seq)
+            await sio.emit(protocol.STATE_EVENT, data=messages[base_seq], to=sid, namespace=BJ_NAMESPACE)
+
+    def _message(self, base_seq):
+        if base_seq is None:
+            return protocol.snapshot_message(self._seq, self._states[self._seq])
+        return protocol.delta_message(
+            self._seq, base_seq, protocol.state_delta(self._states[base_seq], self._states[self._seq])
+        )
+
+    async def send_snapshot(self, sid: str) -> None:
+        if self._states:
+            await sio.emit(protocol.STATE_EVENT, data=self._message(None), to=sid, namespace=BJ_NAMESPACE)
 
 
 # =========================================================================================================
 # ******************************************** BlackJack Online *******************************************
 # =========================================================================================================
 
+# A question a player was asked, and what the server decides for him if he doesn't answer it in time
+Prompt = collections.namedtuple("Prompt", ["id", "kind", "allowed_actions", "default_action"])
+
+BET_OR_SKIP_PROMPT = "To bet, type 'B'. To skip this round, type 'Skip'"
+BET_AMOUNT_PROMPT = "Place your bet: "
+DECISION_PROMPT = (
+    "%s - To Hit type 'H'\nTo stand type 'S'\n"
+    "To Double down type 'D'\n"
+    "To Surrender and get half your money back, type 'Surrender'\n"
+)
+
+
 class SocketioPlayer(Player):
+    """A player seated in an online room.
+
+    He doesn't await his input: his room prompts him, and handles his answers as events (see
+    BlackJackGameOnline.answer). The prompt he is answering and the timers of its decision are kept here.
+    """
 
     def __init__(self, name: str, sid: str, amount_of_money: int = 0):
         Player.__init__(self, name=name, id=sid, amount_of_money=amount_of_money)
-        self.q = asyncio.Queue()
+        self._prompt_ids = itertools.count()
+        self.prompt = None  # The Prompt the player is answering, None when no answer is expected
+        self.decision_timers = ()  # The warning and the timeout of the decision he is prompted for
+        self.decision_started_at = None
+        self.decision_span = tracing.NO_SPAN  # Spans the wait for his answer to the decision
+        self.outbox = None  # The RoomOutbox of the player's room, set while he is seated
 
-    async def _get_input_from_user(self, msg) -> str:
-        await sio.emit("send_input", data=msg, to=self.id, namespace=BJ_NAMESPACE)
-        logging.debug("Waiting for q item to return...")
-        item = await self.q.get()
-        logging.debug("Got item from q")
-        return str(item)
+    def next_prompt_id(self) -> int:
+        return next(self._prompt_ids)
 
-    async def put_user_input_in_queue(self, usr_input) -> None:
-        #   This is called by the event
-        await self.q.put(usr_input)
+    @property
+    def awaited_prompt_id(self):
+        return self.prompt.id if self.prompt is not None else None
+
+    def stop_decision_timers(self) -> None:
+        for timer in self.decision_timers:
+            timer.cancel()
+        self.decision_timers = ()
+        self.decision_span.end()
+        self.decision_span = tracing.NO_SPAN
 
     async def msg_to_user(self, text):
-        await sio.send(data=text, to=self._id, namespace=BJ_NAMESPACE)
-
-    async def get_bet(self):
-        logging.info("Getting bet from %s", self.get_player_name)
-        bet = await self._get_input_from_user("Place your bet: ")
-        while not await self._bet_is_valid(bet):
-            bet = await self._get_input_from_user("Place your bet: ")
-        return int(bet)
-
-    async def get_cmd(self, msg, list_of_valid_actions):
-        while True:
-            user_input = await self._get_input_from_user(msg)
-            logging.info("Got input from user: %s", user_input)
-            user_action = await self._convert_command_to_Action(user_input)
-            if user_action not in list_of_valid_actions:
-                logging.info(
-                    "Got invalid Action %s from %s",
-                    user_action,
-                    self.get_player_name,
-                )
-                continue
-            return user_action
-
-
-class BlackJackGameOnline(BlackJackGameBase):
-    def __init__(self, room_num: str):
-        super().__init__()
+        if self.outbox is not None:
+            self.outbox.add(text, sid=self._id)
+        else:
+            await sio.send(data=text, to=self._id, namespace=BJ_NAMESPACE)
+
+
+def room_event(handle_event):
+    """Decorates the methods through which events get into a room: its timers, and its players joining, answering
+    and leaving.
+
+    The event runs with the room as blackjack_base.current_table, which is left set afterwards, so the loop monitor can
+    attribute the task step that handled it to the room. Timer callbacks and client event handlers each run in a
+    context of their own, so it doesn't leak to other rooms. A failing event is logged and ends the round rather than
+    leaving the room stuck.
+    """
+
+    @functools.wraps(handle_event)
+    def handle_room_event(room, *args):
+        current_table.set(room)
+        started_at = time.perf_counter()
+        try:
+            return handle_event(room, *args)
+        except Exception:
+            logger.exception("Round in room # %d failed", room.room_number)
+            room._abort_round()
+        finally:
+            if asyncio.current_task() is None:  # A timer. The monitor times the steps of tasks itself.
+                event_loop_monitor.record_callback(handle_event.__qualname__, room, started_at)
+
+    return handle_room_event
+
+
+class BlackJackGameOnline(object):
+    """A room playing back to back rounds while it has players, with the rules of engine.RoundState.
+
+    No coroutine is kept per room: the room only moves forward when an event comes in (a player joining, answering
+    or leaving, a timer going off) and handles it synchronously, buffering what it sends in its RoomOutbox. Between
+    events, a round is its RoundState, the bets being placed and the players' prompts, which snapshot() returns as
+    plain data.
+    """
+
+    def __init__(
+            self,
+            room_num: int,
+            inter_round_delay: float = INTER_ROUND_DELAY,
+            betting_deadline: float = BETTING_DEADLINE,
+            decision_timeouts: DecisionTimeouts = DEFAULT_DECISION_TIMEOUTS,
+            idle_ttl: float = DEFAULT_LIMITS.room_idle_ttl,
+    ):
+        self.players = []
         self._num_of_players = 0
         self._room_num = room_num
-        logging.info("BlackJackGameOnline instance created. ROOM # = %d", room_num)
+        self._inter_round_delay = inter_round_delay
+        self._betting_deadline = betting_deadline  # seconds. None waits for every player to bet or skip.
+        self._decision_timeouts = decision_timeouts
+        self._idle_ttl = idle_ttl
+        self._shoe = Shoe()
+        self._phase = None
+        self._round = None  # The RoundState of the round, once the cards are dealt
+        self._round_players = []  # The player of each seat of the round
+        self._paid_seats = set()
+        self._bets = {}  # player -> his bet for the round
+        self._bettors = {}  # player -> span of his bet, for the players who didn't bet or skip yet
+        self._round_started_at = None
+        self._round_timer = None  # Starts the next round
+        self._betting_timer = None
+        self._idle_timer = None  # Evicts the room, while it has no players
+        self._round_span = tracing.NO_SPAN
+        self._phase_span = tracing.NO_SPAN
+        self._decisions_span = tracing.NO_SPAN
+        self._waiting_span = tracing.NO_SPAN  # From scheduling a round until it starts
+        self._state_channel = TableStateChannel()
+        self._outbox = RoomOutbox(room_num, publish_state=self._publish_table_state)
+        self.table_name = "room %d" % room_num
+        logger.info("BlackJackGameOnline instance created. ROOM # = %d", room_num)
 
     @property
     def room_number(self) -> int:
@@ -148,23 +699,504 @@ class BlackJackGameOnline(BlackJackGameBase):
     def num_of_players_in_room(self):
         return self._num_of_players
 
+    @property
+    def phase(self):
+        """The RoundPhases the current round is in, None between rounds"""
+        return self._phase
+
+    @property
+    def is_playing(self) -> bool:
+        return self._phase is not None or self._round_timer is not None
+
+    def _trace_span(self, name, player=None, track=None):
+        return tracing.table_span(self.table_name, name, player.get_player_name if player is not None else None, track)
+
+    def _player_track(self, player) -> str:
+        return "%s / %s" % (self.table_name, player)
+
+    def _tell(self, player, text: str) -> None:
+        self._outbox.add(text, sid=player.id)
+
     def add_player(self, player):
+        logger.info("Player added")
+        previous_num_of_players = self._num_of_players
         self.players.append(player)
         self._num_of_players = len(self.players)
+        players_by_sid[player.id] = (self, player)
+        player.outbox = self._outbox
+        self._outbox.table_changed()
+        rooms.update_occupancy(self, previous_num_of_players)
+
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+        if not self.is_playing:  # Players joining during a round play from the next one
+            self._schedule_round(0)
 
+    @room_event
     def remove_player_from_game(self, player_sid):
-        # TODO: rewrite this method
-        del self.players[player_sid]
+        previous_num_of_players = self._num_of_players
+        leaving_players = [player for player in self.players if player.id == player_sid]
+        self.players = [player for player in self.players if player.id != player_sid]
+        self._state_channel.forget(player_sid)
+        self._outbox.table_changed()
         self._num_of_players = len(self.players)
+        players_by_sid.pop(player_sid, None)
+        rooms.update_occupancy(self, previous_num_of_players)
+
+        for player in leaving_players:
+            player.outbox = None
+            if player.prompt is not None:  # Decide for him now rather than when his decision times out
+                logger.info("%s left while prompted, the server decides for him", player.get_player_name)
+                self._decide(player, player.prompt.default_action, answered=False)
+        if not self.players and self._round_timer is not None:
+            self._round_timer.cancel()
+            self._round_timer = None
+            self._end_waiting_span()
+            self.start_idle_timer()
 
     def _end_connection_with_player(self, sid):
-        # TODO: rewrite this method
-        raise NotImplementedError
+        """Removes a player from the room and disconnects his client, once the messages to him are sent"""
+        self.remove_player_from_game(sid)
+        _run_in_background(self._disconnect_after_flush(sid))
+
+    async def _disconnect_after_flush(self, sid):
+        await self._outbox.flush()
+        await sio.disconnect(sid=sid, namespace=BJ_NAMESPACE)
+
+    def start_idle_timer(self):
+        """Evicts the room if it still has no players in idle_ttl seconds"""
+        if self._idle_timer is None:
+            self._idle_timer = asyncio.get_running_loop().call_later(self._idle_ttl, self._evict_if_idle)
+
+    @room_event
+    def _evict_if_idle(self):
+        self._idle_timer = None
+        if not self.players and not self.is_playing and rooms.get(self.room_number) is self:
+            logger.info("Evicting room # %d, idle for %ds", self.room_number, self._idle_ttl)
+            evicted_rooms.inc()
+            close_room(self)
+
+    def _schedule_round(self, delay: float) -> None:
+        self._waiting_span = self._trace_span("waiting for players")
+        self._round_timer = asyncio.get_running_loop().call_later(delay, self._start_round)
+
+    def _start_phase(self, phase):
+        self._outbox.flush()  # The messages of the previous phase are sent as one frame
+        logger.debug("Round phase is now %s", phase)
+        self._phase = phase
+        self._phase_span.end()
+        self._phase_span = self._trace_span(phase.name.lower())
+        self._outbox.table_changed()
+
+    def _end_waiting_span(self):
+        self._waiting_span.end()
+        self._waiting_span = tracing.NO_SPAN
 
-    async def output_msg_to_game(self, text):
-        await send_msg_to_room(text, self.room_number)
+    # =======================================================
+    # Betting
+    # =======================================================
+    @room_event
+    def _start_round(self):
+        self._round_timer = None
+        self._end_waiting_span()
+        if not self.players:
+            self.start_idle_timer()
+            return
+
+        rounds_started.inc()
+        self._round_started_at = asyncio.get_running_loop().time()
+        self._round_span = self._trace_span("round")
+        if self._shoe.shuffle_if_cut_card_reached():
+            self._outbox.add("The cut card came out, shuffling the shoe")
+
+        self._start_phase(RoundPhases.BETTING)
+        logger.info("Room # %d is starting to take bets from players", self.room_number)
+        # All players bet at the same time, so each of them gets a track of his own
+        for player in self.players:
+            self._bettors[player] = self._trace_span("bet", player, track=self._player_track(player))
+            self._prompt(player, PromptKinds.BET_OR_SKIP, (Actions.BET, Actions.SKIP))
+        if self._betting_deadline is not None:
+            self._betting_timer = asyncio.get_running_loop().call_later(
+                self._betting_deadline, self._close_betting_at_deadline
+            )
+
+    @room_event
+    def _close_betting_at_deadline(self):
+        self._betting_timer = None
+        for player in list(self._bettors):  # Players who didn't bet by the deadline sit the round out
+            logger.info("%s didn't bet in time and sits this round out", player.get_player_name)
+            self._tell(player, "Betting is over, you sit this round out")
+            player.prompt = None
+            player.stop_decision_timers()
+            self._bettors.pop(player).end()
+        self._close_betting()
+
+    def _bet_done(self, player):
+        self._bettors.pop(player).end()
+        if not self._bettors:
+            self._close_betting()
+
+    def _close_betting(self):
+        if self._betting_timer is not None:
+            self._betting_timer.cancel()
+            self._betting_timer = None
+
+        # Only the players who bet and are still seated play the round, in their seats' order
+        self._round_players = [player for player in self.players if player in self._bets]
+        if not self._round_players:
+            self._outbox.add("No Players in this round")
+            self._end_round()
+            return
+
+        self._round = RoundState(
+            [self._bets[player] for player in self._round_players],
+            [player.remaining_money for player in self._round_players],
+        )
+        self._round.shoe_shuffles, self._round.shoe_position = self._shoe.num_of_shuffles, self._shoe.position
+        self._start_phase(RoundPhases.DEAL)
+        self._round.deal(self._shoe)
+        logger.info("Cards were dealt in room # %d", self.room_number)
+        if self._round.hole_card_revealed:  # Someone has a blackjack
+            self._announce_naturals()
+
+        self._start_phase(RoundPhases.DECISIONS)
+        self._continue_round()
+
+    def _announce_naturals(self):
+        self._send(announce_naturals(self._round, self._round_players, self._paid_seats))
+
+    # =======================================================
+    # Prompts
+    # =======================================================
+    def _prompt(self, player, kind, allowed_actions=None):
+        """Asks player for an answer. A new decision starts the player's decision timeout, while prompting him again
+        for the same decision (e.g. after an invalid answer) keeps it."""
+        if kind == PromptKinds.DECISION:
+            text, timeout, default_action = (
+                DECISION_PROMPT % player.get_player_name, self._decision_timeouts.playing, Actions.STAND
+            )
+        else:
+            text = BET_OR_SKIP_PROMPT if kind == PromptKinds.BET_OR_SKIP else BET_AMOUNT_PROMPT
+            timeout, default_action = self._decision_timeouts.betting, Actions.SKIP
+
+        player.prompt = Prompt(player.next_prompt_id(), kind, allowed_actions, default_action)
+        if not player.decision_timers:
+            self._start_decision_timers(player, timeout)
+        self._outbox.prompt(player.id, protocol.prompt_message(player.prompt.id, kind, text))
+
+    def _start_decision_timers(self, player, timeout):
+        loop = asyncio.get_running_loop()
+        grace_period = min(self._decision_timeouts.grace_period, timeout)
+        player.decision_started_at = loop.time()
+        player.decision_timers = (
+            loop.call_later(timeout - grace_period, self._warn_before_timeout, player, grace_period),
+            loop.call_later(timeout, self._decision_timed_out, player),
+        )
+        # Bets are awaited from all players at once, on their own tracks, decisions one seat at a time
+        track = None if player.prompt.kind == PromptKinds.DECISION else self._player_track(player)
+        player.decision_span = self._trace_span("await decision", player, track)
+
+    @room_event
+    def _warn_before_timeout(self, player, grace_period):
+        self._tell(
+            player,
+            "%d seconds left to decide, or the server will %s for you"
+            % (grace_period, player.prompt.default_action.name.lower()),
+        )
+
+    @room_event
+    def _decision_timed_out(self, player):
+        default_action = player.prompt.default_action
+        logger.info("%s didn't decide in time, taking %s for him", player.get_player_name, default_action)
+        default_actions_taken.labels(default_action.name).inc()
+        self._tell(player, "Time is up, the server chose to %s for you" % default_action.name.lower())
+        self._decide(player, default_action, answered=False)
+
+    @room_event
+    def answer(self, player, prompt_id: int, text: str):
+        """Handles a player's answer to one of his prompts. Returns why it was dropped, None if it wasn't."""
+        prompt = player.prompt
+        if prompt is None or prompt.id != prompt_id:
+            return STALE
+
+        if prompt.kind == PromptKinds.BET_AMOUNT:
+            invalid_bet_message = player.invalid_bet_message(text)
+            if invalid_bet_message is not None:
+                self._tell(player, invalid_bet_message)
+                self._prompt(player, prompt.kind)
+                return None
+            self._decide(player, int(text))
+            return None
+
+        action = COMMANDS.get(text.strip().lower())
+        if action not in prompt.allowed_actions:
+            logger.info("Got invalid Action %s from %s", action, player.get_player_name)
+            if action is None:
+                self._tell(player, "Not a valid command!")
+            self._prompt(player, prompt.kind, prompt.allowed_actions)
+            return None
+        self._decide(player, action)
+        return None
+
+    def _decide(self, player, decision, answered=True):
+        """Plays the decision of a prompted player: an Actions, or the amount of his bet"""
+        prompt = player.prompt
+        player.prompt = None
+        player.stop_decision_timers()
+        if answered:
+            decision_wait.labels(decision.name if isinstance(decision, Actions) else Actions.BET.name).observe(
+                asyncio.get_running_loop().time() - player.decision_started_at
+            )
+
+        if prompt.kind == PromptKinds.DECISION:
+            self._play_decision(decision)
+            self._continue_round()
+        elif decision == Actions.BET:
+            if player.remaining_money == 0:
+                self._tell(player, "You have no money left, you sit this round out")
+                self._bet_done(player)
+            else:
+                self._prompt(player, PromptKinds.BET_AMOUNT)
+        else:
+            if decision != Actions.SKIP:
+                logger.info("%s is betting %d$", player.get_player_name, decision)
+                self._bets[player] = player.give_money(decision)
+            self._bet_done(player)
+
+    # =======================================================
+    # Decisions, dealer and settlement
+    # =======================================================
+    def _continue_round(self):
+        """Prompts the seat whose turn it is, or plays the dealer and settles the round once every seat decided"""
+        round_state = self._round
+        while round_state.phase == RoundPhases.DECISIONS:
+            player = self._round_players[round_state.seat]
+            if player in self.players:
+                if self._decisions_span is tracing.NO_SPAN:
+                    self._decisions_span = self._trace_span("decisions", player)
+                self._prompt(player, PromptKinds.DECISION, round_state.allowed_actions)
+                return
+            logger.info("%s left the room, standing for him", player.get_player_name)
+            self._play_decision(Actions.STAND)
+
+        if not round_state.seats_in_round:
+            logger.info("No players left, returning.")
+            self._outbox.add("No more players, game over")
+            round_state.play_dealer(self._shoe)
+            round_state.settle()
+            self._end_round()
+            return
+
+        self._start_phase(RoundPhases.DEALER)
+        round_state.play_dealer(self._shoe)
+        self._start_phase(RoundPhases.SETTLEMENT)
+        round_state.settle()
+        self._announce_results()
+        self._pay_seats()
+        self._end_round()
+
+    def _play_decision(self, action):
+        round_state = self._round
+        seat = round_state.seat
+        num_of_cards = len(round_state.hands[seat])
+        self._send(play_decision(round_state, self._round_players, self._paid_seats, action, self._shoe))
+        if len(round_state.hands[seat]) != num_of_cards:
+            self._outbox.table_changed()
+        if round_state.seat != seat:
+            self._decisions_span.end()
+            self._decisions_span = tracing.NO_SPAN
+
+    def _announce_results(self):
+        self._send(announce_results(self._round, self._round_players))
+
+    def _pay_seats(self):
+        self._send(pay_seats(self._round, self._round_players, self._paid_seats))
+
+    def _send(self, messages):
+        """Buffers the (player, text) messages of the blackjack_base round helpers, player None being the room"""
+        for player, text in messages:
+            if player is None:
+                self._outbox.add(text)
+            else:
+                self._tell(player, text)
+
+    # =======================================================
+    # Round over
+    # =======================================================
+    def _end_round(self, completed=True):
+        round_duration.observe(asyncio.get_running_loop().time() - self._round_started_at)
+        if completed:
+            rounds_completed.inc()
+            if self._round is not None:
+                hand_history.record(self.table_name, self._round, self._shoe)
+
+        for player in self._bettors:
+            player.prompt = None
+            player.stop_decision_timers()
+        for span in self._bettors.values():
+            span.end()
+        self._bettors = {}
+        for player in self._round_players:
+            player.prompt = None
+            player.stop_decision_timers()
+        if self._betting_timer is not None:
+            self._betting_timer.cancel()
+            self._betting_timer = None
+
+        self._round = None
+        self._round_players = []
+        self._paid_seats = set()
+        self._bets = {}
+        self._round_started_at = None
+        self._phase = None
+        for span in (self._decisions_span, self._phase_span, self._round_span):
+            span.end()
+        self._decisions_span = self._phase_span = self._round_span = tracing.NO_SPAN
+        for player in [player for player in self.players if player.remaining_money == 0]:
+            logger.info("%s has no money left, ending his connection", player.get_player_name)
+            self._tell(player, "You have no money left, goodbye")
+            self._end_connection_with_player(player.id)
+        self._outbox.table_changed()
+        self._outbox.flush()
+
+        if self.players:
+            self._schedule_round(self._inter_round_delay)
+        else:
+            self.start_idle_timer()
+
+    def _abort_round(self):
+        if self._round_started_at is not None and self._round_timer is None:
+            self._refund_bets()
+            self._end_round(completed=False)
+
+    def _refund_bets(self):
+        """Gives the players back the bets the round took from them and didn't pay out yet"""
+        round_state = self._round
+        if round_state is not None:
+            bets = [
+                (player, round_state.bets[seat])
+                for seat, player in enumerate(self._round_players)
+                if seat not in self._paid_seats
+            ]
+        else:
+            bets = self._bets.items()
+        for player, bet in bets:
+            logger.info("Returning the %d$ bet of %s", bet, player.get_player_name)
+            self._tell(player, "The round was cancelled, you get your %d$ bet back" % bet)
+            player.get_money(bet)
+
+    def table_state(self):
+        """The table as plain data, like BlackJackGameBase.table_state"""
+        round_state = self._round
+        dealer_cards = list(round_state.dealers_hand.codes) if round_state is not None else []
+        if len(dealer_cards) == 2 and not round_state.hole_card_revealed and self._phase in (
+                RoundPhases.DEAL,
+                RoundPhases.DECISIONS,
+        ):
+            dealer_cards[1] = None
+
+        round_seats = {player: seat for seat, player in enumerate(self._round_players)}
+        seats = {}
+        for seat, player in enumerate(self.players):
+            round_seat = round_seats.get(player)
+            seats[player.id] = {
+                "seat": seat,
+                "name": player.get_player_name,
+                "money": player.remaining_money,
+                "bet": round_state.bets[round_seat] if round_seat is not None else self._bets.get(player, 0),
+                "cards": list(round_state.hands[round_seat].codes) if round_seat is not None else [],
+            }
+        return {
+            "phase": self._phase.name if self._phase is not None else None,
+            "dealer": dealer_cards,
+            "seats": seats,
+        }
+
+    def snapshot(self):
+        """The room as plain data: its shoe, its players and their prompts, the bets placed and the round's
+        RoundState"""
+        return {
+            "room": self.room_number,
+            "phase": self._phase.name if self._phase is not None else None,
+            "shoe": self._shoe.to_dict(),
+            "players": [
+                {
+                    "sid": player.id,
+                    "name": player.get_player_name,
+                    "money": player.remaining_money,
+                    "bet": self._bets.get(player),
+                    "prompt": _prompt_as_dict(player.prompt) if player.prompt is not None else None,
+                }
+                for player in self.players
+            ],
+            "round": self._round.to_dict() if self._round is not None else None,
+            "round_players": [player.id for player in self._round_players],
+            "paid_seats": sorted(self._paid_seats),
+        }
+
+    def _publish_table_state(self):
+        # The state is taken now, when the outbox cuts its frame, and published when the frame is sent
+        return self._state_channel.publish(self.table_state(), [player.id for player in self.players])
+
+    def acknowledge_table_state(self, sid: str, seq: int) -> None:
+        self._state_channel.acknowledge(sid, seq)
+
+    async def send_table_state_snapshot(self, sid: str) -> None:
+        self._state_channel.forget(sid)
+        published_seq = self._state_channel.seq
+        await self._outbox.flush()  # If the table changed, publishing it sends the snapshot
+        if self._state_channel.seq == published_seq:
+            await self._state_channel.send_snapshot(sid)
+
+
+def _prompt_as_dict(prompt):
+    return {
+        "id": prompt.id,
+        "kind": prompt.kind.name,
+        "allowed_actions": [action.name for action in prompt.allowed_actions or ()],
+        "default_action": prompt.default_action.name,
+    }
 
 
 if __name__ == '__main__':
-    logging.info("******************************Starting server******************************")
-    app.run(host='localhost', port=8000, auto_reload=True)
+    parser = argparse.ArgumentParser(description="Run the blackjack server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--slow-callback-threshold",
+        type=float,
+        default=loop_monitor.DEFAULT_SLOW_CALLBACK_THRESHOLD,
+        help="Seconds a callback can run before it is reported as slow",
+    )
+    parser.add_argument("--slow-callback-log", help="Also write the slow callbacks to this size-rotated file")
+    parser.add_argument("--max-rooms", type=int, default=DEFAULT_LIMITS.max_rooms)
+    parser.add_argument("--max-seated-players", type=int, default=DEFAULT_LIMITS.max_seated_players)
+    parser.add_argument(
+        "--room-idle-ttl",
+        type=float,
+        default=DEFAULT_LIMITS.room_idle_ttl,
+        help="Seconds a room without players stays open",
+    )
+    log_setup.add_arguments(parser)
+    tracing.add_arguments(parser)
+    hand_history.add_arguments(parser)
+    args = parser.parse_args()
+
+    log_listener = log_setup.setup_logging_from_arguments(args)
+    slow_callback_log_listener = None
+    if args.slow_callback_log:
+        slow_callback_log_listener = log_setup.add_rotating_file(loop_monitor.__name__, args.slow_callback_log)
+    event_loop_monitor = loop_monitor.LoopMonitor(slow_callback_threshold=args.slow_callback_threshold)
+    limits = ServerLimits(args.max_rooms, args.max_seated_players, args.room_idle_ttl)
+    tracing.enable_from_arguments(args)
+    hand_history.enable_from_arguments(args)
+    try:
+        logger.info("******************************Starting server******************************")
+        app.run(host=args.host, port=args.port, auto_reload=registry is None)
+    finally:
+        hand_history.disable()
+        tracing.disable()
+        if slow_callback_log_listener is not None:
+            slow_callback_log_listener.stop()
+        log_listener.stop()
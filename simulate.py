@@ -0,0 +1,183 @@
+"""Monte Carlo simulation of a playing strategy with the headless engine.
+
+The hands are split into fixed size shards. Each shard is played on its own shoe, seeded from the simulation seed and
+the shard's index, and the shards are spread over a process pool. The results only depend on the seed, not on the
+number of workers.
+
+Usage: python simulate.py --strategy basic --rules default --hands 1000000 --workers 4 --seed 1
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import time
+
+from cards import Shoe
+from engine import BlackJackEngine, Outcomes, TABLE_RULES
+from strategies import STRATEGIES
+
+HANDS_PER_SHARD = 50000
+BET = 1
+
+
+class SimulationStats(object):
+    """Sums over the played hands. Net results are in units of the initial bet."""
+
+    def __init__(self):
+        self.hands = 0
+        self.rounds = 0
+        self.total_bet = 0  # Including the extra bets of double downs
+        self.net = 0
+        self.net_squared = 0
+        self.doubles = 0
+        self.dealer_rounds = 0  # Rounds where the dealer had to draw
+        self.dealer_busts = 0
+        self.outcomes = {outcome.name: 0 for outcome in Outcomes}
+        self.payouts = {outcome.name: 0 for outcome in Outcomes}
+
+    def add_round(self, result):
+        self.rounds += 1
+        if result.dealer_drew:
+            self.dealer_rounds += 1
+            self.dealer_busts += result.dealer_bust
+
+        for seat in result.seats:
+            net = (seat.payout - seat.bet) / BET
+            self.hands += 1
+            self.total_bet += seat.bet
+            self.net += net
+            self.net_squared += net * net
+            self.doubles += seat.bet != BET
+            self.outcomes[seat.outcome.name] += 1
+            self.payouts[seat.outcome.name] += seat.payout
+
+    def merge(self, other):
+        for attribute in (
+                "hands", "rounds", "total_bet", "net", "net_squared", "doubles", "dealer_rounds", "dealer_busts"
+        ):
+            setattr(self, attribute, getattr(self, attribute) + getattr(other, attribute))
+        for outcome in self.outcomes:
+            self.outcomes[outcome] += other.outcomes[outcome]
+            self.payouts[outcome] += other.payouts[outcome]
+        return self
+
+    @property
+    def expected_value(self):
+        return self.net / self.hands
+
+    @property
+    def house_edge(self):
+        return -self.expected_value
+
+    @property
+    def variance(self):
+        return self.net_squared / self.hands - self.expected_value ** 2
+
+    @property
+    def standard_error(self):
+        return math.sqrt(self.variance / self.hands)
+
+    def as_dict(self):
+        return {
+            "hands": self.hands,
+            "rounds": self.rounds,
+            "house_edge": self.house_edge,
+            "standard_error": self.standard_error,
+            "variance": self.variance,
+            "total_bet": self.total_bet,
+            "net": self.net,
+            "double_rate": self.doubles / self.hands,
+            "player_bust_rate": self.outcomes[Outcomes.BUST.name] / self.hands,
+            "dealer_bust_rate": self.dealer_busts / self.dealer_rounds if self.dealer_rounds else 0,
+            "outcome_rates": {outcome: count / self.hands for outcome, count in self.outcomes.items()},
+            "payouts": dict(self.payouts),
+        }
+
+
+def simulate_shard(strategy_name, rules_name, num_of_hands, num_of_seats, seed, shard_index):
+    rules = TABLE_RULES[rules_name]
+    strategy = STRATEGIES[strategy_name]
+    shoe = Shoe(num_of_decks=rules.num_of_decks, penetration=rules.penetration, seed="%s:%d" % (seed, shard_index))
+    engine = BlackJackEngine(shoe)
+    stats = SimulationStats()
+
+    full_table = [BET] * num_of_seats
+    for _ in range(num_of_hands // num_of_seats):
+        stats.add_round(engine.play_round(full_table, strategy))
+    if num_of_hands % num_of_seats:
+        stats.add_round(engine.play_round([BET] * (num_of_hands % num_of_seats), strategy))
+
+    return stats
+
+
+def _simulate_shard_star(args):
+    return simulate_shard(*args)
+
+
+def simulate(strategy_name, rules_name, num_of_hands, num_of_workers=1, num_of_seats=1, seed=0):
+    shards = [
+        (strategy_name, rules_name, min(HANDS_PER_SHARD, num_of_hands - first_hand), num_of_seats, seed, shard_index)
+        for shard_index, first_hand in enumerate(range(0, num_of_hands, HANDS_PER_SHARD))
+    ]
+
+    if num_of_workers == 1:
+        shard_results = map(_simulate_shard_star, shards)
+        return _merge_in_order(shard_results)
+
+    with multiprocessing.Pool(processes=num_of_workers) as pool:
+        return _merge_in_order(pool.imap(_simulate_shard_star, shards))
+
+
+def _merge_in_order(shard_results):
+    # Shards are always merged in the same order, so the float sums don't depend on the pool's scheduling
+    stats = SimulationStats()
+    for shard_stats in shard_results:
+        stats.merge(shard_stats)
+    return stats
+
+
+def _print_report(stats, elapsed_seconds):
+    report = stats.as_dict()
+    print("Hands:            %d (%d rounds)" % (report["hands"], report["rounds"]))
+    print("House edge:       %.4f%% (+/- %.4f%%)" % (report["house_edge"] * 100, report["standard_error"] * 100))
+    print("Variance:         %.4f" % report["variance"])
+    print("Player bust rate: %.4f%%" % (report["player_bust_rate"] * 100))
+    print("Dealer bust rate: %.4f%%" % (report["dealer_bust_rate"] * 100))
+    print("Double down rate: %.4f%%" % (report["double_rate"] * 100))
+    for outcome, rate in report["outcome_rates"].items():
+        print("%-17s %.4f%% of hands, paid %s" % (outcome + ":", rate * 100, report["payouts"][outcome]))
+    print("Took %.2f seconds, %d hands per second" % (elapsed_seconds, report["hands"] / elapsed_seconds))
+
+
+def positive_int(text):
+    """argparse type of the counts, which can't be 0 or negative"""
+    value = int(text)
+    if value <= 0:
+        raise argparse.ArgumentTypeError("%r is not a positive integer" % text)
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a blackjack strategy")
+    parser.add_argument("--strategy", choices=sorted(STRATEGIES), default="basic")
+    parser.add_argument("--rules", choices=sorted(TABLE_RULES), default="default")
+    parser.add_argument("--hands", type=positive_int, default=1000000)
+    parser.add_argument("--workers", type=positive_int, default=os.cpu_count())
+    parser.add_argument("--seats", type=positive_int, default=1, help="Players at the table")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    stats = simulate(args.strategy, args.rules, args.hands, args.workers, args.seats, args.seed)
+    elapsed_seconds = time.perf_counter() - start
+
+    if args.json:
+        print(json.dumps(stats.as_dict(), indent=2))
+    else:
+        _print_report(stats, elapsed_seconds)
+
+
+if __name__ == "__main__":
+    main()
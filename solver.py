@@ -0,0 +1,272 @@
+"""Exact expected values of the player's actions, and the strategy charts they make up.
+
+Computes the EV of HIT, STAND, DOUBLE and SURRENDER for a player hand against a dealer upcard, given the exact
+composition of the cards left in the shoe, under the rules and payouts of BlackJackGameBase: the dealer stands on all
+17s and doesn't peek for blackjack, surrender is allowed at any point and there is no double down after hitting.
+
+A composition is a tuple of 10 counts: aces, then 2s to 9s, then ten valued cards. EVs are in units of the initial
+bet. The dealer's final outcome distributions are memoized by (upcard, composition) in a bounded cache shared between
+calls, and the player's hit EVs by (hand, upcard, composition), so building a full chart takes seconds.
+
+Usage: python solver.py --decks 6
+"""
+import argparse
+import functools
+import time
+
+import numpy as np
+
+from cards import (
+    Actions,
+    HARD_CARD_VALUES,
+    ALL_CARD_RANKS,
+    SAME_AS_THE_BET,
+    ONE_AND_A_HALF_TIMES_THE_BET,
+    TWICE_AS_THE_BET,
+    Card,
+    Suites,
+)
+from engine import SURRENDER_MULTIPLIER
+from strategies import (
+    ChartStrategy,
+    HIT,
+    STAND,
+    SURRENDER,
+    DOUBLE_OR_HIT,
+    DOUBLE_OR_STAND,
+    NUM_OF_UPCARDS,
+)
+
+NUM_OF_CARD_VALUES = 10
+DEALER_CACHE_SIZE = 2 ** 18
+PLAYER_CACHE_SIZE = 2 ** 18
+
+# Net results of a round, in units of the bet
+WIN = TWICE_AS_THE_BET - 1
+TIE = SAME_AS_THE_BET - 1
+LOSE = -1
+NATURAL = ONE_AND_A_HALF_TIMES_THE_BET - 1
+SURRENDERED = SURRENDER_MULTIPLIER - 1
+
+DEALER_STANDS_ON = 17
+_BUST = 21 - DEALER_STANDS_ON + 1  # index of the bust probability in a dealer distribution
+
+
+def composition_index(card):
+    """Index of a card in a composition: 0 for an ace, value - 1 otherwise"""
+    return HARD_CARD_VALUES[card.code] - 1
+
+
+def shoe_composition(num_of_decks):
+    cards_of_each_value = [0] * NUM_OF_CARD_VALUES
+    for rank in ALL_CARD_RANKS:
+        cards_of_each_value[composition_index(Card(Suites.SPADES, rank))] += 4 * num_of_decks
+    return tuple(cards_of_each_value)
+
+
+def remove_cards(composition, cards):
+    composition = list(composition)
+    for card in cards:
+        index = composition_index(card)
+        if composition[index] == 0:
+            raise ValueError("No %s left in the composition" % card)
+        composition[index] -= 1
+    return tuple(composition)
+
+
+def _remove(composition, index):
+    return composition[:index] + (composition[index] - 1,) + composition[index + 1:]
+
+
+def _value(hard_total, has_ace):
+    return hard_total + 10 if has_ace and hard_total + 10 <= 21 else hard_total
+
+
+@functools.lru_cache(maxsize=NUM_OF_CARD_VALUES)
+def _dealer_draws(upcard_index):
+    """Every multiset of cards a dealer showing upcard_index can end up drawing (the hole card included).
+
+    Returns (draws, num_of_orders, outcomes): draws[m] is the multiset as counts per card value, num_of_orders[m] the
+    number of orders the dealer can draw it in and outcomes[m] the index of the dealer's final outcome. Drawing a
+    given order of the multiset from a composition C of N cards has probability prod(C_i falling M_i) / (N falling |M|)
+    whatever the order, which makes the dealer's distribution a short vector computation for any composition.
+    """
+    num_of_orders = {}
+    counts = [0] * NUM_OF_CARD_VALUES
+
+    def draw(hard_total, has_ace):
+        value = _value(hard_total, has_ace)
+        if hard_total > 21 or value >= DEALER_STANDS_ON:
+            outcome = _BUST if hard_total > 21 else value - DEALER_STANDS_ON
+            key = (tuple(counts), outcome)
+            num_of_orders[key] = num_of_orders.get(key, 0) + 1
+            return
+        for index in range(NUM_OF_CARD_VALUES):
+            counts[index] += 1
+            draw(hard_total + index + 1, has_ace or index == 0)
+            counts[index] -= 1
+
+    draw(upcard_index + 1, upcard_index == 0)
+
+    keys = list(num_of_orders)
+    return (
+        np.array([draws for draws, _ in keys], dtype=np.intp),
+        np.array([num_of_orders[key] for key in keys], dtype=np.float64),
+        np.array([outcome for _, outcome in keys], dtype=np.intp),
+    )
+
+
+@functools.lru_cache(maxsize=DEALER_CACHE_SIZE)
+def dealer_distribution(upcard_index, composition):
+    """Probabilities of a dealer showing the card at upcard_index, drawing from composition, ending with 17, 18, 19,
+    20, 21 or busting"""
+    draws, num_of_orders, outcomes = _dealer_draws(upcard_index)
+    max_num_of_draws = draws.sum(axis=1).max()
+
+    # falling_factorials[i, k] = C_i * (C_i - 1) * ... * (C_i - k + 1), the ways to draw k cards of value i in order
+    steps = np.arange(max_num_of_draws)
+    remaining = np.maximum(np.array(composition, dtype=np.float64)[:, None] - steps, 0)
+    falling_factorials = np.ones((NUM_OF_CARD_VALUES, max_num_of_draws + 1))
+    falling_factorials[:, 1:] = np.cumprod(remaining, axis=1)
+
+    num_of_cards = sum(composition)
+    total_falling_factorials = np.ones(max_num_of_draws + 1)
+    total_falling_factorials[1:] = np.cumprod(np.maximum(float(num_of_cards) - steps, 0))
+
+    ways = falling_factorials[np.arange(NUM_OF_CARD_VALUES), draws].prod(axis=1)
+    probabilities = num_of_orders * ways / total_falling_factorials[draws.sum(axis=1)]
+    return tuple(np.bincount(outcomes, weights=probabilities, minlength=_BUST + 1).tolist())
+
+
+def _stand_ev(player_value, upcard_index, composition):
+    distribution = dealer_distribution(upcard_index, composition)
+    ev = distribution[_BUST] * WIN
+    for outcome in range(_BUST):
+        dealer_value = DEALER_STANDS_ON + outcome
+        if player_value > dealer_value:
+            ev += distribution[outcome] * WIN
+        elif player_value == dealer_value:
+            ev += distribution[outcome] * TIE
+        else:
+            ev += distribution[outcome] * LOSE
+    return ev
+
+
+@functools.lru_cache(maxsize=PLAYER_CACHE_SIZE)
+def _hit_ev(hard_total, has_ace, upcard_index, composition):
+    num_of_cards = sum(composition)
+    ev = 0
+    for index, count in enumerate(composition):
+        if count == 0:
+            continue
+        new_hard_total = hard_total + index + 1
+        if new_hard_total > 21:
+            ev += count / num_of_cards * LOSE
+        else:
+            ev += count / num_of_cards * _best_ev_after_hit(
+                new_hard_total, has_ace or index == 0, upcard_index, _remove(composition, index)
+            )
+    return ev
+
+
+def _best_ev_after_hit(hard_total, has_ace, upcard_index, composition):
+    return max(
+        _stand_ev(_value(hard_total, has_ace), upcard_index, composition),
+        _hit_ev(hard_total, has_ace, upcard_index, composition),
+        SURRENDERED,
+    )
+
+
+def _double_ev(hard_total, has_ace, upcard_index, composition):
+    num_of_cards = sum(composition)
+    ev = 0
+    for index, count in enumerate(composition):
+        if count == 0:
+            continue
+        new_hard_total = hard_total + index + 1
+        if new_hard_total > 21:
+            ev += count / num_of_cards * LOSE
+        else:
+            new_value = _value(new_hard_total, has_ace or index == 0)
+            ev += count / num_of_cards * _stand_ev(new_value, upcard_index, _remove(composition, index))
+    return 2 * ev
+
+
+def action_evs(player_cards, dealer_upcard, composition):
+    """{Action: EV} of the first decision on player_cards. composition is the shoe before the cards were dealt."""
+    composition = remove_cards(composition, list(player_cards) + [dealer_upcard])
+    hard_total = sum(HARD_CARD_VALUES[card.code] for card in player_cards)
+    has_ace = any(card.rank == "A" for card in player_cards)
+    upcard_index = composition_index(dealer_upcard)
+
+    return {
+        Actions.HIT: _hit_ev(hard_total, has_ace, upcard_index, composition),
+        Actions.STAND: _stand_ev(_value(hard_total, has_ace), upcard_index, composition),
+        Actions.DOUBLE: _double_ev(hard_total, has_ace, upcard_index, composition),
+        Actions.SURRENDER: SURRENDERED,
+    }
+
+
+def best_action(player_cards, dealer_upcard, composition, allowed_actions=(Actions.HIT, Actions.STAND,
+                                                                             Actions.DOUBLE, Actions.SURRENDER)):
+    evs = action_evs(player_cards, dealer_upcard, composition)
+    return max(allowed_actions, key=lambda action: evs[action])
+
+
+def _representative_hand(total, is_soft):
+    """Two cards making up a chart row. Different hands with the same total only differ by the removed cards."""
+    if is_soft:
+        ranks = ("A", "A") if total == 12 else ("A", total - 11)
+    elif total >= 12:
+        ranks = (10, total - 10)
+    elif total >= 7:
+        ranks = (total - 5, 5) if total - 5 != 5 else (6, 4)
+    else:
+        ranks = (2, total - 2)
+    return [Card(Suites.HEARTS, rank) for rank in ranks]
+
+
+def _upcard_of_column(column):
+    return Card(Suites.SPADES, "A" if column == NUM_OF_UPCARDS - 1 else column + 2)
+
+
+def _chart_code(evs):
+    first_decision = max(evs, key=evs.get)
+    if first_decision != Actions.DOUBLE:
+        return {Actions.HIT: HIT, Actions.STAND: STAND, Actions.SURRENDER: SURRENDER}[first_decision]
+    return DOUBLE_OR_HIT if evs[Actions.HIT] >= max(evs[Actions.STAND], SURRENDERED) else DOUBLE_OR_STAND
+
+
+def build_strategy(composition, name="solver"):
+    """A ChartStrategy playing the best first decision of each row's representative hand against each upcard"""
+    hard_chart, soft_chart = {}, {}
+    for chart, is_soft, totals in ((hard_chart, False, range(4, 21)), (soft_chart, True, range(12, 21))):
+        for total in totals:
+            row = ""
+            for column in range(NUM_OF_UPCARDS):
+                evs = action_evs(_representative_hand(total, is_soft), _upcard_of_column(column), composition)
+                row += _chart_code(evs)
+            chart[total] = row
+    hard_chart[21] = soft_chart[21] = STAND * NUM_OF_UPCARDS
+    return ChartStrategy(name, hard_chart=hard_chart, soft_chart=soft_chart)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the exact strategy chart for a full shoe")
+    parser.add_argument("--decks", type=int, default=6)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    strategy = build_strategy(shoe_composition(args.decks), name="solver-%d-decks" % args.decks)
+    elapsed_seconds = time.perf_counter() - start
+
+    hard_rows, soft_rows = strategy.rows
+    print("#      23456789TA")
+    for title, rows, totals in (("hard", hard_rows, range(4, 22)), ("soft", soft_rows, range(12, 22))):
+        for total in totals:
+            print("%s %2d %s" % (title, total, rows[total]))
+    print("Built in %.2f seconds" % elapsed_seconds)
+
+
+if __name__ == "__main__":
+    main()
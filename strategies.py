@@ -0,0 +1,137 @@
+"""Fixed playing strategies for bots and simulations.
+
+A strategy is a callable strategy(hand, dealer_upcard, allowed_actions) -> Actions, as BlackJackEngine expects.
+The strategies here are charts, like printed basic strategy cards: one row per player total (hard or soft) and one
+column per dealer upcard (2-9, 10, Ace). Each cell is one of CHART_CODES.
+"""
+from cards import Actions, HARD_CARD_VALUES
+
+HIT = "H"
+STAND = "S"
+DOUBLE_OR_HIT = "D"  # Double down if allowed, otherwise hit
+DOUBLE_OR_STAND = "X"  # Double down if allowed, otherwise stand
+SURRENDER = "R"
+CHART_CODES = (HIT, STAND, DOUBLE_OR_HIT, DOUBLE_OR_STAND, SURRENDER)
+
+NUM_OF_UPCARDS = 10  # 2-9, 10 and Ace
+MAX_HAND_TOTAL = 21
+
+
+def upcard_index(card):
+    """Chart column of a dealer upcard: 0 for a 2 ... 8 for a 10 or face card, 9 for an Ace"""
+    hard_value = HARD_CARD_VALUES[card.code]
+    return NUM_OF_UPCARDS - 1 if hard_value == 1 else hard_value - 2
+
+
+class ChartStrategy(object):
+    def __init__(self, name, hard_chart, soft_chart):
+        """hard_chart and soft_chart map a hand total to a row of NUM_OF_UPCARDS chart codes. Totals missing from a
+        chart are played like the closest total in it."""
+        self._name = name
+        self._rows = (self._full_chart(hard_chart), self._full_chart(soft_chart))
+
+        # Resolved Actions for each cell, with and without double down allowed
+        self._first_decision = tuple(
+            tuple(tuple(self._resolve(code, True) for code in row) for row in rows) for rows in self._rows
+        )
+        self._later_decision = tuple(
+            tuple(tuple(self._resolve(code, False) for code in row) for row in rows) for rows in self._rows
+        )
+
+    def __repr__(self):
+        return "<ChartStrategy %s>" % self._name
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def rows(self):
+        """(hard rows, soft rows), each indexed by hand total 0-21 and holding a string of chart codes"""
+        return self._rows
+
+    @staticmethod
+    def _full_chart(chart):
+        for total, row in chart.items():
+            if len(row) != NUM_OF_UPCARDS or any(code not in CHART_CODES for code in row):
+                raise ValueError("Bad chart row for %d: %r" % (total, row))
+        lowest, highest = min(chart), max(chart)
+        return tuple(chart[min(max(total, lowest), highest)] for total in range(MAX_HAND_TOTAL + 1))
+
+    @staticmethod
+    def _resolve(code, can_double):
+        if code == HIT:
+            return Actions.HIT
+        if code == STAND:
+            return Actions.STAND
+        if code == SURRENDER:
+            return Actions.SURRENDER
+        if can_double:
+            return Actions.DOUBLE
+        return Actions.HIT if code == DOUBLE_OR_HIT else Actions.STAND
+
+    def decide(self, total, is_soft, upcard_column, can_double):
+        if total > MAX_HAND_TOTAL:
+            return Actions.STAND
+        decisions = self._first_decision if can_double else self._later_decision
+        return decisions[is_soft][total][upcard_column]
+
+    def __call__(self, hand, dealer_upcard, allowed_actions):
+        action = self.decide(
+            hand.value, hand.is_soft, upcard_index(dealer_upcard), Actions.DOUBLE in allowed_actions
+        )
+        if action not in allowed_actions:
+            return Actions.STAND
+        return action
+
+
+def _uniform_chart(first_total, last_total, code_below, code_from):
+    """A chart that plays code_below under last_total and code_from from it on, whatever the dealer shows"""
+    return {
+        total: (code_below if total < last_total else code_from) * NUM_OF_UPCARDS
+        for total in range(first_total, MAX_HAND_TOTAL + 1)
+    }
+
+
+#               Dealer upcard: 23456789TA
+BASIC_STRATEGY = ChartStrategy(
+    "basic",
+    hard_chart={
+        8: "HHHHHHHHHH",
+        9: "HDDDDHHHHH",
+        10: "DDDDDDDDHH",
+        11: "DDDDDDDDDH",
+        12: "HHSSSHHHHH",
+        13: "SSSSSHHHHH",
+        14: "SSSSSHHHHH",
+        15: "SSSSSHHHRH",
+        16: "SSSSSHHRRR",
+        17: "SSSSSSSSSS",
+    },
+    soft_chart={
+        12: "HHHHHHHHHH",
+        13: "HHHDDHHHHH",
+        14: "HHHDDHHHHH",
+        15: "HHDDDHHHHH",
+        16: "HHDDDHHHHH",
+        17: "HDDDDHHHHH",
+        18: "SXXXXSSHHH",
+        19: "SSSSSSSSSS",
+    },
+)
+
+MIMIC_THE_DEALER = ChartStrategy(
+    "mimic-dealer", hard_chart=_uniform_chart(2, 17, HIT, STAND), soft_chart=_uniform_chart(12, 17, HIT, STAND)
+)
+
+NEVER_BUST = ChartStrategy(
+    "never-bust", hard_chart=_uniform_chart(2, 12, HIT, STAND), soft_chart=_uniform_chart(12, 18, HIT, STAND)
+)
+
+ALWAYS_STAND = ChartStrategy(
+    "always-stand", hard_chart=_uniform_chart(2, 2, HIT, STAND), soft_chart=_uniform_chart(12, 12, HIT, STAND)
+)
+
+STRATEGIES = {
+    strategy.name: strategy for strategy in (BASIC_STRATEGY, MIMIC_THE_DEALER, NEVER_BUST, ALWAYS_STAND)
+}
@@ -1,14 +1,45 @@
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import logging
+import os
+import pickle
+import threading
+import time
 from unittest import mock
-from blackjack_base import (
+from batch_simulate import BatchTableSimulator
+import benchmarks
+import blackjack_base
+from cards import (
     Card,
+    CARDS,
+    card_from_code,
     Deck,
+    Hand,
     Suites,
     Actions,
+    Shoe,
+    RoundPhases,
     NoMoreCardsInDeckError,
     CardAlreadyInDeckError,
     TWICE_AS_THE_BET,
 )
-from offline import BlackJackGameOffLine, Player, OffLinePlayer
+import cluster
+from engine import BlackJackEngine, InvalidRoundEventError, Outcomes, RoundState
+import hand_history
+import loadgen
+import loop_monitor
+import log_setup
+import metrics
+from offline import BlackJackGameOffLine, OffLinePlayer
+import protocol
+import server
+from simulate import positive_int, simulate
+import solver
+from strategies import BASIC_STRATEGY
+import tracing
 
 
 def test_cards():
@@ -58,7 +89,57 @@ def test_get_deck_game_value_reduces_value_of_ace_if_bust(get_input_from_user_mo
     assert game._get_deck_game_value(game.players[3].cards) == 25
 
 
-@mock.patch.object(Deck, "draw_card")
+def test_hand_tracks_value_as_cards_are_taken_and_drawn():
+    hand = Hand()
+    hand.take_card(Card(suit=Suites.HEARTS, rank="A"))
+    hand.take_card(Card(suit=Suites.SPADES, rank=6))
+    assert hand.value == 17
+    assert hand.is_soft
+
+    hand.take_card(Card(suit=Suites.CLUBS, rank=9))
+    assert hand.value == 16
+    assert not hand.is_soft
+    assert not hand.is_bust
+
+    hand.take_card(Card(suit=Suites.CLUBS, rank="K"))
+    assert hand.is_bust
+
+    hand.draw_card()
+    assert hand.value == 16
+
+    hand.empty_all_cards()
+    assert hand.value == 0
+
+
+def test_hand_blackjack_needs_two_cards():
+    hand = Hand()
+    hand.take_card(Card(suit=Suites.HEARTS, rank="A"))
+    hand.take_card(Card(suit=Suites.SPADES, rank="Q"))
+    assert hand.is_blackjack
+
+    hand = Hand()
+    for rank in (7, 7, 7):
+        hand.take_card(Card(suit=Suites.HEARTS, rank=rank))
+    assert hand.value == 21
+    assert not hand.is_blackjack
+
+
+@mock.patch.object(BlackJackGameOffLine, "get_input_from_user")
+def test_hand_value_matches_get_deck_game_value_for_every_composition(get_input_from_user_mock):
+    get_input_from_user_mock.side_effect = ["1", "Test Player", 0]
+    game = BlackJackGameOffLine()
+    one_card_of_each_value = [Card(suit=Suites.SPADES, rank=rank) for rank in list(range(2, 11)) + ["A"]]
+
+    for num_of_cards in range(2, 8):
+        for cards in itertools.combinations_with_replacement(one_card_of_each_value, num_of_cards):
+            hand = Hand()
+            for card in cards:
+                hand.take_card(card)
+            assert hand.value == game._get_deck_game_value(hand), cards
+            assert hand.is_bust == (game._get_deck_game_value(hand) > 21), cards
+
+
+@mock.patch.object(Shoe, "draw_card")
 @mock.patch.object(OffLinePlayer, "_get_input_from_user")
 @mock.patch.object(BlackJackGameOffLine, "get_input_from_user")
 def test_handle_naturals_before_players_can_decide_on_first_round(
@@ -78,12 +159,12 @@ def test_handle_naturals_before_players_can_decide_on_first_round(
         Card(suit=Suites.HEARTS, rank=5),
     ]
     game = BlackJackGameOffLine()
-    game.play_round()
+    asyncio.run(game.play_round())
     assert game.players[0].remaining_money == 750
 
 
 @mock.patch.object(OffLinePlayer, "_get_input_from_user")
-@mock.patch.object(Deck, "draw_card")
+@mock.patch.object(Shoe, "draw_card")
 @mock.patch.object(BlackJackGameOffLine, "get_input_from_user")
 def test_players_have_to_bet_or_skip(
     get_input_from_user_blackjack_mock, draw_card_mock, _get_input_from_user_mock
@@ -104,12 +185,12 @@ def test_players_have_to_bet_or_skip(
         Card(suit=Suites.HEARTS, rank=5),
     ]
     game = BlackJackGameOffLine()
-    game.play_round()
+    asyncio.run(game.play_round())
     assert game.players[0].remaining_money == 750
 
 
 @mock.patch.object(OffLinePlayer, "_get_input_from_user")
-@mock.patch.object(Deck, "draw_card")
+@mock.patch.object(Shoe, "draw_card")
 @mock.patch.object(BlackJackGameOffLine, "get_input_from_user")
 def test_game_full_round(
     get_input_from_blackjack_user, draw_card_mock, _get_input_from_user_mock
@@ -156,7 +237,7 @@ def test_game_full_round(
     ]
     # Hit one card for each player, then stand
     game = BlackJackGameOffLine()
-    game.play_round()
+    asyncio.run(game.play_round())
 
     assert game.players[0].remaining_money == 0
     assert game.players[1].remaining_money == 100
@@ -181,6 +262,28 @@ def test_cards_not_equal():
     assert card_a != card_b
 
 
+def test_cards_are_interned():
+    assert Card(suit=Suites.SPADES, rank="A") is Card(suit=Suites.SPADES, rank="A")
+    assert Card(suit=Suites.HEARTS, rank="8") is Card(suit=Suites.HEARTS, rank=8)
+
+
+def test_card_codes_round_trip():
+    deck = Deck()
+    deck.fill_deck_with_52_cards()
+    assert [card.code for card in deck.cards] == list(range(52))
+    for card in deck.cards:
+        assert CARDS[card.code] is card
+        assert pickle.loads(pickle.dumps(card)) is card
+
+
+def test_invalid_card_rank_raises_value_error():
+    try:
+        Card(suit=Suites.SPADES, rank=11)
+    except ValueError:
+        return
+    raise Exception("Should not reach here")
+
+
 def test_deck_shuffle_does_not_give_same_card():
     deck = Deck()
     deck.reset_deck_and_shuffle()
@@ -238,6 +341,43 @@ def test_deck_draw_more_than_52_raises_NoMoreCardsInDeckError():
     raise Exception("FUCK YOU! THIS SHOULD'NT HAVE HAPPENED")
 
 
+def test_shoe_holds_all_cards_of_all_decks():
+    shoe = Shoe(num_of_decks=2, penetration=1)
+    drawn_codes = sorted(shoe.draw_card().code for _ in range(104))
+    assert drawn_codes == sorted(list(range(52)) * 2)
+    assert len(shoe) == 0
+
+
+def test_shoe_with_same_seed_deals_the_same_cards():
+    shoe_a = Shoe(seed=7)
+    shoe_b = Shoe(seed=7)
+    assert [shoe_a.draw_card() for _ in range(30)] == [shoe_b.draw_card() for _ in range(30)]
+
+
+def test_shoe_reshuffles_only_after_cut_card():
+    shoe = Shoe(num_of_decks=1, penetration=0.5)
+
+    for _ in range(25):
+        shoe.draw_card()
+    assert not shoe.cut_card_reached
+    assert not shoe.shuffle_if_cut_card_reached()
+    assert len(shoe) == 27
+
+    shoe.draw_card()
+    assert shoe.cut_card_reached
+    assert shoe.shuffle_if_cut_card_reached()
+    assert len(shoe) == 52
+
+
+def test_shoe_rejects_bad_configuration():
+    for kwargs in ({"num_of_decks": 0}, {"num_of_decks": 9}, {"penetration": 0}, {"penetration": 1.5}):
+        try:
+            Shoe(**kwargs)
+        except ValueError:
+            continue
+        raise Exception("Should not reach here")
+
+
 def test_card_player_take_card_and_draw():
     player = OffLinePlayer("player 1", id="foo")
     player.take_card(Card(suit=Suites.SPADES, rank="A"))
@@ -314,7 +454,7 @@ def test_pay_player(user_input_mock):
     test_player = game.players[0]
     game._players_bet[test_player] = 100
 
-    game._pay_player(test_player, TWICE_AS_THE_BET)
+    asyncio.run(game._pay_player(test_player, TWICE_AS_THE_BET))
     assert test_player.remaining_money == 200
 
 
@@ -352,7 +492,72 @@ def test_handle_winners_and_losers(user_input_mock):
     for player in game._players_bet:
         game._players_in_round.append(player)
 
-    game._handle_winners_and_losers()
+    asyncio.run(game._handle_winners_and_losers())
+    assert player_a.remaining_money == 200
+    assert player_b.remaining_money == 400
+    assert player_c.remaining_money == 0
+
+
+@mock.patch.object(Shoe, "draw_card")
+def test_naturals_are_paid_once_before_players_can_decide(draw_card_mock):
+    def deal(dealers_second_card):
+        draw_card_mock.side_effect = [
+            Card(suit=Suites.SPADES, rank="A"),
+            Card(suit=Suites.HEARTS, rank=10),
+            Card(suit=Suites.CLUBS, rank="A"),
+            Card(suit=Suites.SPADES, rank="K"),  # Seat 0 has a blackjack
+            Card(suit=Suites.HEARTS, rank=7),
+            dealers_second_card,
+        ]
+        players = [OffLinePlayer("P%d" % seat, id=str(seat)) for seat in range(2)]
+        round_state = RoundState([100, 100])
+        round_state.deal(Shoe())
+        paid_seats = set()
+        messages = blackjack_base.announce_naturals(round_state, players, paid_seats)
+        assert blackjack_base.pay_seats(round_state, players, paid_seats) == []  # Already paid
+        return players, round_state, messages
+
+    players, round_state, messages = deal(Card(suit=Suites.DIAMONDS, rank=8))
+    assert [player.remaining_money for player in players] == [150, 0]
+    assert round_state.seats_in_round == [1]
+    assert messages == [(None, "P0 won 1.5 times his bet"), (players[0], "P0, you won 150$")]
+
+    players, round_state, messages = deal(Card(suit=Suites.DIAMONDS, rank="K"))  # The dealer has a blackjack too
+    assert [player.remaining_money for player in players] == [100, 0]
+    assert messages[1:] == [(None, "P0 is in a tie with the dealer.")]
+
+
+@mock.patch.object(Shoe, "draw_card")
+@mock.patch.object(OffLinePlayer, "get_bet")
+@mock.patch.object(OffLinePlayer, "get_cmd")
+@mock.patch.object(BlackJackGameOffLine, "get_input_from_user")
+def test_offline_round_pays_winners_and_losers(user_input_mock, get_cmd_mock, get_bet_mock, draw_card_mock):
+    user_input_mock.side_effect = [
+        "3",
+        "Test player A",
+        "100",
+        "Test player B",
+        "400",
+        "Test Player C",
+        "500",
+    ]
+    get_cmd_mock.side_effect = [Actions.BET] * 3 + [Actions.STAND] * 3
+    get_bet_mock.side_effect = [100, 400, 500]
+    draw_card_mock.side_effect = [
+        Card(suit=Suites.SPADES, rank=8),
+        Card(suit=Suites.HEARTS, rank=10),
+        Card(suit=Suites.SPADES, rank=2),
+        Card(suit=Suites.SPADES, rank=7),
+        Card(suit=Suites.DIAMONDS, rank=10),  # A has 18
+        Card(suit=Suites.DIAMONDS, rank=7),  # B has 17
+        Card(suit=Suites.DIAMONDS, rank=4),  # C has 6
+        Card(suit=Suites.SPADES, rank=3),
+        Card(suit=Suites.CLUBS, rank=7),  # The dealer draws to 17
+    ]
+    game = BlackJackGameOffLine()
+    player_a, player_b, player_c = game.players
+
+    asyncio.run(game.play_round())
     assert player_a.remaining_money == 200
     assert player_b.remaining_money == 400
     assert player_c.remaining_money == 0
@@ -379,7 +584,7 @@ def test_player_deck_print(get_input_from_user_mock):
 
 @mock.patch.object(OffLinePlayer, "get_bet")
 @mock.patch.object(OffLinePlayer, "_get_input_from_user")
-@mock.patch.object(Deck, "draw_card")
+@mock.patch.object(Shoe, "draw_card")
 @mock.patch.object(BlackJackGameOffLine, "get_input_from_user")
 def test_one_player_wins_and_the_rest_continue_to_play(
     get_input_from_user_blackjack_mock,
@@ -408,26 +613,33 @@ def test_one_player_wins_and_the_rest_continue_to_play(
         Card(suit=Suites.HEARTS, rank=7),
     ]
     game = BlackJackGameOffLine()
-    game.play_round()
+    asyncio.run(game.play_round())
     assert game.players[0].remaining_money == 150
     assert game.players[1].remaining_money == 200
 
 
+@mock.patch.object(Shoe, "draw_card")
 @mock.patch.object(OffLinePlayer, "get_bet")
 @mock.patch.object(OffLinePlayer, "get_cmd")
 @mock.patch.object(BlackJackGameOffLine, "get_input_from_user")
 def test_surrender_gives_back_half_the_money(
-    get_input_from_user_mock, get_cmd_mock, get_bet_mock
+    get_input_from_user_mock, get_cmd_mock, get_bet_mock, draw_card_mock
 ):
     get_input_from_user_mock.side_effect = ["1", "P1", 100]
+    draw_card_mock.side_effect = [
+        Card(suit=Suites.DIAMONDS, rank=10),
+        Card(suit=Suites.SPADES, rank=9),
+        Card(suit=Suites.DIAMONDS, rank=6),
+        Card(suit=Suites.CLUBS, rank="K"),
+    ]
     get_cmd_mock.side_effect = [Actions.BET, Actions.SURRENDER]
     get_bet_mock.side_effect = [100]
     game = BlackJackGameOffLine()
-    game.play_round()
+    asyncio.run(game.play_round())
     assert game.players[0].remaining_money == 50
 
 
-@mock.patch.object(Deck, "draw_card")
+@mock.patch.object(Shoe, "draw_card")
 @mock.patch.object(OffLinePlayer, "_get_input_from_user")
 @mock.patch.object(BlackJackGameOffLine, "get_input_from_user")
 def test_bust_player_is_kicked_from_round(
@@ -446,11 +658,11 @@ def test_bust_player_is_kicked_from_round(
     ]
 
     game = BlackJackGameOffLine()
-    game.play_round()
+    asyncio.run(game.play_round())
     assert game.players[0].remaining_money == 0
 
 
-@mock.patch.object(Deck, "draw_card")
+@mock.patch.object(Shoe, "draw_card")
 @mock.patch.object(OffLinePlayer, "_get_input_from_user")
 @mock.patch.object(BlackJackGameOffLine, "get_input_from_user")
 def test_player_cant_double_down_after_hitting(
@@ -470,6 +682,1045 @@ def test_player_cant_double_down_after_hitting(
     ]
 
     game = BlackJackGameOffLine()
-    game.play_round()
+    asyncio.run(game.play_round())
 
     assert game.players[0].num_of_remaining_cards == 3
+
+
+@mock.patch.object(BlackJackGameOffLine, "get_input_from_user")
+def test_players_who_miss_the_betting_deadline_sit_the_round_out(get_input_from_user_mock):
+    get_input_from_user_mock.side_effect = ["2", "P1", 100, "P2", 100]
+    game = BlackJackGameOffLine()
+    game._betting_deadline = 0.05
+    fast_player, slow_player = game.players
+
+    async def bet(msg, allowed_actions):
+        return Actions.BET
+
+    async def never_answer(msg, allowed_actions):
+        await asyncio.Event().wait()
+
+    async def bet_40():
+        return 40
+
+    fast_player.get_cmd, fast_player.get_bet = bet, bet_40
+    slow_player.get_cmd = never_answer
+
+    asyncio.run(game._take_bets_from_players())
+    assert game._players_bet == {fast_player: 40}
+    assert slow_player.remaining_money == 100
+
+
+def _scripted_strategy(actions):
+    actions = iter(actions)
+    return lambda hand, dealer_upcard, allowed_actions: next(actions)
+
+
+@mock.patch.object(Shoe, "draw_card")
+def test_engine_full_round(draw_card_mock):
+    # Same cards and decisions as test_game_full_round
+    draw_card_mock.side_effect = [
+        Card(suit=Suites.SPADES, rank=2),
+        Card(suit=Suites.HEARTS, rank="J"),
+        Card(suit=Suites.HEARTS, rank="K"),
+        Card(suit=Suites.CLUBS, rank="J"),
+        Card(suit=Suites.SPADES, rank=10),
+        Card(suit=Suites.SPADES, rank=6),
+        Card(suit=Suites.HEARTS, rank=3),
+        Card(suit=Suites.DIAMONDS, rank=6),
+        Card(suit=Suites.CLUBS, rank="K"),
+        Card(suit=Suites.HEARTS, rank=2),
+        Card(suit=Suites.HEARTS, rank=7),
+        Card(suit=Suites.CLUBS, rank=2),
+    ]
+    strategy = _scripted_strategy([Actions.HIT, Actions.HIT, Actions.STAND, Actions.HIT, Actions.STAND])
+
+    result = BlackJackEngine().play_round([100, 100, 100], strategy)
+
+    assert [seat.outcome for seat in result.seats] == [Outcomes.BUST, Outcomes.TIE, Outcomes.WIN]
+    assert [seat.payout for seat in result.seats] == [0, 100, 200]
+    assert result.dealer_value == 18
+    assert result.dealer_upcard == Card(suit=Suites.CLUBS, rank="J")
+
+
+@mock.patch.object(Shoe, "draw_card")
+def test_engine_pays_naturals_and_the_rest_continue_to_play(draw_card_mock):
+    # Same cards and decisions as test_one_player_wins_and_the_rest_continue_to_play
+    draw_card_mock.side_effect = [
+        Card(suit=Suites.CLUBS, rank="A"),
+        Card(suit=Suites.SPADES, rank="Q"),
+        Card(suit=Suites.DIAMONDS, rank=10),
+        Card(suit=Suites.DIAMONDS, rank="K"),
+        Card(suit=Suites.CLUBS, rank="K"),
+        Card(suit=Suites.HEARTS, rank=7),
+    ]
+
+    result = BlackJackEngine().play_round([100, 100], _scripted_strategy([Actions.STAND]))
+
+    assert [seat.outcome for seat in result.seats] == [Outcomes.NATURAL, Outcomes.WIN]
+    assert [seat.payout for seat in result.seats] == [150, 200]
+
+
+@mock.patch.object(Shoe, "draw_card")
+def test_engine_double_down_and_surrender(draw_card_mock):
+    draw_card_mock.side_effect = [
+        Card(suit=Suites.SPADES, rank=5),
+        Card(suit=Suites.HEARTS, rank=10),
+        Card(suit=Suites.DIAMONDS, rank=10),
+        Card(suit=Suites.CLUBS, rank=10),
+        Card(suit=Suites.SPADES, rank=6),
+        Card(suit=Suites.HEARTS, rank=6),
+        Card(suit=Suites.DIAMONDS, rank=6),
+        Card(suit=Suites.CLUBS, rank=7),  # dealer has 17
+        Card(suit=Suites.HEARTS, rank=9),  # first seat doubles down on 11
+    ]
+    strategy = _scripted_strategy([Actions.DOUBLE, Actions.SURRENDER, Actions.DOUBLE])
+
+    result = BlackJackEngine().play_round([10, 10, 10], strategy, bankrolls=[10, 10, 5])
+
+    doubled, surrendered, could_not_double = result.seats
+    assert (doubled.bet, doubled.num_of_cards, doubled.outcome, doubled.payout) == (20, 3, Outcomes.WIN, 40)
+    assert (surrendered.outcome, surrendered.payout) == (Outcomes.SURRENDER, 5)
+    assert (could_not_double.bet, could_not_double.num_of_cards) == (10, 2)
+    assert could_not_double.outcome == Outcomes.LOSE
+
+
+def test_engine_rounds_are_reproducible_from_the_shoe_seed():
+    def hit_until_17(hand, dealer_upcard, allowed_actions):
+        return Actions.HIT if hand.value < 17 else Actions.STAND
+
+    engine_a = BlackJackEngine(Shoe(seed=42))
+    engine_b = BlackJackEngine(Shoe(seed=42))
+    for _ in range(200):
+        assert engine_a.play_round([1, 1, 1], hit_until_17) == engine_b.play_round([1, 1, 1], hit_until_17)
+
+
+def test_hand_history_records_every_engine_round(tmp_path):
+    history = hand_history.HandHistoryWriter(
+        str(tmp_path), segment_max_bytes=hand_history.SEGMENT_HEADER.size + 20 * hand_history.RECORD.size, batch_size=8
+    )
+    engine = BlackJackEngine(Shoe(seed=42), history=history, table_name="table 1")
+    results = [engine.play_round([1, 2, 3], BASIC_STRATEGY, [10, 10, 10]) for _ in range(100)]
+    history.close()
+    assert hand_history.RECORD_DTYPE.itemsize == hand_history.RECORD.size
+    assert history.writer_id == str(os.getpid())
+    assert hand_history.segment_indexes(str(tmp_path), history.writer_id) == [0, 1, 2, 3, 4]
+
+    with hand_history.HandHistoryReader(str(tmp_path)) as reader:
+        records = list(reader)
+        assert len(reader) == len(records) == 100
+        for record, result in zip(records, results):
+            assert record.room == "table 1"
+            assert record.dealer_drew == result.dealer_drew
+            assert [(seat.bet, seat.payout, seat.outcome, seat.num_of_cards) for seat in record.seats] == [
+                (seat.bet, seat.payout, seat.outcome, seat.num_of_cards) for seat in result.seats
+            ]
+            for seat in record.seats:
+                assert len(seat.cards) == seat.num_of_cards
+                assert seat.actions.count(Actions.HIT) + (seat.actions[-1:] == (Actions.DOUBLE,)) == len(seat.cards) - 2
+
+        # The seed and position replay the round's deal: one card per seat, then the dealer's upcard
+        shoe = hand_history.replay_shoe(records[-1])
+        assert bytes(shoe.draw_code() for _ in range(4)) == bytes(seat.cards[0] for seat in records[-1].seats) + \
+            records[-1].dealer_cards[:1]
+
+        arrays = reader.arrays()
+        assert sum(len(array) for array in arrays) == 100
+        assert sum(array["payouts"].sum() for array in arrays) == sum(
+            seat.payout for result in results for seat in result.seats
+        )
+        del arrays
+
+    # Segments are only appended, a new writer starts a new one. It writes its records after flush_interval seconds,
+    # even if no other round comes.
+    history = hand_history.HandHistoryWriter(str(tmp_path), flush_interval=0.02)
+    BlackJackEngine(Shoe(), history=history).play_round([5], BASIC_STRATEGY)
+    time.sleep(0.2)
+    with hand_history.HandHistoryReader(str(tmp_path)) as reader:
+        assert len(reader) == 101
+        assert list(reader)[:100] == records
+    history.close()
+
+
+def test_hand_history_writers_share_a_directory(tmp_path):
+    segment_max_bytes = hand_history.SEGMENT_HEADER.size + 10 * hand_history.RECORD.size
+    writers = [
+        hand_history.HandHistoryWriter(str(tmp_path), segment_max_bytes, batch_size=4, writer_id=writer_id)
+        for writer_id in ("worker_1", "worker_2")
+    ]
+
+    def play(writer):
+        engine = BlackJackEngine(Shoe(seed=1), history=writer, table_name=writer.writer_id)
+        for _ in range(50):
+            engine.play_round([1, 1], BASIC_STRATEGY)
+        writer.close()
+
+    threads = [threading.Thread(target=play, args=(writer,)) for writer in writers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert hand_history.segments(str(tmp_path)) == [
+        (writer_id, index) for writer_id in ("worker_1", "worker_2") for index in range(5)
+    ]
+    with hand_history.HandHistoryReader(str(tmp_path)) as reader:
+        records = list(reader)
+    assert [record.room for record in records] == ["worker_1"] * 50 + ["worker_2"] * 50
+    # Same shoes, same rounds, in the order each writer wrote them
+    rounds = [record._replace(timestamp=None, room=None) for record in records]
+    assert rounds[:50] == rounds[50:]
+
+    try:
+        hand_history.HandHistoryWriter(str(tmp_path), writer_id="../worker")
+    except ValueError:
+        return
+    raise Exception("Should not reach here")
+
+
+def test_basic_strategy_chart():
+    ace, six, ten = (Card(suit=Suites.SPADES, rank=rank) for rank in ("A", 6, 10))
+
+    def hand_of(*ranks):
+        hand = Hand()
+        for rank in ranks:
+            hand.take_card(Card(suit=Suites.HEARTS, rank=rank))
+        return hand
+
+    all_actions = (Actions.HIT, Actions.DOUBLE, Actions.STAND, Actions.SURRENDER)
+    assert BASIC_STRATEGY(hand_of(6, 5), six, all_actions) == Actions.DOUBLE
+    assert BASIC_STRATEGY(hand_of(6, 5), ace, all_actions) == Actions.HIT
+    assert BASIC_STRATEGY(hand_of(10, 6), ten, all_actions) == Actions.SURRENDER
+    assert BASIC_STRATEGY(hand_of("A", 7), six, all_actions) == Actions.DOUBLE
+    assert BASIC_STRATEGY(hand_of("A", 7), six, (Actions.HIT, Actions.STAND)) == Actions.STAND
+    assert BASIC_STRATEGY(hand_of(10, 3, 6), ten, all_actions) == Actions.STAND
+
+
+@mock.patch("simulate.HANDS_PER_SHARD", 500)
+def test_simulation_does_not_depend_on_the_number_of_workers():
+    single_process = simulate("basic", "default", 3000, num_of_workers=1, num_of_seats=2, seed=3)
+    two_processes = simulate("basic", "default", 3000, num_of_workers=2, num_of_seats=2, seed=3)
+
+    assert single_process.hands == 3000
+    assert single_process.as_dict() == two_processes.as_dict()
+    assert sum(single_process.outcomes.values()) == 3000
+
+
+def test_simulation_counts_must_be_positive():
+    assert positive_int("4") == 4
+    for text in ("0", "-2"):
+        try:
+            positive_int(text)
+        except argparse.ArgumentTypeError:
+            continue
+        raise Exception("Should not reach here")
+
+
+class _ReplayShoe(object):
+    def __init__(self, codes):
+        self._codes = iter(codes)
+
+    def shuffle_if_cut_card_reached(self):
+        return False
+
+    def draw_card(self):
+        return card_from_code(next(self._codes))
+
+
+def test_batch_simulator_plays_like_the_engine():
+    simulator = BatchTableSimulator(2000, num_of_decks=6, penetration=0.75, strategy=BASIC_STRATEGY, seed=5)
+    for _ in range(3):  # play on shoes that are partially dealt
+        shoes, positions = simulator.shoes.copy(), simulator.positions.copy()
+        result = simulator.play_round()
+
+        for table in range(len(shoes)):
+            shoe = _ReplayShoe(shoes[table, positions[table]:].tolist())
+            seat = BlackJackEngine(shoe).play_round([1], BASIC_STRATEGY).seats[0]
+            assert (seat.bet, seat.payout, seat.outcome.value) == (
+                result.bet[table],
+                result.payout[table],
+                result.outcome[table],
+            ), table
+
+
+def _reference_dealer_distribution(hard_total, has_ace, composition):
+    value = hard_total + 10 if has_ace and hard_total + 10 <= 21 else hard_total
+    if hard_total > 21:
+        return [0, 0, 0, 0, 0, 1]
+    if value >= 17:
+        return [1 if value == dealer_value else 0 for dealer_value in range(17, 23)]
+
+    distribution = [0] * 6
+    for index, count in enumerate(composition):
+        if count:
+            next_composition = composition[:index] + (count - 1,) + composition[index + 1:]
+            next_distribution = _reference_dealer_distribution(hard_total + index + 1, has_ace or index == 0,
+                                                               next_composition)
+            for outcome in range(6):
+                distribution[outcome] += count / sum(composition) * next_distribution[outcome]
+    return distribution
+
+
+def test_solver_dealer_distribution_matches_recursive_draws():
+    six_decks = solver.shoe_composition(6)
+    compositions = [solver.shoe_composition(1), (3, 4, 4, 0, 4, 2, 4, 1, 4, 9), six_decks[:9] + (40,)]
+    for composition in compositions:
+        for upcard_index in (0, 1, 5, 9):
+            expected = _reference_dealer_distribution(upcard_index + 1, upcard_index == 0, composition)
+            actual = solver.dealer_distribution(upcard_index, composition)
+            assert max(abs(a - b) for a, b in zip(actual, expected)) < 1e-12
+
+
+def test_solver_best_actions():
+    composition = solver.shoe_composition(6)
+
+    def best_action(player_ranks, upcard_rank):
+        player_cards = [Card(suit=Suites.HEARTS, rank=rank) for rank in player_ranks]
+        return solver.best_action(player_cards, Card(suit=Suites.SPADES, rank=upcard_rank), composition)
+
+    assert best_action((6, 5), 6) == Actions.DOUBLE
+    assert best_action((10, 6), 10) == Actions.SURRENDER
+    assert best_action((10, 10), 10) == Actions.STAND
+    assert best_action((10, 2), 7) == Actions.HIT
+
+
+@mock.patch.object(server.BlackJackGameOnline, "_schedule_round")
+def test_room_index_finds_most_populated_vacant_room(_schedule_round_mock):
+    async def fill_and_empty_rooms():
+        room_a = server.BlackJackGameOnline(room_num=0)
+        room_b = server.BlackJackGameOnline(room_num=1)
+        index.add(room_a)
+        index.add(room_b)
+
+        room_b.add_player(server.SocketioPlayer(name="P1", sid="sid1"))
+        assert index.most_populated_vacant_room() is room_b
+
+        room_b.add_player(server.SocketioPlayer(name="P2", sid="sid2"))  # room b is full
+        assert index.most_populated_vacant_room() is room_a
+        assert server.players_by_sid["sid1"][0] is room_b
+
+        room_b.remove_player_from_game("sid1")
+        assert [player.id for player in room_b.players] == ["sid2"]
+        assert "sid1" not in server.players_by_sid
+        assert index.most_populated_vacant_room() is room_b
+
+        index.remove(room_b)
+        index.remove(room_a)
+        assert index.most_populated_vacant_room() is None
+        assert len(index) == 0
+
+    index = server.RoomIndex(max_number_of_players_in_room=2)
+    with mock.patch.object(server, "rooms", index), mock.patch.object(server, "players_by_sid", {}):
+        asyncio.run(fill_and_empty_rooms())
+
+
+async def _prompted(player, kind):
+    while player.prompt is None or player.prompt.kind != kind:
+        await asyncio.sleep(0.001)
+    return player.prompt.id
+
+
+@mock.patch.object(server, "sio")
+@mock.patch.object(server.BlackJackGameOnline, "_schedule_round")
+def test_answers_are_routed_to_the_prompted_player(_schedule_round_mock, sio_mock):
+    sio_mock.emit = mock.AsyncMock()
+    sio_mock.send = mock.AsyncMock()
+    player = server.SocketioPlayer(name="P1", sid="sid1", amount_of_money=100)
+    other_player = server.SocketioPlayer(name="P2", sid="sid2", amount_of_money=100)
+    dropped = {reason: server.dropped_client_events.labels(reason).value for reason in (
+        server.NOT_SEATED, server.MALFORMED, server.STALE, server.RATE_LIMITED,
+    )}
+
+    def dropped_since_start(reason):
+        return server.dropped_client_events.labels(reason).value - dropped[reason]
+
+    async def bet():
+        game = server.BlackJackGameOnline(room_num=0)
+        game.add_player(player)
+        game.add_player(other_player)
+        answer = server.answer_prompt
+        await answer("sid1", {"id": 0, "input": "b"})  # Not prompted yet
+        game._start_round()
+        await game._outbox.flush()
+        bet_or_skip = sio_mock.emit.await_args.kwargs["data"]  # P2's prompt has the same id and text
+        assert bet_or_skip == {"id": 0, "kind": "BET_OR_SKIP", "text": server.BET_OR_SKIP_PROMPT}
+
+        await answer("unknown sid", protocol.answer_message(bet_or_skip, "b"))
+        await answer("sid1", "b")
+        await answer("sid1", protocol.answer_message(bet_or_skip, "b"))
+        await answer("sid1", protocol.answer_message(bet_or_skip, "b"))  # Already answered
+        await answer("sid1", {"id": player.awaited_prompt_id, "input": "1000"})
+        await answer("sid1", {"id": player.awaited_prompt_id, "input": "40"})
+        await game._outbox.flush()
+        return game
+
+    with mock.patch.object(server, "rooms", server.RoomIndex(2)), mock.patch.object(server, "players_by_sid", {}), \
+            mock.patch.object(server, "rate_limits", {}):
+        game = asyncio.run(bet())
+
+    assert game.phase == RoundPhases.BETTING  # P2 didn't bet yet
+    assert game.table_state()["seats"]["sid1"]["bet"] == 40
+    assert player.remaining_money == 60
+    assert player.prompt is None
+    prompts = [call.kwargs["data"] for call in sio_mock.emit.await_args_list if call.args[0] == protocol.PROMPT_EVENT]
+    # P1 and P2, then P1 for his bet. Prompt 1 was replaced by prompt 2 (asking again for 1000$) before it was sent.
+    assert [(prompt["id"], prompt["kind"]) for prompt in prompts] == [
+        (0, "BET_OR_SKIP"), (0, "BET_OR_SKIP"), (2, "BET_AMOUNT"),
+    ]
+    assert mock.call(
+        data="You don't have 1000$! you can place a bet up to 100", to="sid1", namespace=server.BJ_NAMESPACE
+    ) in sio_mock.send.await_args_list
+
+    snapshot = json.loads(json.dumps(game.snapshot()))
+    assert [player["bet"] for player in snapshot["players"]] == [40, None]
+    assert snapshot["players"][1]["prompt"]["kind"] == "BET_OR_SKIP"
+    assert dropped_since_start(server.NOT_SEATED) == 1
+    assert dropped_since_start(server.MALFORMED) == 1
+    assert dropped_since_start(server.STALE) == 2  # The answer before the prompt, and the second answer
+    assert dropped_since_start(server.RATE_LIMITED) == 0
+
+
+def test_clients_flooding_events_are_rate_limited():
+    with mock.patch.object(server, "rate_limits", {}), mock.patch.object(server, "state_rate_limits", {}), \
+            mock.patch.object(server, "players_by_sid", {}):
+        rate_limited = [server.rate_limited("sid1") for _ in range(server.CLIENT_EVENTS_BURST + 10)]
+        assert not server.rate_limited("sid2")  # Every client has a bucket of its own
+        state_rate_limited = [server.state_rate_limited("sid2") for _ in range(server.STATE_EVENTS_BURST + 10)]
+        assert not server.rate_limited("sid2")  # Acking states doesn't use up the budget of the answers
+    assert rate_limited.count(False) == server.CLIENT_EVENTS_BURST
+    assert rate_limited[-10:] == [True] * 10
+    assert state_rate_limited.count(False) == server.STATE_EVENTS_BURST
+    assert server.STATE_EVENTS_PER_SECOND >= 1 / server.OUTBOX_FLUSH_DELAY  # An ack for every state sent
+
+
+@mock.patch.object(server, "sio")
+def test_disconnected_players_and_idle_rooms_are_freed(sio_mock):
+    sessions = {}
+    sio_mock.emit = sio_mock.send = sio_mock.disconnect = sio_mock.close_room = mock.AsyncMock()
+    sio_mock.save_session = mock.AsyncMock(side_effect=lambda sid, session, namespace: sessions.update({sid: session}))
+    sio_mock.get_session = mock.AsyncMock(side_effect=lambda sid, namespace: sessions[sid])
+    limits = server.ServerLimits(max_rooms=1, max_seated_players=3, room_idle_ttl=0.01)
+    refused = []
+
+    async def churn():
+        for cycle in range(20):
+            sids = ["sid%d-%d" % (cycle, seat) for seat in range(3)]
+            for sid in sids:
+                await server.connect(sid, {})
+                await server.process_new_player_data(sid, "P", "100")
+            assert len(server.players_by_sid) == 3
+            try:
+                await server.connect("one too many", {})
+            except server.socketio.exceptions.ConnectionRefusedError:
+                refused.append(cycle)
+            for sid in sids:
+                await server.answer_prompt(sid, {"id": 0, "input": "skip"})
+                await server.disconnect(sid)
+            await asyncio.sleep(0.03)  # The room is evicted
+            assert len(server.rooms) == 0
+
+    evicted_rooms = server.evicted_rooms.value
+    with mock.patch.object(server, "rooms", server.RoomIndex(server.MAX_NUMBER_OF_PLAYERS_IN_ROOM)), \
+            mock.patch.object(server, "room_numbers", server.RoomNumbers()), \
+            mock.patch.object(server, "players_by_sid", {}), mock.patch.object(server, "rate_limits", {}), \
+            mock.patch.object(server, "state_rate_limits", {}), mock.patch.object(server, "limits", limits):
+        asyncio.run(churn())
+        assert server.players_by_sid == {}
+        assert server.rate_limits == server.state_rate_limits == {}
+        assert server.room_numbers.claim() == 0  # Every room had number 0
+
+    assert refused == list(range(20))
+    assert server.evicted_rooms.value == evicted_rooms + 20
+
+
+@mock.patch.object(server, "sio")
+@mock.patch.object(Shoe, "draw_card")
+@mock.patch.object(server.BlackJackGameOnline, "_schedule_round")
+def test_failed_rounds_return_the_unpaid_bets(_schedule_round_mock, draw_card_mock, sio_mock):
+    sio_mock.emit = mock.AsyncMock()
+    sio_mock.send = mock.AsyncMock()
+    draw_card_mock.side_effect = [
+        Card(suit=Suites.SPADES, rank=10),
+        Card(suit=Suites.HEARTS, rank=9),
+        Card(suit=Suites.CLUBS, rank=7),
+        Card(suit=Suites.DIAMONDS, rank=8),
+        Card(suit=Suites.SPADES, rank=6),
+        Card(suit=Suites.HEARTS, rank=5),
+        Card(suit=Suites.CLUBS, rank=4),
+    ]
+    players = [server.SocketioPlayer(name="P%d" % seat, sid="sid%d" % seat, amount_of_money=100) for seat in (1, 2)]
+
+    async def fail_a_decision():
+        game = server.BlackJackGameOnline(room_num=0)
+        for player in players:
+            game.add_player(player)
+        game._start_round()
+        for player, bet in zip(players, ("30", "20")):
+            game.answer(player, player.awaited_prompt_id, "b")
+            game.answer(player, player.awaited_prompt_id, bet)
+        assert game.phase == RoundPhases.DECISIONS
+        game.answer(players[0], players[0].awaited_prompt_id, "d")  # P1 doubles down to 60$ and stands on 19
+        assert [player.remaining_money for player in players] == [40, 80]
+        with mock.patch.object(RoundState, "decide", side_effect=RuntimeError("Broken decision")):
+            game.answer(players[1], players[1].awaited_prompt_id, "h")
+        await game._outbox.flush()
+        return game
+
+    with mock.patch.object(server, "rooms", server.RoomIndex(2)):
+        game = asyncio.run(fail_a_decision())
+
+    assert game.phase is None
+    assert [player.remaining_money for player in players] == [100, 100]
+    assert [player.prompt for player in players] == [None, None]
+    assert mock.call(
+        data="The round was cancelled, you get your 60$ bet back", to="sid1", namespace=server.BJ_NAMESPACE
+    ) in sio_mock.send.await_args_list
+
+
+@mock.patch.object(server, "sio")
+@mock.patch.object(Shoe, "draw_card")
+def test_idle_players_get_default_actions(draw_card_mock, sio_mock):
+    sio_mock.emit = mock.AsyncMock()
+    sio_mock.send = mock.AsyncMock()
+    draw_card_mock.side_effect = [
+        Card(suit=Suites.SPADES, rank=10),
+        Card(suit=Suites.HEARTS, rank=9),
+        Card(suit=Suites.CLUBS, rank=7),
+        Card(suit=Suites.DIAMONDS, rank=8),  # dealer has 17
+    ]
+    timeouts = server.DecisionTimeouts(betting=0.05, playing=0.05, grace_period=0.02)
+    player = server.SocketioPlayer(name="P1", sid="sid1", amount_of_money=100)
+
+    async def play_idle_rounds():
+        game = server.BlackJackGameOnline(room_num=0, inter_round_delay=0, decision_timeouts=timeouts)
+        game.add_player(player)
+        await _prompted(player, server.PromptKinds.BET_OR_SKIP)  # First round: skipped by the server
+        await asyncio.sleep(0.07)
+        game.answer(player, await _prompted(player, server.PromptKinds.BET_OR_SKIP), "b")
+        await asyncio.sleep(0.07)  # Second round: the bet is skipped by the server
+        game.answer(player, await _prompted(player, server.PromptKinds.BET_OR_SKIP), "b")
+        game.answer(player, await _prompted(player, server.PromptKinds.BET_AMOUNT), "50")
+        decision_prompt_id = await _prompted(player, server.PromptKinds.DECISION)
+        await asyncio.sleep(0.07)  # Third round: stands for the player, who is in a tie with the dealer
+        assert game.answer(player, decision_prompt_id, "h") == server.STALE
+        game.remove_player_from_game(player.id)
+        await game._outbox.flush()
+        return game
+
+    default_stands = server.default_actions_taken.labels(Actions.STAND.name).value
+    default_skips = server.default_actions_taken.labels(Actions.SKIP.name).value
+    rounds_completed = server.rounds_completed.value
+    with mock.patch.object(server, "rooms", server.RoomIndex(2)), mock.patch.object(server, "players_by_sid", {}):
+        game = asyncio.run(play_idle_rounds())
+
+    assert server.default_actions_taken.labels(Actions.STAND.name).value == default_stands + 1
+    assert server.default_actions_taken.labels(Actions.SKIP.name).value == default_skips + 2
+    assert server.rounds_completed.value >= rounds_completed + 3
+    assert player.remaining_money == 100
+    sent_texts = "\n".join(call.kwargs["data"] for call in sio_mock.send.await_args_list)
+    assert sent_texts.count("seconds left") == 3
+    assert "P1, You are tied with the dealer! you get your bet back" in sent_texts
+    assert not game.is_playing
+
+
+@mock.patch.object(server, "sio")
+def test_decision_timers_are_room_events(sio_mock):
+    sio_mock.emit = mock.AsyncMock()
+    sio_mock.send = mock.AsyncMock()
+    timeouts = server.DecisionTimeouts(betting=0.05, playing=0.05, grace_period=0.02)
+    player = server.SocketioPlayer(name="P1", sid="sid1", amount_of_money=100)
+    warned_tables = []
+
+    def fail_to_warn(player, text):
+        if "seconds left" in text:
+            warned_tables.append(blackjack_base.current_table.get())
+            raise RuntimeError("Can't warn")
+
+    async def fail_warning():
+        game = server.BlackJackGameOnline(room_num=0, inter_round_delay=10, decision_timeouts=timeouts)
+        game._tell = fail_to_warn
+        game.add_player(player)
+        await _prompted(player, server.PromptKinds.BET_OR_SKIP)
+        await asyncio.sleep(0.04)
+        return game
+
+    with mock.patch.object(server, "rooms", server.RoomIndex(2)), mock.patch.object(server, "players_by_sid", {}):
+        with mock.patch.object(server, "logger") as logger_mock:
+            game = asyncio.run(fail_warning())
+
+    assert warned_tables == [game]  # The warning ran with its room as the current table
+    logger_mock.exception.assert_called_once_with("Round in room # %d failed", 0)
+    assert game.phase is None and player.prompt is None and not player.decision_timers  # The round was ended
+
+
+@mock.patch.object(server, "sio")
+@mock.patch.object(server.BlackJackGameOnline, "_schedule_round")
+def test_room_messages_are_sent_once_per_phase(_schedule_round_mock, sio_mock):
+    sio_mock.send = mock.AsyncMock()
+    sio_mock.emit = mock.AsyncMock()
+
+    async def play_phase():
+        game = server.BlackJackGameOnline(room_num=3)
+        player = server.SocketioPlayer(name="P1", sid="sid1")
+        game.add_player(player)
+
+        game._outbox.add("Dealers Cards: ...")
+        await player.msg_to_user("P1, you won 10$")
+        game._outbox.add("P1 Cards: ...")
+        assert sio_mock.send.await_count == 0
+
+        game._start_phase(RoundPhases.DECISIONS)
+        game._outbox.add("P1 said STAND")  # In the next frame
+        await game._outbox.flush()
+        assert game.phase == RoundPhases.DECISIONS
+        assert sio_mock.send.await_args_list == [
+            mock.call(data="Dealers Cards: ...\nP1 Cards: ...", room="room-3", namespace=server.BJ_NAMESPACE),
+            mock.call(data="P1, you won 10$", to="sid1", namespace=server.BJ_NAMESPACE),
+            mock.call(data="P1 said STAND", room="room-3", namespace=server.BJ_NAMESPACE),
+        ]
+
+        game._outbox.add("P1 said SURRENDER")
+        # Sent right away, after the text
+        game._outbox.prompt("sid1", protocol.prompt_message(0, server.PromptKinds.DECISION, "Hit or stand"))
+        await asyncio.sleep(server.OUTBOX_FLUSH_DELAY / 5)
+        assert sio_mock.send.await_count == 4
+        assert sio_mock.emit.await_args.args[0] == protocol.PROMPT_EVENT
+
+    with mock.patch.object(server, "rooms", server.RoomIndex(2)), mock.patch.object(server, "players_by_sid", {}):
+        asyncio.run(play_phase())
+
+
+@mock.patch.object(BlackJackGameOffLine, "get_input_from_user")
+def test_table_state_deltas_rebuild_the_table(get_input_from_user_mock):
+    get_input_from_user_mock.side_effect = ["2", "P1", 100, "P2", 100]
+    game = BlackJackGameOffLine()
+    player_a, player_b = game.players
+    replica = protocol.TableStateReplica()
+    assert replica.receive(protocol.snapshot_message(1, game.table_state()))
+
+    old_state = game.table_state()
+    game._phase = RoundPhases.DECISIONS
+    game._players_bet[player_a] = player_a.give_money(40)
+    player_a.take_card(Card(Suites.SPADES, "A"))
+    game._dealers_cards.take_card(Card(Suites.HEARTS, 9))
+    game._dealers_cards.take_card(Card(Suites.CLUBS, "K"))
+    new_state = game.table_state()
+
+    assert new_state["dealer"] == [Card(Suites.HEARTS, 9).code, None]  # The hole card is hidden
+    delta = protocol.state_delta(old_state, new_state)
+    assert set(delta) == {"phase", "dealer", "seats"}
+    assert set(delta["seats"]) == {player_a.id}
+
+    assert replica.receive(protocol.delta_message(2, 1, delta))
+    assert replica.state == new_state
+    assert not replica.receive(protocol.delta_message(4, 3, {}))  # Missed state 3
+    assert "[A of ♠ ]" in protocol.render_table(replica.state)
+
+    game.players.remove(player_b)
+    delta = protocol.state_delta(new_state, game.table_state())
+    assert delta == {"seats": {player_b.id: None}}
+    assert protocol.apply_delta(new_state, delta) == game.table_state()
+
+
+@mock.patch.object(server, "sio")
+def test_room_plays_rounds_until_empty_then_closes(sio_mock):
+    sio_mock.emit = mock.AsyncMock()
+    sio_mock.send = mock.AsyncMock()
+    sio_mock.close_room = mock.AsyncMock()
+
+    async def play_two_rounds():
+        game = server.BlackJackGameOnline(room_num=0, inter_round_delay=0, idle_ttl=0.01)
+        index.add(game)
+        player = server.SocketioPlayer(name="P1", sid="sid1", amount_of_money=100)
+        game.add_player(player)
+        assert game.is_playing
+        game.answer(player, await _prompted(player, server.PromptKinds.BET_OR_SKIP), "skip")
+        await _prompted(player, server.PromptKinds.BET_OR_SKIP)
+        game.remove_player_from_game(player.id)  # Skips the second round for him
+        assert len(index) == 1  # Until the room was idle for its TTL
+        await asyncio.sleep(0.05)
+        return game
+
+    rounds_started = server.rounds_started.value
+    index = server.RoomIndex(2)
+    with mock.patch.object(server, "rooms", index), mock.patch.object(server, "players_by_sid", {}):
+        game = asyncio.run(play_two_rounds())
+
+    assert server.rounds_started.value == rounds_started + 2
+    assert not game.is_playing
+    assert len(index) == 0
+
+
+def _play_to_the_end(round_state, shoe, resume=lambda round_state: round_state):
+    def hit_until_17(hand):
+        return Actions.HIT if hand.value < 17 else Actions.STAND
+
+    round_state.deal(shoe)
+    while round_state.phase == RoundPhases.DECISIONS:
+        round_state = resume(round_state)
+        round_state.decide(hit_until_17(round_state.hands[round_state.seat]), shoe)
+    round_state = resume(round_state)
+    round_state.play_dealer(shoe)
+    round_state.settle()
+    return round_state.result()
+
+
+def test_round_state_resumes_from_its_snapshot():
+    def through_json(round_state):
+        return RoundState.from_dict(json.loads(json.dumps(round_state.to_dict())))
+
+    shoe = Shoe(num_of_decks=1, penetration=0.5, seed=7)
+    for _ in range(20):  # Snapshot a shoe that was already reshuffled
+        _play_to_the_end(RoundState([10, 20, 30]), shoe)
+        shoe.shuffle_if_cut_card_reached()
+    resumed_shoe = Shoe.from_dict(json.loads(json.dumps(shoe.to_dict())))
+    assert resumed_shoe.to_dict() == shoe.to_dict()
+    assert shoe.num_of_shuffles > 1
+    for _ in range(100):
+        assert shoe.shuffle_if_cut_card_reached() == resumed_shoe.shuffle_if_cut_card_reached()
+        result = _play_to_the_end(RoundState([10, 20, 30], [100, 100, 100]), shoe)
+        resumed_result = _play_to_the_end(RoundState([10, 20, 30], [100, 100, 100]), resumed_shoe, through_json)
+        assert resumed_result == result
+
+    try:
+        RoundState([10]).settle()
+    except InvalidRoundEventError:
+        return
+    raise Exception("Should not reach here")
+
+
+def test_room_registry_assigns_players_across_workers(tmp_path):
+    registry = cluster.RoomRegistry(str(tmp_path / "rooms.json"))
+    assert registry.assign(max_number_of_players_in_room=2) is None
+
+    registry.register_worker("0", "http://localhost:8000")
+    registry.register_worker("1", "http://localhost:8001")
+    room_a = registry.claim_room("0")
+    room_b = registry.claim_room("1")
+    assert room_a != room_b
+    assert registry.owner_address(room_b) == "http://localhost:8001"
+
+    registry.update_occupancy(room_b, 1)
+    assert registry.assign(2) == "http://localhost:8001"  # Most populated vacant room
+    registry.update_occupancy(room_b, 2)
+    registry.update_occupancy(room_a, 2)
+    registry.update_occupancy(registry.claim_room("0"), 1)
+    registry.update_occupancy(registry.claim_room("0"), 1)
+    assert registry.assign(2) == "http://localhost:8000"
+
+    registry.release_room(room_a)
+    assert registry.owner_address(room_a) is None
+    assert registry.claim_room("1") == room_a  # Room numbers are recycled
+    registry.release_room(room_a)
+    registry.unregister_worker("0")
+    assert registry.assign(2) == "http://localhost:8001"  # Least busy worker, all of its rooms are full
+
+
+def test_background_registry_coalesces_occupancy_off_the_event_loop(tmp_path):
+    registry = cluster.RoomRegistry(str(tmp_path / "rooms.json"))
+    registry.register_worker("0", "http://localhost:8000")
+    room_a, room_b, room_c = (registry.claim_room("0") for _ in range(3))
+    calling_threads = []
+
+    def update_occupancies(num_of_players_by_room):
+        calling_threads.append(threading.current_thread())
+        cluster.RoomRegistry.update_occupancies(registry, num_of_players_by_room)
+
+    async def join_and_leave():
+        background_registry = cluster.BackgroundRoomRegistry(registry, report_interval=0.02)
+        for num_of_players in (1, 2, 3, 2):
+            background_registry.update_occupancy(room_a, num_of_players)
+        background_registry.update_occupancy(room_b, 1)
+        background_registry.update_occupancy(room_c, 1)
+        background_registry.release_room(room_c)
+        assignments = await asyncio.gather(*(background_registry.assign(3) for _ in range(10)))
+        await asyncio.sleep(0.05)
+        background_registry.update_occupancy(room_b, 3)
+        background_registry.close()  # Reports the pending changes
+        return assignments
+
+    with mock.patch.object(registry, "update_occupancies", side_effect=update_occupancies) as update_mock, \
+            mock.patch.object(registry, "assign", wraps=registry.assign) as assign_mock:
+        assignments = asyncio.run(join_and_leave())
+
+    assert assignments == ["http://localhost:8000"] * 10
+    assert update_mock.call_args_list == [mock.call({room_a: 2, room_b: 1}), mock.call({room_b: 3})]
+    assert threading.main_thread() not in calling_threads
+    assert assign_mock.call_count == 1  # The concurrent assignments shared a call
+    assert registry.owner_address(room_c) is None
+
+
+@mock.patch.object(server, "sio")
+def test_connections_claim_rooms_off_the_event_loop(sio_mock, tmp_path):
+    sio_mock.emit = sio_mock.save_session = sio_mock.close_room = mock.AsyncMock()
+    registry = cluster.RoomRegistry(str(tmp_path / "rooms.json"))
+    registry.register_worker(server.WORKER_ID, "http://localhost:8000")
+    registry.claim_room("another worker")
+    calling_threads = []
+
+    def claim_room(worker_id):
+        calling_threads.append(threading.current_thread())
+        return cluster.RoomRegistry.claim_room(registry, worker_id)
+
+    async def connect():
+        background_registry = cluster.BackgroundRoomRegistry(registry)
+        with mock.patch.object(server, "registry", registry), \
+                mock.patch.object(server, "background_registry", background_registry), \
+                mock.patch.object(server, "rooms", server.RoomIndex(2, background_registry)):
+            await server.connect("sid1", {})
+            room = server.rooms.get(1)
+            server.close_room(room)
+        background_registry.close()
+        return room
+
+    with mock.patch.object(registry, "claim_room", side_effect=claim_room):
+        room = asyncio.run(connect())
+
+    assert room.room_number == 1  # Numbers are unique across workers
+    assert calling_threads and threading.main_thread() not in calling_threads
+    assert registry.owner_address(1) is None  # Released when the room closed
+
+
+def test_broker_sends_published_messages_to_every_worker():
+    async def publish_and_listen():
+        broker_server = await cluster.Broker().serve("127.0.0.1", 0)
+        address = "127.0.0.1:%d" % broker_server.sockets[0].getsockname()[1]
+        managers = [cluster.BrokerClientManager(address) for _ in range(2)]
+        listeners = [manager._listen() for manager in managers]
+        await asyncio.gather(*(manager._connect() for manager in managers))
+
+        await managers[0]._publish({"method": "emit", "event": "message", "data": "hi"})
+        received = [await asyncio.wait_for(listener.__anext__(), 1) for listener in listeners]
+        broker_server.close()
+        return received
+
+    assert asyncio.run(publish_and_listen()) == [{"method": "emit", "event": "message", "data": "hi"}] * 2
+
+
+def test_load_generator_bot_answers_and_stats():
+    stats = loadgen.LoadStats()
+    bot = loadgen.Bot("bot-0", "http://localhost", BASIC_STRATEGY, 0, "fixed", 100, stats, None)
+    bot._sio.get_sid = mock.Mock(return_value="sid1")
+    cards = [Card(Suites.SPADES, 10), Card(Suites.HEARTS, 6), Card(Suites.CLUBS, 10)]
+    state = {
+        "phase": RoundPhases.DECISIONS.name,
+        "dealer": [cards[2].code, None],
+        "seats": {"sid1": {"seat": 0, "name": "bot-0", "money": 90, "bet": 10, "cards": [c.code for c in cards[:2]]}},
+    }
+    bot._table.receive(protocol.snapshot_message(1, state))
+
+    def answer(kind):  # The bot answers from the prompt's kind, whatever its text says
+        prompt = json.loads(json.dumps(protocol.prompt_message(0, kind, "Type something")))
+        return bot._answer(protocol.prompt_kind(prompt))
+
+    assert answer(protocol.PromptKinds.BET_OR_SKIP) == "b"
+    assert answer(protocol.PromptKinds.BET_AMOUNT) == str(loadgen.BET)
+    assert answer(protocol.PromptKinds.DECISION) == "surrender"  # Hard 16 against a 10
+
+    other_stats = loadgen.LoadStats()
+    other_stats.round_trips = [0.3, 0.1, 0.2]
+    other_stats.add_error("connect failed")
+    report = stats.merge(other_stats).as_dict(elapsed_seconds=1)
+    assert report["rounds"] == 1
+    assert report["errors"] == {"connect failed": 1}
+    assert report["round_trip"]["p50"] == 0.2
+
+
+def test_benchmarks_run_and_compare_with_a_baseline():
+    for name, build_callable in benchmarks.BENCHMARKS.items():
+        build_callable()()
+
+    baseline = {"fast": {"best": 1.0}, "slow": {"best": 1.0}, "removed": {"best": 1.0}}
+    results = {"fast": {"best": 0.5}, "slow": {"best": 1.5}, "new": {"best": 1.0}}
+    ratios, regressions = benchmarks.compare(results, baseline, threshold=1.1)
+    assert ratios == {"fast": 0.5, "slow": 1.5}
+    assert regressions == ["slow"]
+
+
+def test_metrics_render_in_prometheus_text_format():
+    registry = metrics.MetricsRegistry()
+    requests = metrics.counter("requests_total", "Requests", label_names=("kind",), registry=registry)
+    latency = metrics.histogram("latency_seconds", "Latency", buckets=(0.1, 1), registry=registry)
+    metrics.gauge("rooms", "Open rooms", function=lambda: 3, registry=registry)
+
+    requests.labels("get").inc()
+    requests.labels("get").inc(2)
+    for value in (0.05, 0.1, 0.5, 7):
+        latency.observe(value)
+
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{kind="get"} 3',
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_sum 7.65",
+        "latency_seconds_count 4",
+        "# HELP rooms Open rooms",
+        "# TYPE rooms gauge",
+        "rooms 3",
+    ]
+
+
+def test_logging_goes_through_a_queue_with_levels_per_subsystem_and_sampled_debug():
+    root_logger = logging.getLogger()
+    root_handlers, root_level = root_logger.handlers[:], root_logger.level
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter("%(name)s %(levelname)s %(message)s"))
+    assert log_setup.parse_levels("test_quiet=WARNING,test_loud=debug") == {
+        "test_quiet": "WARNING", "test_loud": "DEBUG",
+    }
+
+    listener = log_setup.setup_logging(
+        logging.DEBUG, {"test_quiet": "WARNING"}, debug_sample_rate=0.5, handler=handler
+    )
+    try:
+        hand = [1]
+        for i in range(4):
+            logging.getLogger("test_loud").debug("debug %d %s", i, hand)
+        hand.append(2)  # Changing an argument after the call doesn't change the message
+        logging.getLogger("test_quiet").info("hidden")
+        logging.getLogger("test_quiet").warning("shown")
+    finally:
+        listener.stop()
+        root_logger.handlers[:] = root_handlers
+        root_logger.setLevel(root_level)
+        logging.getLogger("test_quiet").setLevel(logging.NOTSET)
+
+    assert stream.getvalue().splitlines() == [
+        "test_loud DEBUG debug 0 [1]",
+        "test_loud DEBUG debug 2 [1]",
+        "test_quiet WARNING shown",
+    ]
+
+    # Only the arguments that could change are rendered when queued, the message is merged by the listener
+    record = logging.LogRecord(
+        "test_loud", logging.INFO, __file__, 1, "%s has %r, %d%% %s", ("P1", hand, 5, None), None
+    )
+    prepared = log_setup.LazyQueueHandler(None).prepare(record)
+    hand.append(3)
+    assert prepared.msg == record.msg
+    assert prepared.args[0] == "P1"
+    assert prepared.getMessage() == "P1 has [1, 2], 5% None"
+    assert record.args[1] is hand  # Other handlers get the record as it was
+
+
+def _read_trace_events(path):
+    with open(path) as trace_file:
+        lines = trace_file.read().splitlines()
+    assert lines[0] == "["
+    return [json.loads(line.rstrip(",")) for line in lines[1:]]
+
+
+@mock.patch.object(server, "sio")
+def test_rounds_are_traced_per_phase_and_player_into_rotated_files(sio_mock, tmp_path):
+    sio_mock.emit = mock.AsyncMock()
+    sio_mock.send = mock.AsyncMock()
+    trace_path = str(tmp_path / "trace.json")
+    answers = {
+        server.PromptKinds.BET_OR_SKIP: "b",
+        server.PromptKinds.BET_AMOUNT: "5",
+        server.PromptKinds.DECISION: "s",
+    }
+
+    async def play_traced_rounds(num_of_rounds):
+        game = server.BlackJackGameOnline(room_num=7, inter_round_delay=0)
+        game._shoe = Shoe(seed=0)
+        players = [server.SocketioPlayer(name="P%d" % i, sid="sid%d" % i, amount_of_money=1000) for i in range(2)]
+        assert game._trace_span("round") is tracing.NO_SPAN  # Tracing is off
+
+        tracing.enable(trace_path, max_bytes=4096, backup_count=2)
+        try:
+            rounds_completed = server.rounds_completed.value
+            for player in players:
+                game.add_player(player)
+            while server.rounds_completed.value < rounds_completed + num_of_rounds:
+                for player in players:
+                    if player.prompt is not None:
+                        game.answer(player, player.prompt.id, answers[player.prompt.kind])
+                await asyncio.sleep(0.001)
+            for player in players:
+                game.remove_player_from_game(player.id)
+            await game._outbox.flush()
+        finally:
+            tracing.disable()
+
+    with mock.patch.object(server, "rooms", server.RoomIndex(2)), mock.patch.object(server, "players_by_sid", {}):
+        asyncio.run(play_traced_rounds(20))
+
+    trace_files = sorted(tmp_path.iterdir())
+    assert [path.name for path in trace_files] == ["trace.json", "trace.json.1", "trace.json.2"]
+    spans = []
+    for path in trace_files:
+        events = _read_trace_events(str(path))
+        track_names = {event["tid"]: event["args"]["name"] for event in events if event["ph"] == "M"}
+        assert all(event["tid"] in track_names for event in events)  # Every file names its tracks
+        spans.extend(dict(event, track=track_names[event["tid"]]) for event in events if event["ph"] == "X")
+
+    assert {
+        "waiting for players", "round", "betting", "deal", "decisions", "dealer", "settlement", "bet", "await decision",
+    } <= {span["name"] for span in spans}
+    assert all(span["args"]["room"] == "room 7" for span in spans)
+    assert {(span["track"], span["args"]["player"]) for span in spans if span["name"] == "bet"} == {
+        ("room 7 / P0", "P0"), ("room 7 / P1", "P1"),
+    }
+    assert all(span["track"] == "room 7" for span in spans if span["name"] == "round")
+    assert all(span["track"] == "room 7" for span in spans if span["name"] == "waiting for players")
+    # Bets are awaited on the players' tracks, within their bet spans, and decisions on the room's, within the seat's
+    for awaited in (span for span in spans if span["name"] == "await decision"):
+        assert awaited["track"] in ("room 7", "room 7 / %s" % awaited["args"]["player"])
+        enclosing_name = "decisions" if awaited["track"] == "room 7" else "bet"
+        assert any(
+            span["name"] == enclosing_name and span["args"].get("player") == awaited["args"]["player"]
+            and span["ts"] <= awaited["ts"] and awaited["ts"] + awaited["dur"] <= span["ts"] + span["dur"]
+            for span in spans
+        )
+
+
+@mock.patch.object(server, "sio")
+def test_loop_monitor_attributes_slow_callbacks_to_their_room_and_phase(sio_mock):
+    sio_mock.emit = mock.AsyncMock()
+    sio_mock.send = mock.AsyncMock()
+    monitor = loop_monitor.LoopMonitor(sample_interval=0.005, slow_callback_threshold=0.02)
+    slow_bets = loop_monitor.slow_callbacks.labels("room 7", "BETTING")
+    slow_bets_before = slow_bets.value
+
+    def hog_the_loop(*args):
+        time.sleep(0.03)  # CPU work hogging the loop
+        return None
+
+    async def bet(game, player):
+        game.answer(player, await _prompted(player, server.PromptKinds.BET_OR_SKIP), "b")
+        game.answer(player, await _prompted(player, server.PromptKinds.BET_AMOUNT), "10")
+
+    async def play_monitored_betting():
+        monitor.start()
+        try:
+            game = server.BlackJackGameOnline(room_num=7)
+            game._shoe.shuffle_if_cut_card_reached = hog_the_loop  # In the timer starting the round
+            waiting_player = server.SocketioPlayer(name="P0", sid="sid0", amount_of_money=100)
+            blocking_player = server.SocketioPlayer(name="P1", sid="sid1", amount_of_money=100)
+            blocking_player.invalid_bet_message = hog_the_loop  # In the task answering his bet
+            game.add_player(waiting_player)
+            game.add_player(blocking_player)
+            await asyncio.create_task(bet(game, blocking_player))
+            await asyncio.sleep(0.02)
+            assert game.phase == RoundPhases.BETTING  # Until the waiting player bets
+        finally:
+            monitor.stop()
+
+    with mock.patch.object(server, "rooms", server.RoomIndex(2)), mock.patch.object(server, "players_by_sid", {}):
+        with mock.patch.object(server, "event_loop_monitor", monitor):
+            with mock.patch.object(loop_monitor, "logger") as logger_mock:
+                asyncio.run(play_monitored_betting())
+
+    assert slow_bets.value == slow_bets_before + 2
+    assert loop_monitor.slow_callback_seconds.labels("room 7", "BETTING").value >= 0.06
+    slow_steps = [call.args[-1] for call in logger_mock.warning.call_args_list]
+    assert slow_steps[0] == "BlackJackGameOnline._start_round"  # A timer, reported by room_event
+    assert slow_steps[1].startswith(bet.__qualname__)  # A task step, timed by the monitor
+    assert "blackjack_event_loop_lag_seconds_count" in metrics.REGISTRY.render()
@@ -0,0 +1,187 @@
+"""Optional timeline tracing of rounds, written as Chrome trace events.
+
+Spans are recorded as complete ("X") events of the Trace Event Format, so a trace file opens as is in
+chrome://tracing or https://ui.perfetto.dev. Every span belongs to a track, shown as a row: a room's phases and its
+players' decisions share the room's track, while bets, which players place at the same time, each get a track of
+their own. Span attributes (e.g. the room and the player) show up as the event's args.
+
+Tracing is off unless enable() was called. While it is off, span() returns a shared no-op span, so the instrumented
+code only pays for a function call.
+
+Files are rotated by size like logging's RotatingFileHandler: trace.json is moved to trace.json.1 and so on, keeping
+backup_count old files. Every file is a JSON array on its own. Events are written one per line, each followed by a
+comma and without the closing bracket, which the Trace Event Format allows, so a file is loadable while it is being
+written and even if the server died.
+
+Usage: python server.py --trace-file /tmp/blackjack-trace.json
+"""
+import json
+import os
+import time
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 3
+WRITE_BUFFER_SIZE = 64 * 1024
+
+_FILE_HEADER = "[\n"
+
+_tracer = None
+
+
+def _now_us():
+    return time.perf_counter_ns() // 1000
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def end(self):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class Span(object):
+    __slots__ = ("_tracer", "_name", "_track", "_attributes", "_start", "_ended")
+
+    def __init__(self, tracer, name, track, attributes):
+        self._tracer = tracer
+        self._name = name
+        self._track = track
+        self._attributes = attributes
+        self._start = _now_us()
+        self._ended = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._attributes["error"] = exc_type.__name__
+        self.end()
+
+    def end(self):
+        if not self._ended:
+            self._ended = True
+            self._tracer.record(self._name, self._track, self._start, _now_us(), self._attributes)
+
+
+class Tracer(object):
+    """Writes spans to path, rotating it once it grows beyond max_bytes.
+
+    Writes go through a large file buffer, so most spans cost a json.dumps and a string copy on the event loop.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, backup_count=DEFAULT_BACKUP_COUNT):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._pid = os.getpid()
+        self._track_ids = {}  # track name -> tid of its row
+        self._file = None
+        self._size = 0
+        self._open()
+
+    def _open(self):
+        self._file = open(self._path, "w", buffering=WRITE_BUFFER_SIZE, encoding="utf-8")
+        self._file.write(_FILE_HEADER)
+        self._size = len(_FILE_HEADER)
+        for track, track_id in self._track_ids.items():  # Every file names its rows
+            self._write_track_name(track, track_id)
+
+    def _rotate(self):
+        self._file.close()
+        for backup_index in range(self._backup_count - 1, 0, -1):
+            backup_path = "%s.%d" % (self._path, backup_index)
+            if os.path.exists(backup_path):
+                os.replace(backup_path, "%s.%d" % (self._path, backup_index + 1))
+        if self._backup_count > 0:
+            os.replace(self._path, self._path + ".1")
+        self._open()
+
+    def _write(self, event):
+        line = json.dumps(event, separators=(",", ":"), default=str) + ",\n"
+        if self._size + len(line) > self._max_bytes and self._size > len(_FILE_HEADER):
+            self._rotate()
+        self._file.write(line)
+        self._size += len(line)
+
+    def _write_track_name(self, track, track_id):
+        self._write({"name": "thread_name", "ph": "M", "pid": self._pid, "tid": track_id, "args": {"name": track}})
+
+    def _track_id(self, track):
+        track_id = self._track_ids.get(track)
+        if track_id is None:
+            track_id = self._track_ids[track] = len(self._track_ids) + 1
+            self._write_track_name(track, track_id)
+        return track_id
+
+    def record(self, name, track, start, end, attributes):
+        """Writes a span of track from start to end, in microseconds of time.perf_counter_ns() // 1000"""
+        if self._file.closed:  # The span started before tracing was disabled
+            return
+        self._write({
+            "name": name,
+            "ph": "X",
+            "ts": start,
+            "dur": end - start,
+            "pid": self._pid,
+            "tid": self._track_id(track),
+            "args": attributes,
+        })
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def enable(path, max_bytes=DEFAULT_MAX_BYTES, backup_count=DEFAULT_BACKUP_COUNT):
+    global _tracer
+    disable()
+    _tracer = Tracer(path, max_bytes, backup_count)
+    return _tracer
+
+
+def disable():
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+        _tracer = None
+
+
+def is_enabled():
+    return _tracer is not None
+
+
+def span(name, track, **attributes):
+    """A span of track starting now. It is recorded at the end of a with block, or when its end() is called."""
+    if _tracer is None:
+        return NO_SPAN
+    return Span(_tracer, name, track, attributes)
+
+
+def table_span(table_name, name, player_name=None, track=None):
+    """A span of a game table, on the table's track unless given another one"""
+    if _tracer is None:
+        return NO_SPAN
+    if player_name is None:
+        return Span(_tracer, name, track or table_name, {"room": table_name})
+    return Span(_tracer, name, track or table_name, {"room": table_name, "player": player_name})
+
+
+def add_arguments(parser):
+    parser.add_argument("--trace-file", help="Write a Chrome trace of the rounds to this file")
+    parser.add_argument("--trace-max-bytes", type=int, default=DEFAULT_MAX_BYTES, help="Size to rotate the trace at")
+    parser.add_argument("--trace-backups", type=int, default=DEFAULT_BACKUP_COUNT, help="Rotated trace files to keep")
+
+
+def enable_from_arguments(args):
+    if args.trace_file:
+        enable(args.trace_file, args.trace_max_bytes, args.trace_backups)